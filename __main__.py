@@ -16,19 +16,20 @@ __author__ = u'Robert Błaut <listy@blaut.biz>'
 
 import argparse
 import codecs
+import multiprocessing
 import os
-import shutil
 import subprocess
 import sys
-import tempfile
 import zipfile
 
 from datetime import datetime
-from lib.epubqcheck import qcheck
-from lib.epubqcheck import find_opf
-from lib.epubqfix import qfix
-from lib.epubqfix import rename_files
-from lib.fix_name_author import fix_name_author
+from lib.epubqindex import LibraryIndex
+from lib.epubqcache import QfixCache
+from lib.epubqcache import HYPHENATION_CACHE
+from lib.hyphenator import CACHE_SIZE
+from lib.epubqrunner import extract_epubcheck
+from lib.epubqrunner import epubcheck_library
+from lib.epubqrunner import kindlegen_library
 from lib.azkfix import to_azk
 
 SFENC = sys.getfilesystemencoding()
@@ -144,6 +145,28 @@ parser.add_argument("--fix-missing-container",
 parser.add_argument('--book-margin', nargs='?', metavar='NUMBER',
                     help='Add left and right book margin to reset CSS file '
                     '(only with -e)')
+parser.add_argument('-j', '--jobs', nargs='?', type=int, metavar='N',
+                    default=1, const=multiprocessing.cpu_count(),
+                    help='number of books processed in parallel. If N is '
+                    'omitted use all CPU cores (only with -q, -e, -p or '
+                    '-k)')
+parser.add_argument('--pack-threads', nargs='?', type=int, metavar='N',
+                    default=1, const=multiprocessing.cpu_count(),
+                    help='number of threads compressing files of a single '
+                    '_moh.epub file. If N is omitted use all CPU cores '
+                    '(only with -e)')
+parser.add_argument('--hyph-cache', nargs='?', metavar='FILE',
+                    const=HYPHENATION_CACHE,
+                    help='remember hyphenated words in database FILE and '
+                    'reuse them in next runs. If FILE is omitted use '
+                    '%s (only with -e)' % HYPHENATION_CACHE.replace('%', '%%'))
+parser.add_argument('--hyph-cache-size', type=int, metavar='N',
+                    default=CACHE_SIZE,
+                    help='number of hyphenated words kept in memory '
+                    '(default: %(default)s) (only with -e)')
+parser.add_argument('--kindlegen-timeout', type=int, metavar='SECONDS',
+                    help='stop converting a book with kindlegen after '
+                    'SECONDS (only with -k)')
 args = parser.parse_args()
 uni_dir = args.directory.decode('utf-8')
 
@@ -160,6 +183,9 @@ class Logger(object):
         self.log.write(message)
 
 
+# lxml, cssutils and the hyphenation dictionary are loaded by the modules
+# of checking and fixing phases, so they are imported in main() only when
+# these phases are requested
 def main():
     if args.alter and not args.qcheck:
         print('* WARNING! -a was ignored because it works only with -q.')
@@ -182,6 +208,22 @@ def main():
               'with -e.')
     if args.left and not args.epub:
         print('* WARNING! --left was ignored because it works only with -e.')
+    if args.jobs != 1 and not (args.qcheck or args.epub or args.epubcheck or
+                               args.kindlegen):
+        print('* WARNING! -j was ignored because it works only with -q, -e, '
+              '-p or -k.')
+    if args.pack_threads != 1 and not args.epub:
+        print('* WARNING! --pack-threads was ignored because it works only '
+              'with -e.')
+    if args.hyph_cache and not args.epub:
+        print('* WARNING! --hyph-cache was ignored because it works only '
+              'with -e.')
+    if args.hyph_cache_size != CACHE_SIZE and not args.epub:
+        print('* WARNING! --hyph-cache-size was ignored because it works '
+              'only with -e.')
+    if args.kindlegen_timeout and not args.kindlegen:
+        print('* WARNING! --kindlegen-timeout was ignored because it works '
+              'only with -k.')
     if args.log == '1':
         st = datetime.now().strftime('%Y%m%d%H%M%S')
         sys.stdout = Logger(os.path.join(uni_dir, 'eQT-' + st +
@@ -191,30 +233,21 @@ def main():
         sys.stdout = Logger(os.path.join(args.log, 'eQT-' + st +
                                          '.log'))
     ind_file = ind_root = None
+    library = LibraryIndex(uni_dir)
     if args.individual == 'nonr':
         print('')
         print('**********************************************')
         print('*** Listing EPUB files for individual mode ***')
         print('**********************************************')
         print('')
-        counter = 0
-        for root, dirs, files in os.walk(uni_dir):
-            for f in files:
-                if f.lower().endswith('.epub') and not f.lower().endswith(
-                        '_moh.epub'):
-                    print(counter, os.path.join(root, f))
-                    counter += 1
+        for counter, lf in enumerate(library.originals()):
+            print(counter, lf.path)
         return 0
     elif args.individual != 'nonr' and args.individual is not None:
-        counter = 0
-        for root, dirs, files in os.walk(uni_dir):
-            for f in files:
-                if f.lower().endswith('.epub') and not f.lower().endswith(
-                        '_moh.epub'):
-                    if counter == int(args.individual):
-                        ind_file = f
-                        ind_root = root
-                    counter += 1
+        lf = library.individual(int(args.individual))
+        if lf is not None:
+            ind_file = lf.name
+            ind_root = lf.root
     if (
             (args.author or args.title) and args.individual != 'nonr' and
             args.individual is not None
@@ -224,7 +257,9 @@ def main():
         print('*** Processing author or book title... ***')
         print('******************************************')
         print('')
+        from lib.fix_name_author import fix_name_author
         fix_name_author(ind_root, ind_file, args.author, args.title)
+        library.refresh(ind_root, ind_file)
 
     if args.rename:
         print('')
@@ -232,27 +267,33 @@ def main():
         print('*** Renaming EPUBs to "author - title" ***')
         print('******************************************')
         print('')
+        from lib.epubqcheck import find_opf
+        from lib.epubqfix import rename_files
         counter = 0
         if ind_file:
             counter += 1
             fdec = ind_file
             epbzf = zipfile.ZipFile(os.path.join(ind_root, ind_file))
             opf_root, opf_path = find_opf(epbzf)
-            rename_files(opf_path, ind_root, epbzf, ind_file, fdec)
+            new_name = rename_files(opf_path, ind_root, epbzf, ind_file, fdec)
+            if new_name:
+                library.rename(ind_root, ind_file, new_name)
+                ind_file = new_name
         else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    fdec = f
-                    if f.lower().endswith('.epub') and not f.lower().endswith(
-                            '_moh.epub'):
-                        counter += 1
-                        try:
-                            epbzf = zipfile.ZipFile(os.path.join(root, f))
-                        except zipfile.BadZipfile, e:
-                            print('! CRITICAL! Problem with file "%s": %s' % (
-                                f, str(e).decode(SFENC)))
-                        opf_root, opf_path = find_opf(epbzf)
-                        rename_files(opf_path, root, epbzf, f, fdec)
+            for lf in library.originals():
+                root, f = lf.root, lf.name
+                fdec = f
+                counter += 1
+                try:
+                    epbzf = zipfile.ZipFile(os.path.join(root, f))
+                except zipfile.BadZipfile, e:
+                    print('! CRITICAL! Problem with file "%s": %s' % (
+                        f, str(e).decode(SFENC)))
+                    continue
+                opf_root, opf_path = find_opf(epbzf)
+                new_name = rename_files(opf_path, root, epbzf, f, fdec)
+                if new_name:
+                    library.rename(root, f, new_name)
         if counter == 0:
             print('* NO epub files for renaming found!')
 
@@ -266,54 +307,31 @@ def main():
         print('******************************************')
         print('*** Checking with internal qcheck tool ***')
         print('******************************************')
-        if args.mod:
-            fe = '_moh.epub'
-            nfe = '_org.epub'
-        else:
-            fe = '.epub'
-            nfe = '_moh.epub'
-        counter = 0
+        from lib.epubqcheck import qcheck_library
+        tasks = []
         if ind_file:
-            counter += 1
-            qcheck(ind_root, ind_file_m, args.alter, args.mod, args.list_fonts)
+            tasks.append((ind_root, ind_file_m, args.alter, args.mod,
+                          args.list_fonts))
         else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    if f.lower().endswith(fe) and not f.lower().endswith(nfe):
-                        counter += 1
-                        qcheck(root, f, args.alter, args.mod, args.list_fonts)
+            for lf in library.moh_epubs() if args.mod else \
+                    library.originals():
+                tasks.append((lf.root, lf.name, args.alter, args.mod,
+                              args.list_fonts))
+        counter = len(tasks)
+        for report in qcheck_library(tasks, args.jobs):
+            for c in report.format():
+                sys.stdout.write(c)
         if counter == 0:
             print('')
             print('* NO epub files for checking found!')
 
     if args.epubcheck:
-
-        def epubchecker(echp_temp, root, f, epubcheckstr, epubcheckjar):
-            epubchecker_path = os.path.join(
-                echp_temp,
-                epubcheckstr, epubcheckjar
-            )
-            jp = subprocess.Popen([
-                'java', '-Djava.awt.headless=true', '-jar',
-                '%s' % epubchecker_path.encode(SFENC),
-                '%s' % os.path.join(root, f).encode(SFENC)
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            jpout, jperr = jp.communicate()
-            if jperr:
-                print(f + ': PROBLEMS FOUND...')
-                print('*** Details... ***')
-                print(jperr.decode(SFENC))
-            else:
-                print(f + ': OK!')
-                print('')
-
         for e in os.listdir(os.path.join(args.tools)):
             if e.startswith('epubcheck-4.'):
                 epubcheckstr = os.path.splitext(e)[0]
                 break
             else:
                 epubcheckstr = ''
-        epubcheckjar = 'epubcheck.jar'
 
         print('')
         print('***********************************************')
@@ -327,39 +345,34 @@ def main():
         except:
             sys.exit('Java is NOT installed. Giving up...')
         try:
-            echpzipfile = zipfile.ZipFile(os.path.join(args.tools,
-                                          epubcheckstr + '.zip'))
+            epubcheckjar = extract_epubcheck(
+                os.path.join(args.tools, epubcheckstr + '.zip'), epubcheckstr
+            )
         except:
             sys.exit(epubcheckstr + 'EpubCheck 4.x ZIP file not found '
                      'in directory: "' + args.tools + '" Giving up...')
-        echp_temp = tempfile.mkdtemp(suffix='', prefix='quiris-tmp-')
-        echpzipfile.extractall(echp_temp)
-        if args.mod:
-            fe = '_moh.epub'
-            nfe = '_org.epub'
-        else:
-            fe = '.epub'
-            nfe = '_moh.epub'
         counter = 0
-
+        books = []
         if ind_file:
             counter += 1
             if os.path.exists(os.path.join(ind_root, ind_file_m)):
-                epubchecker(echp_temp, ind_root, ind_file_m, epubcheckstr,
-                            epubcheckjar)
+                books.append(os.path.join(ind_root, ind_file_m))
             else:
                 print('File "%s" not found...' % ind_file_m)
         else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    if f.lower().endswith(fe) and not f.lower().endswith(nfe):
-                        counter += 1
-                        epubchecker(echp_temp, root, f, epubcheckstr,
-                                    epubcheckjar)
-        for p in os.listdir(os.path.join(echp_temp, os.pardir)):
-            if 'quiris-tmp-' in p:
-                if os.path.isdir(os.path.join(echp_temp, os.pardir, p)):
-                    shutil.rmtree(os.path.join(echp_temp, os.pardir, p))
+            for lf in library.moh_epubs() if args.mod else \
+                    library.originals():
+                counter += 1
+                books.append(lf.path)
+        for path, jperr in epubcheck_library(epubcheckjar, books, args.jobs):
+            f = os.path.basename(path)
+            if jperr:
+                print(f + ': PROBLEMS FOUND...')
+                print('*** Details... ***')
+                print(jperr.decode(SFENC))
+            else:
+                print(f + ': OK!')
+                print('')
         if counter == 0:
             print('')
             print('* NO epub files for checking found!')
@@ -369,30 +382,78 @@ def main():
         print('******************************************')
         print('*** Fixing with internal qfix tool...  ***')
         print('******************************************')
-        counter = 0
+        from lib.epubqfix import qfix, qfix_library, setup_hyphenation, \
+            hyphenation_cache, take_new_words, take_skipped_files
         if ind_file:
-            counter += 1
-            qfix(ind_root, ind_file, args.force, args.replace_font_files,
-                 args.skip_reset_css, args.tools, args.skip_hyphenate,
-                 args.skip_justify, args.left, args.myk_fix,
-                 args.remove_colors, args.remove_fonts, args.font_dir,
-                 args.fix_missing_container, args.book_margin,
-                 args.skip_hyphenate_headers, args.replace_font_family)
+            books = [library.get(ind_root, ind_file)]
+        else:
+            books = library.fixable()
+        # options which change the content of generated _moh.epub files
+        fix_opts = [args.replace_font_files, args.skip_reset_css,
+                    args.skip_hyphenate, args.skip_justify, args.left,
+                    args.myk_fix, args.remove_colors, args.remove_fonts,
+                    args.font_dir, args.book_margin,
+                    args.skip_hyphenate_headers, args.replace_font_family]
+        if args.fix_missing_container:
+            cache = None
         else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    if (f.lower().endswith('.epub') and
-                            not f.lower().endswith('_moh.epub') and
-                            not f.lower().endswith('_org.epub')):
-                        counter += 1
-                        qfix(root, f, args.force, args.replace_font_files,
-                             args.skip_reset_css, args.tools,
-                             args.skip_hyphenate, args.skip_justify, args.left,
-                             args.myk_fix, args.remove_colors,
-                             args.remove_fonts, args.font_dir,
-                             args.fix_missing_container,
-                             args.book_margin, args.skip_hyphenate_headers,
-                             args.replace_font_family)
+            cache = QfixCache(uni_dir, __version__)
+        tasks = []
+        outputs = []
+        for lf in books:
+            out = library.get(lf.root,
+                              os.path.splitext(lf.name)[0] + '_moh.epub')
+            outputs.append(out.mtime if out is not None else None)
+            if args.force or cache is None:
+                forced = args.force
+            else:
+                forced = cache.is_stale(lf, out, fix_opts)
+            tasks.append((lf.root, lf.name, (
+                forced, args.replace_font_files, args.skip_reset_css,
+                args.tools, args.skip_hyphenate, args.skip_justify,
+                args.left, args.myk_fix, args.remove_colors,
+                args.remove_fonts, args.font_dir, args.fix_missing_container,
+                args.book_margin, args.skip_hyphenate_headers,
+                args.replace_font_family, args.pack_threads
+            )))
+        counter = len(tasks)
+        hyph_options = (args.hyph_cache_size, args.hyph_cache)
+        setup_hyphenation(*hyph_options)
+        if args.hyph_cache:
+            hyph_words = hyphenation_cache(args.hyph_cache)
+        else:
+            hyph_words = None
+        skipped = 0
+        if args.jobs > 1 and counter > 1:
+            for chunks, is_problem, new_words, book_skipped in qfix_library(
+                tasks, args.jobs, hyph_options
+            ):
+                for c in chunks:
+                    sys.stdout.write(c)
+                if hyph_words is not None:
+                    hyph_words.store(new_words)
+                skipped += book_skipped
+        else:
+            for root, f, opts in tasks:
+                qfix(root, f, *opts)
+                if hyph_words is not None:
+                    hyph_words.store(take_new_words())
+            skipped = take_skipped_files()
+        if hyph_words is not None:
+            hyph_words.close()
+        if skipped:
+            print('')
+            print('* %d already hyphenated XHTML files found, hyphenating '
+                  'skipped...' % skipped)
+        for lf, out_mtime in zip(books, outputs):
+            library.refresh(lf.root, lf.name)
+            out = library.refresh(lf.root,
+                                  os.path.splitext(lf.name)[0] + '_moh.epub')
+            if (cache is not None and out is not None and
+                    out.mtime != out_mtime):
+                cache.store(lf, fix_opts)
+        if cache is not None:
+            cache.close()
         if counter == 0:
             print('')
             print('* NO epub files for fixing found!')
@@ -403,64 +464,61 @@ def main():
         print('*** Converting with kindlegen tool...  ***')
         print('******************************************')
 
-        def to_mobi(root, f, cover_html_found, error_found):
+        def book(root, f):
             newmobifile = os.path.splitext(f)[0] + '.mobi'
-            if not args.force:
-                if os.path.isfile(os.path.join(root, newmobifile)):
-                    print('* Skipping previously generated _moh file: ' +
-                          newmobifile)
-                    return 0
-            print('')
-            print('* Kindlegen: Converting file: ' + f)
-            if sys.platform == 'win32':
-                kgapp = 'kindlegen.exe'
-            else:
-                kgapp = 'kindlegen'
-            try:
-                proc = subprocess.Popen([
-                    os.path.join(args.tools, kgapp).encode(SFENC),
-                    '-dont_append_source',
-                    compression,
-                    os.path.join(root, f).encode(SFENC)
-                ], stdout=subprocess.PIPE).communicate()[0]
-            except OSError:
-                try:
-                    proc = subprocess.Popen([
-                        os.path.join(kgapp).encode(SFENC),
-                        '-dont_append_source',
-                        compression,
-                        os.path.join(root, f).encode(SFENC)
-                    ], stdout=subprocess.PIPE).communicate()[0]
-                except:
-                    sys.exit('ERROR! Kindlegen not found in directory: "' +
-                             args.tools + '" Giving up...')
-            for ln in proc.splitlines():
-                if 'Warning' in ln and 'W14029' not in ln:
-                    print(' ', ln)
-                if 'Error' in ln:
-                    print(' ', ln)
-                    error_found = True
-                if ('I1052' in ln):
-                    cover_html_found = True
-            if not cover_html_found and not error_found:
-                print('')
-                print('* WARNING: Probably duplicated covers generated '
-                      'in file: ' + newmobifile)
+            skip = (not args.force and
+                    os.path.isfile(os.path.join(root, newmobifile)))
+            return os.path.join(root, f), skip
 
+        if sys.platform == 'win32':
+            kgapp = 'kindlegen.exe'
+        else:
+            kgapp = 'kindlegen'
+        if os.path.isfile(os.path.join(args.tools, kgapp)):
+            kgapp = os.path.join(args.tools, kgapp)
         compression = '-c2' if args.huffdic else '-c1'
         counter = 0
-        cover_html_found = error_found = False
+        books = []
+        refresh = []
         if ind_file:
             counter += 1
-            to_mobi(ind_root, os.path.splitext(ind_file)[0] + '_moh.epub',
-                    cover_html_found, error_found)
+            books.append(book(ind_root,
+                              os.path.splitext(ind_file)[0] + '_moh.epub'))
+            refresh.append((ind_root,
+                            os.path.splitext(ind_file)[0] + '_moh.mobi'))
         else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    cover_html_found = error_found = False
-                    if f.lower().endswith('_moh.epub'):
-                        counter += 1
-                        to_mobi(root, f, cover_html_found, error_found)
+            for lf in library.moh_epubs():
+                counter += 1
+                books.append(book(lf.root, lf.name))
+                refresh.append((lf.root,
+                                os.path.splitext(lf.name)[0] + '.mobi'))
+        try:
+            for report, (root, name) in zip(
+                kindlegen_library(kgapp, books, compression, args.jobs,
+                                  args.kindlegen_timeout), refresh
+            ):
+                library.refresh(root, name)
+                f = os.path.basename(report.path)
+                newmobifile = os.path.splitext(f)[0] + '.mobi'
+                if report.skipped:
+                    print('* Skipping previously generated _moh file: ' +
+                          newmobifile)
+                    continue
+                print('')
+                print('* Kindlegen: Converting file: ' + f)
+                for ln in report.lines:
+                    print(' ', ln)
+                if report.timed_out:
+                    print('* ERROR! Kindlegen stopped after %d seconds: %s' % (
+                        args.kindlegen_timeout, f
+                    ))
+                elif not report.cover_html_found and not report.error_found:
+                    print('')
+                    print('* WARNING: Probably duplicated covers generated '
+                          'in file: ' + newmobifile)
+        except OSError:
+            sys.exit('ERROR! Kindlegen not found in directory: "' +
+                     args.tools + '" Giving up...')
         if counter == 0:
             print('')
             print('* NO *_moh.epub files for converting found!')
@@ -477,11 +535,9 @@ def main():
             to_azk(ind_root, os.path.splitext(ind_file)[0] + '_moh.mobi',
                    args.force)
         else:
-            for root, dirs, files in os.walk(uni_dir):
-                for f in files:
-                    if f.lower().endswith('_moh.mobi'):
-                        counter += 1
-                        to_azk(root, f, args.force)
+            for lf in library.moh_mobis():
+                counter += 1
+                to_azk(lf.root, lf.name, args.force)
         if counter == 0:
             print('')
             print('* NO *_moh.mobi files for converting found!')
@@ -494,4 +550,5 @@ def main():
     return 0
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     sys.exit(main())
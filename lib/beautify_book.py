@@ -8,26 +8,22 @@
 from __future__ import print_function
 import os
 import sys
-import re
-import shutil
 import logging
-from lib.epubqcheck import list_font_basic_properties
-from urllib import unquote
+from collections import OrderedDict
+from lib.epubqcheck import list_font_basic_properties, setup_cssutils
+from lib import epubqpatterns as pat
+from lib.epubqrefs import ReferenceGraph
 
 SFENC = sys.getfilesystemencoding()
 try:
     from lxml import etree
-    import cssutils
 except ImportError as e:
     sys.exit('! CRITICAL! ' + str(e).decode(SFENC))
+cssutils = setup_cssutils()
 
 HOME = os.path.expanduser("~")
 DCNS = {'dc': 'http://purl.org/dc/elements/1.1/'}
 OPFNS = {'opf': 'http://www.idpf.org/2007/opf'}
-XHTMLNS = {'xhtml': 'http://www.w3.org/1999/xhtml'}
-NCXNS = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
-XLXHTNS = {'xhtml': 'http://www.w3.org/1999/xhtml',
-           'xlink': 'http://www.w3.org/1999/xlink'}
 
 cssutils.log.setLevel(logging.CRITICAL)
 cssutils.ser.prefs.omitLastSemicolon = False
@@ -61,22 +57,21 @@ def change_font_family_value(cssvalue, new_name):
     cssvalue._type = 'STRING'
 
 
-def fix_property(prop, old_name, new_name, is_url):
+def fix_property(prop, names, is_url):
     changed = False
     ff = prop.propertyValue
     for i in xrange(ff.length):
         val = ff.item(i)
-        if (hasattr(val.value, 'lower') and
-                val.value.lower() == old_name.lower()):
+        if hasattr(val.value, 'lower') and val.value.lower() in names:
             if is_url:
-                val.value = new_name
+                val.value = names[val.value.lower()]
             else:
-                change_font_family_value(val, new_name)
+                change_font_family_value(val, names[val.value.lower()])
             changed = True
     return changed
 
 
-def fix_declaration(style, old_name, new_name, is_url):
+def fix_declaration(style, names, is_url):
     changed = False
     if is_url:
         prop_list = ('src',)
@@ -85,11 +80,16 @@ def fix_declaration(style, old_name, new_name, is_url):
     for x in prop_list:
         prop = style.getProperty(x)
         if prop is not None:
-            changed |= fix_property(prop, old_name, new_name, is_url)
+            changed |= fix_property(prop, names, is_url)
     return changed
 
 
-def fix_sheet(sheet, old_name, new_name, is_url):
+def fix_sheet(sheet, names, is_url):
+    """
+    Replace font URLs or font family names in the sheet in a single pass.
+
+    names maps lower case old names to new names.
+    """
     changed = False
     if is_url:
         rules_list = (cssutils.css.CSSRule.FONT_FACE_RULE,)
@@ -98,20 +98,21 @@ def fix_sheet(sheet, old_name, new_name, is_url):
                       cssutils.css.CSSRule.STYLE_RULE)
     for rule in sheet.cssRules:
         if rule.type in rules_list:
-            if fix_declaration(rule.style, old_name, new_name, is_url):
+            if fix_declaration(rule.style, names, is_url):
                 changed = True
     return changed
 
 
-def replace_file(epub_dir, old_path, new_absolute_path):
+def replace_file(ws, old_path, new_absolute_path):
     font_replaced = False
-    old_absolute_path = os.path.join(epub_dir, old_path)
-    if os.path.exists(old_absolute_path):
-        os.remove(old_absolute_path)
-        shutil.copyfile(new_absolute_path, os.path.join(
-            os.path.dirname(old_absolute_path),
-            os.path.basename(new_absolute_path)
-        ))
+    old_absolute_path = ws.href_name(old_path)
+    if ws.exists(old_absolute_path):
+        ws.remove(old_absolute_path)
+        with open(new_absolute_path, 'rb') as f:
+            ws.write(ws.join(
+                os.path.dirname(old_absolute_path),
+                os.path.basename(new_absolute_path)
+            ), f.read())
         font_replaced = True
     if font_replaced:
         print('* File "%s" was replaced with "%s"...' % (
@@ -120,19 +121,93 @@ def replace_file(epub_dir, old_path, new_absolute_path):
         ))
 
 
-def update_css_font_families(epub_dir, opftree):
+class RenameTransaction(object):
+    """
+    Renames and replacements of files of a book applied together.
+
+    Files to rename are collected by rename() as a map of old href to new
+    href, and commit() applies the whole map at once: the OPF is updated
+    in one pass, files are moved in the workspace and the reference graph
+    rewrites URLs in XHTML and NCX files. Then every document and
+    stylesheet referring to renamed files is changed once, so only files
+    which were actually changed are written back.
+    """
+
+    def __init__(self, opftree, graph, ws, sheets):
+        self.opftree = opftree
+        self.graph = graph
+        self.ws = ws
+        self.sheets = sheets
+        # old href -> (new href, absolute path of a replacement file)
+        self.renames = OrderedDict()
+
+    def is_taken(self, new_name_path):
+        return (self.opftree.item_by_href(new_name_path) is not None or
+                any(n == new_name_path for n, a in self.renames.values()))
+
+    def rename(self, old_name_path, new_name_path, new_absolute_path=None):
+        """
+        Add a rename of the file old_name_path to the transaction.
+
+        With new_absolute_path the file is replaced with the given file.
+        Return False if the new name is already taken.
+        """
+        new_name_path = new_name_path.replace('\\', '/')
+        if self.is_taken(new_name_path):
+            # if new_name_path exists unable to continue
+            print("! New file name is already taken by other file...")
+            return False
+        self.renames[old_name_path] = (new_name_path, new_absolute_path)
+        return True
+
+    def update_opf(self):
+        for old_name_path, (new_name_path, _) in self.renames.items():
+            item = self.opftree.item_by_href(old_name_path)
+            if item is not None:
+                self.opftree.set(item, 'href', new_name_path)
+        for r in self.opftree.xpath('//opf:reference[@href]',
+                                    namespaces=OPFNS):
+            if r.get('href') in self.renames:
+                r.set('href', self.renames[r.get('href')][0])
+
+    def commit(self):
+        ws = self.ws
+        self.update_opf()
+        # stylesheet -> archive names of renamed files it refers to
+        css_renames = OrderedDict()
+        documents = set()
+        for old_name_path, (new_name_path, new_absolute_path) in (
+                self.renames.items()):
+            old_name = ws.href_name(old_name_path)
+            new_name = ws.href_name(new_name_path)
+            if new_absolute_path:
+                replace_file(ws, old_name_path, new_absolute_path)
+            else:
+                ws.rename(old_name, new_name)
+            for ref in self.graph.rename(old_name, new_name):
+                if ref.element is None:
+                    css_renames.setdefault(ref.source, OrderedDict())[
+                        old_name] = new_name
+                else:
+                    documents.add(ref.source)
+        for name in sorted(documents):
+            ws.touch(name)
+        for css_file_path, names in css_renames.items():
+            css_dir = os.path.dirname(css_file_path)
+            urls = dict((ws.relpath(o, css_dir).lower(),
+                         ws.relpath(n, css_dir)) for o, n in names.items())
+            if fix_sheet(self.sheets.sheet(css_file_path), urls, True):
+                self.sheets.touch(css_file_path)
+        self.renames.clear()
+
+
+def update_css_font_families(ws, sheets, opftree):
 
-    def find_css_font_file_families(epub_dir, opftree):
+    def find_css_font_file_families(ws, sheets, opftree):
         font_families = []
-        css_items = etree.XPath(
-            '//opf:item[@media-type="text/css"]',
-            namespaces=OPFNS
-        )(opftree)
-        for c in css_items:
-            css_file_path = os.path.join(epub_dir, c.get('href'))
-            sheet = cssutils.parseFile(css_file_path,
-                                       validate=True)
-            for rule in sheet:
+        for c in opftree.items('text/css'):
+            css_file_path = ws.href_name(c.get('href'))
+            for rule in sheets.sheet(css_file_path):
                 if rule.type == rule.FONT_FACE_RULE:
                     css_font_family = None
                     font_file_family = None
@@ -147,58 +222,48 @@ def update_css_font_families(epub_dir, opftree):
                         if p.name == 'src' and font_file_family is None:
                             ffs = rule.style.getProperty(p.name).propertyValue
                             ff_url = ffs.item(0).value
-                            with open(os.path.join(
+                            lfp = list_font_basic_properties(ws.read(ws.join(
                                 os.path.dirname(css_file_path), ff_url
-                            ), 'rb') as f:
-                                lfp = list_font_basic_properties(f.read())
-                                lfp = list(lfp)
-                                if 'subset of' in lfp[0]:
-                                    lfp[0] = re.sub(
-                                        r'\w+?\s-\ssubset\sof\s', '',
-                                        lfp[0]
-                                    )
-                                font_file_family = lfp[0]
-                                continue
+                            )))
+                            lfp = list(lfp)
+                            if 'subset of' in lfp[0]:
+                                lfp[0] = pat.FONT_SUBSET_PREFIX.sub(
+                                    '', lfp[0]
+                                )
+                            font_file_family = lfp[0]
+                            continue
                     font_families.append([css_font_family, font_file_family])
             return font_families
 
     print('* Updating font-family in all CSS files...')
-    ff_list = find_css_font_file_families(epub_dir, opftree)
-    css_items = etree.XPath('//opf:item[@media-type="text/css"]',
-                            namespaces=OPFNS)(opftree)
-    for c in css_items:
-        css_file_path = os.path.join(epub_dir, c.get('href'))
-        sheet = cssutils.parseFile(css_file_path, validate=True)
-
+    ff_list = find_css_font_file_families(ws, sheets, opftree)
+    for c in opftree.items('text/css'):
+        css_file_path = ws.href_name(c.get('href'))
+        changed = False
         for ff in ff_list:
-            fix_sheet(sheet, ff[0], ff[1], False)
-
-        with open(os.path.join(epub_dir, c.get('href')), 'w') as f:
-            f.write(sheet.cssText)
+            changed |= fix_sheet(sheets.sheet(css_file_path),
+                                 {ff[0].lower(): ff[1]}, False)
+        if changed:
+            sheets.touch(css_file_path)
 
 
-def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
+def replace_fonts(user_font_dir, ws, renames, opftree, pair_family):
 
     # TODO: replace also family-name in CSS
 
-    def find_old_family_fonts(epub_dir, opftree, family_name):
-        font_items = etree.XPath(
-            '//opf:item[@media-type="application/vnd.ms-opentype"]',
-            namespaces=OPFNS
-        )(opftree)
+    def find_old_family_fonts(ws, opftree, family_name):
         family_font_list = []
-        for f in font_items:
+        for f in opftree.items('application/vnd.ms-opentype'):
             furl = f.get('href')
-            with open(os.path.join(epub_dir, furl), 'rb') as f:
-                lfp = list_font_basic_properties(f.read())
-                lfp = list(lfp)
-                if 'subset of' in lfp[0]:
-                    lfp[0] = re.sub(r'\w+?\s-\ssubset\sof\s', '', lfp[0])
-                if lfp[0] == family_name:
-                    family_font_list.append([furl] + lfp)
+            lfp = list_font_basic_properties(ws.read(ws.href_name(furl)))
+            lfp = list(lfp)
+            if 'subset of' in lfp[0]:
+                lfp[0] = pat.FONT_SUBSET_PREFIX.sub('', lfp[0])
+            if lfp[0] == family_name:
+                family_font_list.append([furl] + lfp)
         return family_font_list
 
-    def find_new_family_fonts(user_font_dir, epub_dir, opftree, family_name,
+    def find_new_family_fonts(user_font_dir, ws, opftree, family_name,
                               is_all):
         family_font_list = []
         for root, dirs, files in os.walk(user_font_dir):
@@ -231,9 +296,9 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
             return None
     else:
         return None
-    new_font_files = find_new_family_fonts(user_font_dir, epub_dir, opftree,
+    new_font_files = find_new_family_fonts(user_font_dir, ws, opftree,
                                            nf, False)
-    old_font_files = find_old_family_fonts(epub_dir, opftree, of)
+    old_font_files = find_old_family_fonts(ws, opftree, of)
     if old_font_files == []:
         print('! No font with family name "%s" was found in EPUB file'
               '...' % (of))
@@ -241,7 +306,7 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
         print('! No font with family name "%s" was found in provided '
               'directory "%s"...' % (nf, user_font_dir))
         print('* Choose from the below list of font family names:')
-        for i in find_new_family_fonts(user_font_dir, epub_dir, opftree,
+        for i in find_new_family_fonts(user_font_dir, ws, opftree,
                                        nf, True):
             print(
                 '* Font info for %s, Family name: "%s", '
@@ -255,225 +320,61 @@ def replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family):
             if o[2] == n[2] and o[3] == n[3] and o[4] == n[4]:
                 nfp = os.path.join(os.path.dirname(o[0]),
                                    os.path.basename(n[0]))
-                rename_replace_files(opftree, ncxtree, epub_dir, o[0], nfp,
-                                     n[0])
-
-
-def fix_body_id_links(opftree, epub_dir, ncxtree):
-
-    def get_body_id_list(opftree, epub_dir):
-        # build list with body tags with id attributes
-        xhtml_items = etree.XPath(
-            '//opf:item[@media-type="application/xhtml+xml"]',
-            namespaces=OPFNS
-        )(opftree)
-        body_id_list = []
-        for i in xhtml_items:
-            xhtml_url = i.get('href')
-            xhtree = etree.parse(os.path.join(epub_dir, xhtml_url),
-                                 parser=etree.XMLParser(recover=False))
-            try:
-                body_id = etree.XPath('//xhtml:body[@id]',
-                                      namespaces=XHTMLNS)(xhtree)[0]
-            except IndexError:
-                body_id = None
-            if body_id is not None:
-                body_id_list.append(os.path.basename(
-                    xhtml_url
-                ) + '#' + body_id.get('id'))
-        return body_id_list
-
-    body_id_list = get_body_id_list(opftree, epub_dir)
-    contents = etree.XPath('//ncx:content', namespaces=NCXNS)(ncxtree)
-    content_src_list = []
-    for c in contents:
-        content_src_list.append(c.get('src'))
-    for c in contents:
-        if (c.get('src').split('/')[-1] in body_id_list and
-                c.get('src').split('#')[0] not in content_src_list):
-            print("* Fixing body_id link: " + c.get('src'))
-            c.set('src', c.get('src').split('#')[0])
-
-
-def rename_replace_files(opftree, ncxtree, epub_dir, old_name_path,
-                         new_name_path, new_absolute_path):
-
-    def fix_references_in_xhtml(opftree, epub_dir, old_name_path,
-                                new_name_path):
-        xhtml_items = etree.XPath(
-            '//opf:item[@media-type="application/xhtml+xml"]',
-            namespaces=OPFNS
-        )(opftree)
-
-        for i in xhtml_items:
-            xhtml_url = i.get('href')
-            try:
-                xhtree = etree.parse(os.path.join(epub_dir, xhtml_url),
-                                     parser=etree.XMLParser(recover=False))
-            except (etree.XMLSyntaxError, IOError):
-                continue
-            urls = etree.XPath('//*[@href or @src or @xlink:href]',
-                               namespaces=XLXHTNS)(xhtree)
-            exclude_urls = ('http://', 'https://', 'mailto:',
-                            'tel:', 'data:', '#')
-            xhtml_dir = os.path.dirname(os.path.join(epub_dir, xhtml_url))
-            diff_path = os.path.relpath(
-                os.path.dirname(os.path.join(epub_dir, old_name_path)),
-                os.path.dirname(os.path.join(epub_dir, new_name_path))
-            )
-            for u in urls:
-                if u.get('src'):
-                    url = u.get('src')
-                elif u.get('href'):
-                    url = u.get('href')
-                elif u.get('{http://www.w3.org/1999/xlink}href'):
-                    url = u.get('{http://www.w3.org/1999/xlink}href')
-                if url.lower().startswith(exclude_urls):
-                    continue
-                url = unquote(url)
-                if '#' in url:
-                    frag_url = '#' + url.split('#')[1]
-                    url = url.split('#')[0]
-                else:
-                    frag_url = ''
-                if os.path.basename(
-                    xhtml_url
-                ) == os.path.basename(new_name_path):
-                    if u.get('src'):
-                        u.set('src', os.path.join(
-                            diff_path, u.get('src')
-                        ).replace('\\', '/') + frag_url)
-                    elif u.get('href'):
-                        u.set('href', os.path.join(
-                            diff_path, u.get('href')
-                        ).replace('\\', '/') + frag_url)
-                    elif u.get('{http://www.w3.org/1999/xlink}href'):
-                        u.set(
-                            '{http://www.w3.org/1999/xlink}href',
-                            os.path.join(
-                                diff_path,
-                                u.get('{http://www.w3.org/1999/xlink}href')
-                            ).replace('\\', '/') + frag_url
-                        )
-                if os.path.basename(url) == os.path.basename(old_name_path):
-                    if u.get('src'):
-                        u.set('src', os.path.relpath(
-                            os.path.join(epub_dir, new_name_path), xhtml_dir
-                        ).replace('\\', '/') + frag_url)
-                    elif u.get('href'):
-                        u.set('href', os.path.relpath(
-                            os.path.join(epub_dir, new_name_path), xhtml_dir
-                        ).replace('\\', '/') + frag_url)
-                    elif u.get('{http://www.w3.org/1999/xlink}href'):
-                        u.set(
-                            '{http://www.w3.org/1999/xlink}href',
-                            os.path.relpath(
-                                os.path.join(epub_dir, new_name_path),
-                                xhtml_dir
-                            ).replace('\\', '/') + frag_url
-                        )
-            write_file_changes_back(xhtree, os.path.join(epub_dir, xhtml_url))
-
-    def update_css(opftree, epub_dir, old_name_path, new_name_path):
-        css_items = etree.XPath(
-            '//opf:item[@media-type="text/css"]',
-            namespaces=OPFNS
-        )(opftree)
-        for c in css_items:
-            sheet = cssutils.parseFile(os.path.join(epub_dir, c.get('href')),
-                                       validate=True)
-            old_css_path = os.path.relpath(
-                old_name_path,
-                os.path.dirname(c.get('href'))
-            ).replace('\\', '/')
-            new_css_path = os.path.relpath(
-                new_name_path,
-                os.path.dirname(c.get('href'))
-            ).replace('\\', '/')
-
-            fix_sheet(sheet, old_css_path, new_css_path, True)
-
-            with open(os.path.join(epub_dir, c.get('href')), 'w') as f:
-                f.write(sheet.cssText)
-
-    def update_opf(opftree, old_name_path, new_name_path):
-        items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(opftree)
-        for i in items:
-            if i.get('href') == new_name_path:
-                # if new_name_path exists unable to continue
-                print("! New file name is already taken by other file...")
-                return opftree, False
-        for i in items:
-            if i.get('href') == old_name_path:
-                i.set('href', new_name_path.replace('\\', '/'))
-                break
-        references = etree.XPath('//opf:reference[@href]',
-                                 namespaces=OPFNS)(opftree)
-        for r in references:
-            if r.get('href') == old_name_path:
-                r.set('href', new_name_path.replace('\\', '/'))
-        return opftree, True
-
-    def update_ncx(ncxtree, old_name_path, new_name_path):
-        contents = etree.XPath('//ncx:content', namespaces=NCXNS)(ncxtree)
-        for c in contents:
-            if c.get('src') == old_name_path:
-                c.set('src', new_name_path.replace('\\', '/'))
-
-    opftree, is_updated = update_opf(opftree, old_name_path, new_name_path)
-    if is_updated:
-        if new_absolute_path:
-            replace_file(epub_dir, old_name_path, new_absolute_path)
-        else:
-            try:
-                os.rename(os.path.join(epub_dir, old_name_path),
-                          os.path.join(epub_dir, new_name_path))
-            except WindowsError:
-                os.unlink(os.path.join(epub_dir, new_name_path))
-                os.rename(os.path.join(epub_dir, old_name_path),
-                          os.path.join(epub_dir, new_name_path))
-        ncxtree = update_ncx(ncxtree, old_name_path, new_name_path)
-        update_css(opftree, epub_dir, old_name_path, new_name_path)
-        fix_references_in_xhtml(opftree, epub_dir, old_name_path,
-                                new_name_path)
-    return opftree, ncxtree
+                renames.rename(o[0], nfp, n[0])
 
 
-def most_common(lst):
-    return max(set(lst), key=lst.count)
+def build_reference_graph(opftree, ncx_file, ncxtree, ws, sheets):
+    graph = ReferenceGraph(ws.namelist())
+    for i in opftree.items('application/xhtml+xml'):
+        xhtml_file = ws.href_name(i.get('href'))
+        try:
+            graph.add_document(xhtml_file,
+                               ws.document(xhtml_file, strict=True))
+        except (etree.XMLSyntaxError, IOError):
+            continue
+    for c in opftree.items('text/css'):
+        css_file = ws.href_name(c.get('href'))
+        try:
+            graph.add_stylesheet(css_file, sheets.text(css_file))
+        except IOError:
+            continue
+    graph.add_document(ncx_file, ncxtree)
+    return graph
+
+
+def fix_body_id_links(graph, ncx_file):
+    # NCX items linking to body with id are not accepted by kindlegen,
+    # unless the file is linked without the anchor as well
+    refs = graph.references(ncx_file)
+    linked_files = set(r.target for r in refs if not r.anchor)
+    for r in refs:
+        if (r.anchor and r.anchor == graph.body_ids.get(r.target) and
+                r.target not in linked_files):
+            src = r.element.get(r.attribute)
+            print("* Fixing body_id link: " + src)
+            graph.update(r, src.split('#')[0])
 
 
-def write_file_changes_back(tree, file_path):
-    with open(file_path, 'w') as f:
-        f.write(etree.tostring(tree.getroot(), pretty_print=True,
-                standalone=False, xml_declaration=True, encoding='utf-8'))
+def most_common(lst):
+    return max(set(lst), key=lst.count)
 
 
-def rename_calibre_cover(opftree, ncxtree, epub_dir):
-        for r in etree.XPath('//opf:reference[@type="cover"]',
-                             namespaces=OPFNS)(opftree):
+def rename_calibre_cover(opftree, renames):
+        for r in opftree.xpath('//opf:reference[@type="cover"]',
+                               namespaces=OPFNS):
             if os.path.basename(r.get('href')) == 'titlepage.xhtml':
                 print("* Renaming calibre cover file to 'cover.html'...")
-                xhtml_items = etree.XPath(
-                    '//opf:item[@media-type="application/xhtml+xml"]',
-                    namespaces=OPFNS
-                )(opftree)
                 xhtml_dirs = []
-                for i in xhtml_items:
+                for i in opftree.items('application/xhtml+xml'):
                     xhtml_dirs.append(os.path.dirname(i.get('href')))
                 most_xthml_dir = most_common(xhtml_dirs)
                 if most_xthml_dir != '':
                     pass
-                try:
-                    rename_replace_files(
-                        opftree, ncxtree, epub_dir, r.get('href'),
-                        os.path.join(most_xthml_dir, 'cover.html'), False
-                    )
-                except WindowsError:
-                    pass
+                renames.rename(r.get('href'),
+                               os.path.join(most_xthml_dir, 'cover.html'))
 
 
-def rename_cover_img(opftree, ncxtree, epub_dir):
+def rename_cover_img(opftree, ws, renames):
     try:
         meta_cover_id = opftree.xpath('//opf:meta[@name="cover"]',
                                       namespaces=OPFNS)[0].get('content')
@@ -481,10 +382,8 @@ def rename_cover_img(opftree, ncxtree, epub_dir):
         print('! ERROR! Unable to rename cover file. '
               'Cover file is not properly defined...')
         return None
-    try:
-        cover_item = opftree.xpath('//opf:item[@id="' + meta_cover_id + '"]',
-                                   namespaces=OPFNS)[0]
-    except IndexError:
+    cover_item = opftree.item_by_id(meta_cover_id)
+    if cover_item is None:
         print('! ERROR! Unable to rename cover file. '
               'Cover is not properly defined...')
         return None
@@ -498,10 +397,9 @@ def rename_cover_img(opftree, ncxtree, epub_dir):
         for e in extensions:
             new_name_path = os.path.join(os.path.dirname(cover_file),
                                          'cover' + e)
-            if not os.path.isfile(os.path.join(epub_dir, new_name_path)):
+            if not ws.exists(ws.href_name(new_name_path)):
                 print("* Renaming cover image to: " + new_name_path)
-                rename_replace_files(opftree, ncxtree, epub_dir, cover_file,
-                                     new_name_path, False)
+                renames.rename(cover_file, new_name_path)
                 break
 
 
@@ -509,40 +407,32 @@ def make_cover_item_first(opftree):
     try:
         meta_cover_id = opftree.xpath('//opf:meta[@name="cover"]',
                                       namespaces=OPFNS)[0].get('content')
-        cover_item = opftree.xpath('//opf:item[@id="' + meta_cover_id + '"]',
-                                   namespaces=OPFNS)[0]
     except IndexError:
+        meta_cover_id = None
+    cover_item = opftree.item_by_id(meta_cover_id)
+    if cover_item is None:
         print('! ERROR! Unable to make cover item first. '
               'Cover is not properly defined...')
         return None
-    manifest = cover_item.getparent()
-    if manifest[0] != cover_item:
+    if cover_item.getparent()[0] != cover_item:
         print('* Make cover image item first...')
-        manifest.remove(cover_item)
-        manifest.insert(0, cover_item)
+        opftree.move_first(cover_item)
 
 
 def make_content_src_list(ncxtree):
-    contents = etree.XPath('//ncx:content[@src]', namespaces=NCXNS)(ncxtree)
+    contents = pat.NCX_CONTENTS_WITH_SRC(ncxtree)
     cont_src_list = []
     for c in contents:
         cont_src_list.append(c.get('src').split('/')[-1])
     return cont_src_list
 
 
-def fix_display_none(opftree, epub_dir, cont_src_list):
-    xhtml_items = etree.XPath(
-        '//opf:item[@media-type="application/xhtml+xml"]',
-        namespaces=OPFNS
-    )(opftree)
-    for i in xhtml_items:
+def fix_display_none(opftree, ws, cont_src_list):
+    for i in opftree.items('application/xhtml+xml'):
         is_updated = False
         xhtml_url = i.get('href')
-        xhtree = etree.parse(os.path.join(epub_dir, xhtml_url),
-                             parser=etree.XMLParser(recover=False))
-        styles = etree.XPath('//*[@style]',
-                             namespaces=XHTMLNS)(xhtree)
-        for s in styles:
+        xhtree = ws.document(ws.href_name(xhtml_url), strict=True)
+        for s in pat.WITH_STYLE(xhtree):
             if (
                 (
                     ('display: none' in s.get('style')) or
@@ -552,48 +442,31 @@ def fix_display_none(opftree, epub_dir, cont_src_list):
             ):
                 print('* Replacing problematic style: none with '
                       'visibility: hidden...')
-                stylestr = re.sub(r'display\s*:\s*none',
-                                  'visibility: hidden; height: 0',
-                                  s.get('style'))
+                stylestr = pat.DISPLAY_NONE.sub(
+                    'visibility: hidden; height: 0', s.get('style')
+                )
                 s.set('style', stylestr)
                 is_updated = True
         if is_updated:
-            write_file_changes_back(xhtree, os.path.join(epub_dir, xhtml_url))
-
-
-def beautify_book(root, f, user_font_dir, pair_family):
-    from lib.epubqfix import pack_epub
-    from lib.epubqfix import unpack_epub
-    from lib.epubqfix import clean_temp
-    from lib.epubqfix import find_roots
-    f = f.replace('.epub', '_moh.epub')
-    print('START beautify for: ' + f)
-    tempdir = unpack_epub(os.path.join(root, f))
-    opf_dir, opf_file, is_fixed = find_roots(tempdir)
-    epub_dir = os.path.join(tempdir, opf_dir)
-    opf_path = os.path.join(tempdir, opf_file)
-    parser = etree.XMLParser(remove_blank_text=True)
-    opftree = etree.parse(opf_path, parser)
-    ncxfile = etree.XPath(
-        '//opf:item[@media-type="application/x-dtbncx+xml"]',
-        namespaces=OPFNS
-    )(opftree)[0].get('href')
-    ncx_path = os.path.join(epub_dir, ncxfile)
-    ncxtree = etree.parse(ncx_path, parser)
-
-    rename_calibre_cover(opftree, ncxtree, epub_dir)
-    rename_cover_img(opftree, ncxtree, epub_dir)
-    fix_body_id_links(opftree, epub_dir, ncxtree)
+            ws.touch(ws.href_name(xhtml_url))
+
+
+def beautify_book(opftree, ncxtree, ws, sheets, user_font_dir, pair_family):
+    ncx_file = ws.href_name(
+        opftree.items('application/x-dtbncx+xml')[0].get('href')
+    )
+    # references between files of the book are found once
+    graph = build_reference_graph(opftree, ncx_file, ncxtree, ws, sheets)
+    # files are renamed together, after all fixes are done
+    renames = RenameTransaction(opftree, graph, ws, sheets)
+    rename_calibre_cover(opftree, renames)
+    rename_cover_img(opftree, ws, renames)
+    fix_body_id_links(graph, ncx_file)
     make_cover_item_first(opftree)
     cont_src_list = make_content_src_list(ncxtree)
-    fix_display_none(opftree, epub_dir, cont_src_list)
-    replace_fonts(user_font_dir, epub_dir, ncxtree, opftree, pair_family)
+    fix_display_none(opftree, ws, cont_src_list)
+    replace_fonts(user_font_dir, ws, renames, opftree, pair_family)
+    renames.commit()
     clean_meta_tags(opftree)
     # temprorary disabled due critical problems
-    # update_css_font_families(epub_dir, opftree)
-
-    write_file_changes_back(opftree, opf_path)
-    write_file_changes_back(ncxtree, ncx_path)
-    pack_epub(os.path.join(root, f), tempdir)
-    clean_temp(tempdir)
-    print('FINISH beautify for: ' + f)
+    # update_css_font_families(ws, sheets, opftree)
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+# Benchmarks of epubQTools internals. Run from the epubQTools directory:
+#     python -m lib.epubqbench pack --size 100 --threads 4
+#     python -m lib.epubqbench hyph --words 50000 --output hyph.json
+#     python -m lib.epubqbench startup --max-time 0.5
+#     python -m lib.epubqbench entities --size 2
+#     python -m lib.epubqbench files --files 5000
+#
+
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from lib.epubqworkspace import EpubWorkspace
+from lib.hyphenator import Compiled_dict, Hyph_dict, Hyphenator, LRU_cache
+from lib.hyphenator import compile_dict
+from lib.htmlconstants import entities, replace_entities
+
+
+parser = argparse.ArgumentParser(prog='python -m lib.epubqbench')
+subparsers = parser.add_subparsers(dest='command')
+pack_parser = subparsers.add_parser(
+    'pack', help='pack a synthetic fixed-layout EPUB file'
+)
+pack_parser.add_argument('--size', type=int, default=100, metavar='MB',
+                         help='approximate size of the EPUB file in MB')
+pack_parser.add_argument('--threads', type=int,
+                         default=multiprocessing.cpu_count(), metavar='N',
+                         help='number of threads compared with one thread')
+pack_parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                         help='best time of N runs is reported')
+hyph_parser = subparsers.add_parser(
+    'hyph', help='hyphenate a generated corpus of Polish words'
+)
+hyph_parser.add_argument('--words', type=int, default=50000, metavar='N',
+                         help='number of words in the corpus')
+hyph_parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                         help='best time of N runs is reported')
+hyph_parser.add_argument('--dict', metavar='FILE', default=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'resources', 'dictionaries',
+    'hyph_pl_PL.dic'
+), help='hyphenation dictionary (default: %(default)s)')
+hyph_parser.add_argument('--output', metavar='FILE',
+                         help='write results as JSON to FILE')
+startup_parser = subparsers.add_parser(
+    'startup', help='check the startup time of short epubQTools commands'
+)
+startup_parser.add_argument('--repeat', type=int, default=5, metavar='N',
+                            help='best time of N runs is reported')
+startup_parser.add_argument('--max-time', type=float, metavar='SECONDS',
+                            help='fail if a command is slower than SECONDS')
+entities_parser = subparsers.add_parser(
+    'entities', help='replace HTML entities in a generated XHTML chapter'
+)
+entities_parser.add_argument('--size', type=float, default=2, metavar='MB',
+                             help='approximate size of the chapter in MB')
+entities_parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                             help='best time of N runs is reported')
+files_parser = subparsers.add_parser(
+    'files', help='run per-file XPath lookups on many small XHTML files'
+)
+files_parser.add_argument('--files', type=int, default=5000, metavar='N',
+                          help='number of XHTML files')
+files_parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                          help='best time of N runs is reported')
+
+# modules which must not be imported by commands checked by startup
+# benchmark: lxml, cssutils and the hyphenation dictionary take most
+# of the startup time
+HEAVY_MODULES = ('lxml', 'cssutils', 'lib.epubqcheck', 'lib.epubqfix',
+                 'lib.beautify_book', 'lib.fix_name_author')
+# resources of epubqfix loaded on first use: the hyphenator and the ncx2end
+# XSLT, reported by STARTUP_PROBE like modules
+LAZY_RESOURCES = ('lib.epubqfix.hyph', 'lib.epubqfix.ncx2end')
+# runs epubQTools with the given arguments and writes names of imported
+# modules and loaded LAZY_RESOURCES to stderr
+STARTUP_PROBE = '''
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+names = sorted(sys.modules)
+fix = sys.modules.get('lib.epubqfix')
+if fix is not None:
+    if fix.hyph is not None:
+        names.append('lib.epubqfix.hyph')
+    if fix.ncx2end:
+        names.append('lib.epubqfix.ncx2end')
+sys.stderr.write(' '.join(names))
+'''
+
+PAGE = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="pl">
+<head><title>%(nr)d</title>
+<meta name="viewport" content="width=1200, height=1600"/>
+<link href="../Styles/page.css" rel="stylesheet" type="text/css"/></head>
+<body><div class="page"><img src="../Images/page%(nr)04d.jpg" alt=""/>
+<img src="../Images/page%(nr)04d.svg" alt=""/>
+%(text)s</div></body></html>
+'''
+WORDS = (u'przykładowy tekst strony książki w języku polskim która zawiera '
+         u'dość długie wyrazy oraz nieprawdopodobieństwo').split()
+
+
+def make_fixed_layout_epub(path, size_mb):
+    """Write a synthetic fixed-layout EPUB file of about size_mb MB."""
+    rnd = random.Random(size_mb)
+    # XHTML text, SVG vector page and JPEG-like background for every page
+    pages = max(1, size_mb * 1024 * 1024 // (24000 + 160000 + 160000))
+    manifest = []
+    spine = []
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('mimetype', 'application/epub+zip')
+        z.writestr('META-INF/container.xml', (
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:'
+            'names:tc:opendocument:xmlns:container"><rootfiles><rootfile '
+            'full-path="OEBPS/content.opf" media-type="application/oebps-'
+            'package+xml"/></rootfiles></container>'
+        ))
+        z.writestr('OEBPS/Styles/page.css',
+                   '.page { position: absolute; width: 1200px; }')
+        for nr in xrange(pages):
+            text = u''.join(
+                u'<p style="position: absolute; top: %dpx">%s</p>\n' % (
+                    rnd.randint(0, 1600),
+                    u' '.join(rnd.choice(WORDS) for w in xrange(12))
+                ) for p in xrange(150)
+            )
+            z.writestr('OEBPS/Text/page%04d.xhtml' % nr, (
+                PAGE % {'nr': nr, 'text': text}
+            ).encode('utf-8'))
+            z.writestr('OEBPS/Images/page%04d.svg' % nr, (
+                '<svg xmlns="http://www.w3.org/2000/svg" width="1200" '
+                'height="1600"><path d="M0 0 %s"/></svg>' % ' '.join(
+                    'L%d %d' % (rnd.randint(0, 1200), rnd.randint(0, 1600))
+                    for p in xrange(16000)
+                )
+            ))
+            z.writestr('OEBPS/Images/page%04d.jpg' % nr,
+                       '\xff\xd8\xff\xe0' + os.urandom(160000))
+            manifest.append(
+                '<item id="p%(nr)d" href="Text/page%(nr)04d.xhtml" '
+                'media-type="application/xhtml+xml"/>'
+                '<item id="s%(nr)d" href="Images/page%(nr)04d.svg" '
+                'media-type="image/svg+xml"/>'
+                '<item id="j%(nr)d" href="Images/page%(nr)04d.jpg" '
+                'media-type="image/jpeg"/>' % {'nr': nr}
+            )
+            spine.append('<itemref idref="p%d"/>' % nr)
+        z.writestr('OEBPS/content.opf', (
+            '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://'
+            'www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            '<dc:identifier id="id">bench</dc:identifier><dc:title>Bench'
+            '</dc:title><dc:language>pl</dc:language><meta property='
+            '"rendition:layout">pre-paginated</meta></metadata><manifest>'
+            '%s</manifest><spine>%s</spine></package>'
+        ) % (''.join(manifest), ''.join(spine)))
+    return pages
+
+
+def time_pack(source, output, threads, repeat, modify, stored_types=None):
+    best = None
+    for r in xrange(repeat):
+        ws = EpubWorkspace(source)
+        for name in ws.namelist():
+            if modify(name):
+                ws.write(name, ws.read(name))
+        kwargs = {'threads': threads}
+        if stored_types is not None:
+            kwargs['stored_types'] = stored_types
+        start = time.time()
+        ws.pack(output, **kwargs)
+        elapsed = time.time() - start
+        ws.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_pack(ar):
+    tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-bench-')
+    try:
+        source = os.path.join(tempdir, 'fixed-layout.epub')
+        output = os.path.join(tempdir, 'fixed-layout_moh.epub')
+        print('* Generating fixed-layout EPUB file...', end=' ')
+        pages = make_fixed_layout_epub(source, ar.size)
+        print('%d pages, %.1f MB' % (
+            pages, os.path.getsize(source) / 1024.0 / 1024
+        ))
+
+        def is_text(name):
+            return not name.endswith('.jpg')
+
+        cases = [
+            ('all entries deflated again (old pack_epub)', 1,
+             lambda name: True, frozenset()),
+            ('unchanged entries only (raw copy)', 1,
+             lambda name: False, None),
+            ('text entries modified, 1 thread', 1, is_text, None),
+            ('text entries modified, %d threads' % ar.threads, ar.threads,
+             is_text, None),
+        ]
+        results = []
+        for label, threads, modify, stored_types in cases:
+            elapsed = time_pack(source, output, threads, ar.repeat, modify,
+                                stored_types)
+            results.append(elapsed)
+            print('* %-45s %7.3f s' % (label + ':', elapsed))
+        print('* Speedup of %d threads: %.2fx' % (
+            ar.threads, results[2] / results[3]
+        ))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+SYLLABLES = (u'na po za do prze przy wy roz nie od ob u s z ja ko ra ta '
+             u'wa ła ka ma no go ży dzie cie sie rze szcze ście bień stwo '
+             u'ność ski cki ęta ąca ów ami ach ego emu ymi ych ić ać eć '
+             u'krz grz trz chw szcz źdź drż ją mó żó łó').split()
+
+
+def make_corpus(count):
+    """Return count generated Polish-like words, about a third repeated."""
+    rnd = random.Random(count)
+    words = []
+    for i in xrange(count):
+        if words and rnd.random() < 0.33:
+            words.append(rnd.choice(words))
+            continue
+        word = u''.join(rnd.choice(SYLLABLES)
+                        for s in xrange(rnd.randint(1, 6)))
+        if rnd.random() < 0.05:
+            word = word.capitalize()
+        words.append(word)
+    words.extend(WORDS)
+    return words
+
+
+def peak_memory():
+    """Return peak resident memory of the process in kB or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def git_revision():
+    try:
+        return subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def best_time(repeat, func):
+    best = None
+    for r in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_hyph(ar):
+    words = make_corpus(ar.words)
+    results = {
+        'benchmark': 'hyph',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'dictionary': os.path.basename(ar.dict),
+        'words': len(words),
+        'unique_words': len(set(w.lower() for w in words)),
+        'load': {},
+        'cold': {},
+        'warm': {},
+    }
+    tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-bench-')
+    try:
+        with open(ar.dict, 'rb') as f:
+            data = f.read()
+        compiled = os.path.join(tempdir, os.path.basename(ar.dict) + 'c')
+        results['load']['parse'] = best_time(
+            ar.repeat, lambda: Hyph_dict(ar.dict)
+        )
+        results['load']['compile'] = best_time(ar.repeat, lambda: (
+            compile_dict(open(ar.dict), compiled,
+                         hashlib.sha1(data).digest())
+        ))
+        results['load']['mmap'] = best_time(
+            ar.repeat, lambda: Compiled_dict(compiled)
+        )
+        hyph = Hyphenator(compiled)
+        start = time.time()
+        hyph.hd.trie
+        results['load']['trie'] = time.time() - start
+
+        cases = [
+            ('positions', lambda: [hyph.positions(w) for w in words]),
+            ('inserted', lambda: [hyph.inserted(w, u'\u00AD')
+                                  for w in words]),
+            ('iterate', lambda: [list(hyph.iterate(w)) for w in words]),
+        ]
+        for name, func in cases:
+            def cold():
+                hyph.hd.cache = LRU_cache()
+                func()
+            elapsed = best_time(ar.repeat, cold)
+            results['cold'][name] = {'seconds': elapsed,
+                                     'words_per_sec': len(words) / elapsed}
+            # the last cold run filled the cache
+            elapsed = best_time(ar.repeat, func)
+            results['warm'][name] = {'seconds': elapsed,
+                                     'words_per_sec': len(words) / elapsed}
+        cache = hyph.hd.cache
+        results['cache'] = {'size': len(cache), 'hits': cache.hits,
+                            'misses': cache.misses}
+    finally:
+        shutil.rmtree(tempdir)
+    results['peak_memory_kb'] = peak_memory()
+
+    print('* Corpus: %d words, %d unique' % (results['words'],
+                                              results['unique_words']))
+    for name in ('parse', 'compile', 'mmap', 'trie'):
+        print('* %-45s %7.3f s' % ('dictionary ' + name + ':',
+                                   results['load'][name]))
+    for state in ('cold', 'warm'):
+        for name, func in cases:
+            r = results[state][name]
+            print('* %-45s %7.3f s %10.0f words/s' % (
+                '%s (%s cache):' % (name, state), r['seconds'],
+                r['words_per_sec']
+            ))
+    if results['peak_memory_kb'] is not None:
+        print('* Peak memory: %d kB' % results['peak_memory_kb'])
+    if ar.output:
+        with open(ar.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('* Results written to: ' + ar.output)
+
+
+def make_chapter(size_mb, with_entities):
+    """Return XHTML chapter of about size_mb MB of Polish-like text."""
+    rnd = random.Random(size_mb)
+    marks = ['&nbsp;', '&mdash;', '&hellip;', '&bdquo;', '&rdquo;',
+             '&amp;', '&lt;', '&#160;']
+    paras = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        words = [rnd.choice(WORDS).encode('utf-8')
+                 for w in xrange(rnd.randint(20, 120))]
+        if with_entities:
+            for i in xrange(0, len(words), 15):
+                words[i] += rnd.choice(marks)
+        para = '<p>' + ' '.join(words) + '</p>\n'
+        paras.append(para)
+        size += len(para)
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://'
+            'www.w3.org/1999/xhtml"><head><title>Bench</title></head>'
+            '<body>\n' + ''.join(paras) + '</body></html>\n')
+
+
+def bench_entities(ar):
+    def sequential(c):
+        for key in entities.iterkeys():
+            c = c.replace(key, entities[key])
+        return c
+
+    for name, with_entities in (('with entities', True),
+                                ('without entities', False)):
+        chapter = make_chapter(ar.size, with_entities)
+        print('* Chapter %s: %.1f MB' % (
+            name, len(chapter) / 1024.0 / 1024
+        ))
+        if sequential(chapter) != replace_entities(chapter):
+            sys.exit('! CRITICAL! Different results of entity replacing!')
+        for case, func in (('str.replace per entity', sequential),
+                           ('single pass', replace_entities)):
+            print('* %-45s %7.3f s' % (case + ':', best_time(
+                ar.repeat, lambda: func(chapter)
+            )))
+
+
+def make_small_files(count):
+    """Return count parsed XHTML files as small as calibre splits them."""
+    from lxml import etree
+    rnd = random.Random(count)
+    trees = []
+    for nr in xrange(count):
+        text = u''.join(u'<p class="calibre%d">%s</p>' % (
+            rnd.randint(1, 9), u' '.join(rnd.choice(WORDS)
+                                         for w in xrange(20))
+        ) for p in xrange(rnd.randint(2, 6)))
+        trees.append(etree.fromstring((
+            u'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%d'
+            u'</title><link href="../Styles/style.css" rel="stylesheet" '
+            u'type="text/css"/></head><body id="b%d"><div style="display: '
+            u'none" id="a%d"><a href="part%04d.xhtml#a%d">%s</a></div>'
+            u'</body></html>' % (nr, nr, nr, nr + 1, nr + 1, text)
+        ).encode('utf-8')))
+    return trees
+
+
+def bench_files(ar):
+    from lxml import etree
+    from lib import epubqpatterns as pat
+    xhtmlns = {'xhtml': 'http://www.w3.org/1999/xhtml'}
+    # the same lookups as qcheck runs for every XHTML file
+    lookups = [
+        ('//xhtml:body[@id]', pat.XHTML_BODY_WITH_ID),
+        ('//*[starts-with(text(),"===")]', pat.WM_MARKS),
+        ('//xhtml:meta[@charset="utf-8"]', pat.XHTML_META_CHARSET),
+        ('//xhtml:body//text()', pat.XHTML_BODY_TEXTS),
+        ('//processing-instruction("fragment")', pat.FRAGMENT_PIS),
+        ('//xhtml:link', pat.XHTML_LINKS),
+        ('//*[@href or @src]', pat.WITH_URL),
+        ('//*[@style]', pat.WITH_STYLE),
+    ]
+
+    def compiled_per_file():
+        return [len(etree.XPath(path, namespaces=xhtmlns)(tree))
+                for tree in trees for path, compiled in lookups]
+
+    def precompiled():
+        return [len(compiled(tree))
+                for tree in trees for path, compiled in lookups]
+
+    trees = make_small_files(ar.files)
+    print('* XHTML files: %d, lookups per file: %d' % (len(trees),
+                                                        len(lookups)))
+    if compiled_per_file() != precompiled():
+        sys.exit('! CRITICAL! Different results of XPath lookups!')
+    for case, func in (('compiled for every file', compiled_per_file),
+                       ('precompiled', precompiled)):
+        elapsed = best_time(ar.repeat, func)
+        print('* %-45s %7.3f s %7.1f us/file' % (
+            case + ':', elapsed, elapsed * 1000000 / len(trees)
+        ))
+
+
+def startup_modules(package, args):
+    """
+    Return names of modules imported and resources loaded by epubQTools
+    from the package directory run with args.
+    """
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.Popen(
+            [sys.executable, '-c', STARTUP_PROBE, package] + args,
+            stdout=devnull, stderr=subprocess.PIPE
+        ).communicate()[1].split()
+
+
+def bench_startup(ar):
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-bench-')
+    failed = False
+    try:
+        for name, args in (('version', ['-V']),
+                           ('listing', [tempdir, '-i'])):
+            with open(os.devnull, 'w') as devnull:
+                elapsed = best_time(ar.repeat, lambda: subprocess.check_call(
+                    [sys.executable, package] + args, stdout=devnull,
+                    stderr=devnull
+                ))
+            modules = startup_modules(package, args)
+            heavy = [m for m in HEAVY_MODULES + LAZY_RESOURCES
+                     if m in modules]
+            print('* %-45s %7.3f s' % (name + ':', elapsed))
+            if heavy:
+                failed = True
+                print('! ERROR! Heavy modules imported: ' + ', '.join(heavy))
+            if ar.max_time is not None and elapsed > ar.max_time:
+                failed = True
+                print('! ERROR! Slower than %.3f s' % ar.max_time)
+    finally:
+        shutil.rmtree(tempdir)
+    return 1 if failed else 0
+
+
+def epubqbench():
+    ar = parser.parse_args()
+    if ar.command == 'pack':
+        bench_pack(ar)
+    elif ar.command == 'hyph':
+        bench_hyph(ar)
+    elif ar.command == 'entities':
+        bench_entities(ar)
+    elif ar.command == 'files':
+        bench_files(ar)
+    elif ar.command == 'startup':
+        return bench_startup(ar)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(epubqbench())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import errno
+import hashlib
+import json
+import os
+import sqlite3
+
+CACHE_NAME = '.epubQTools-cache.db'
+# directory for data shared by all libraries
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.epubQTools', 'cache')
+HYPHENATION_CACHE = os.path.join(CACHE_DIR, 'hyphenation.db')
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class QfixCache(object):
+    """
+    Sidecar database remembering inputs used to generate _moh.epub files.
+
+    Every record stores the digest of the source EPUB file, the set of
+    qfix options and the tool version. An existing _moh.epub file is up to
+    date only if all of them are still the same. Size and mtime of the
+    source file are stored too, so the digest of an untouched file is not
+    computed again.
+    """
+
+    def __init__(self, directory, version):
+        self.directory = directory
+        self.version = version
+        self.db = sqlite3.connect(os.path.join(directory, CACHE_NAME))
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS qfix ('
+            'source TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+            'digest TEXT, options TEXT, version TEXT)'
+        )
+        self.digests = {}
+
+    def key(self, lf):
+        return os.path.relpath(lf.path, self.directory).replace('\\', '/')
+
+    def record(self, lf):
+        return self.db.execute(
+            'SELECT size, mtime, digest, options, version FROM qfix '
+            'WHERE source = ?', (self.key(lf),)
+        ).fetchone()
+
+    def digest(self, lf, row=None):
+        if lf.path in self.digests:
+            return self.digests[lf.path]
+        if row is not None and row[0] == lf.size and row[1] == lf.mtime:
+            digest = row[2]
+        else:
+            digest = file_digest(lf.path)
+        self.digests[lf.path] = digest
+        return digest
+
+    def is_stale(self, lf, out, options):
+        """
+        Return True if the existing _moh.epub file (out) has to be
+        generated again for the source file lf.
+        """
+        if out is None:
+            return False
+        row = self.record(lf)
+        if row is None:
+            # generated before the cache was used
+            return lf.mtime > out.mtime
+        digest = self.digest(lf, row)
+        if digest == row[2] and (row[0], row[1]) != (lf.size, lf.mtime):
+            # touched but not changed, do not compute the digest next time
+            self.db.execute(
+                'UPDATE qfix SET size = ?, mtime = ? WHERE source = ?',
+                (lf.size, lf.mtime, self.key(lf))
+            )
+            self.db.commit()
+        return (digest != row[2] or
+                row[3] != json.dumps(options) or
+                row[4] != self.version)
+
+    def store(self, lf, options):
+        row = self.record(lf)
+        self.db.execute(
+            'INSERT OR REPLACE INTO qfix VALUES (?, ?, ?, ?, ?, ?)',
+            (self.key(lf), lf.size, lf.mtime, self.digest(lf, row),
+             json.dumps(options), self.version)
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class HyphenationCache(object):
+    """
+    Database of words hyphenated in previous runs.
+
+    Words are stored separately for every dictionary, identified by its
+    digest. Points are all points found by the dictionary, encoded as
+    returned by Hyphenator.take_new_words(), so they do not depend on the
+    left and right settings of the hyphenator.
+
+    The database is connected on first use in every process, worker
+    processes forked after the cache was created use their own connection.
+    The directory of the database is created with the cache, so it exists
+    before worker processes are started.
+    """
+
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest.encode('hex')
+        self.db = None
+        self.pid = None
+        self.make_directory()
+
+    def make_directory(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                # created by another process in the meantime
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def connect(self):
+        if self.db is None or self.pid != os.getpid():
+            self.make_directory()
+            self.db = sqlite3.connect(self.path)
+            self.pid = os.getpid()
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS positions ('
+                'digest TEXT, word TEXT, points TEXT, '
+                'PRIMARY KEY (digest, word))'
+            )
+        return self.db
+
+    def get(self, word):
+        """Return encoded points of the word or None."""
+        row = self.connect().execute(
+            'SELECT points FROM positions WHERE digest = ? AND word = ?',
+            (self.digest, word)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def store(self, words):
+        if not words:
+            return
+        db = self.connect()
+        db.executemany(
+            'INSERT OR REPLACE INTO positions VALUES (?, ?, ?)',
+            ((self.digest, word, points)
+             for word, points in words.iteritems())
+        )
+        db.commit()
+
+    def close(self):
+        if self.db is not None and self.pid == os.getpid():
+            self.db.close()
+        self.db = None
@@ -13,11 +13,15 @@ import sys
 import tempfile
 import shutil
 import logging
+import multiprocessing
 import lib.fntutls
 import StringIO
 import struct
+import traceback
 from urllib import unquote
-from lib.htmlconstants import entities
+from lib.htmlconstants import replace_entities
+from lib import epubqpatterns as pat
+from lib.epubqrefs import ReferenceGraph
 
 SFENC = sys.getfilesystemencoding()
 try:
@@ -28,41 +32,77 @@ except ImportError as e:
 
 try:
     from lxml import etree
-    import cssutils
-    from cssutils.profiles import Profiles, properties, macros
 except ImportError as e:
     sys.exit('! CRITICAL! ' + str(e).decode(SFENC))
 
 # set up recover parser for malformed XML
 recover_parser = etree.XMLParser(encoding='utf-8', recover=True)
 
-# add the most common used non-standard properties for cssutils
-properties[Profiles.CSS_LEVEL_2]['oeb-column-number'] = r'{num}'
-properties[Profiles.CSS_LEVEL_2]['hyphens'] = r'none|manual|auto|all'
-properties[Profiles.CSS_LEVEL_2]['-epub-hyphens'] = r'none|manual|auto|all'
-properties[Profiles.CSS_LEVEL_2]['-webkit-hyphens'] = r'none|manual|auto|all'
-properties[Profiles.CSS_LEVEL_2]['-moz-hyphens'] = r'none|manual|auto|all'
-properties[Profiles.CSS_LEVEL_2]['adobe-hyphenate'] = r'none|explicit|auto'
-cssutils.profile.addProfiles([(
-    Profiles.CSS_LEVEL_2, properties[Profiles.CSS_LEVEL_2],
-    macros[Profiles.CSS_LEVEL_2]
-)])
-
-# set up additional amzn MEDIA_TYPES and handler for cssutils
-cssutils.stylesheets.MediaQuery.MEDIA_TYPES = \
-    cssutils.stylesheets.MediaQuery.MEDIA_TYPES + \
-    ['amzn-mobi', 'amzn-mobi7', 'amzn-kf8']
-streamhandler = logging.StreamHandler()
-
-formatter = logging.Formatter('* CSS %(levelname)s! Problem in '
-                              '"%(name)s": %(message)s')
-streamhandler.setFormatter(formatter)
+# imported by setup_cssutils(), importing cssutils is slow
+cssutils = None
+
+
+class CSSLogHandler(logging.Handler):
+    """
+    Record cssutils messages as qcheck findings of the checked CSS file in
+    the report of the book being checked, or print them outside qcheck.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.report = None
+        self.css_file = ''
+
+    def emit(self, record):
+        message = 'CSS %s! Problem in "%s": %s' % (
+            record.levelname, self.css_file, record.getMessage()
+        )
+        if self.report is None:
+            print('* ' + message)
+        else:
+            self.report.finding(message)
+
+csshandler = CSSLogHandler()
+csslog = logging.getLogger('epubqcheck.css')
+csslog.addHandler(csshandler)
+csslog.propagate = False
+
+
+def setup_cssutils():
+    """Import and set up cssutils on first use and return the module."""
+    global cssutils
+    if cssutils is not None:
+        return cssutils
+    try:
+        import cssutils as module
+        from cssutils.profiles import Profiles, properties, macros
+    except ImportError as e:
+        sys.exit('! CRITICAL! ' + str(e).decode(SFENC))
+
+    # add the most common used non-standard properties for cssutils
+    css2 = properties[Profiles.CSS_LEVEL_2]
+    css2['oeb-column-number'] = r'{num}'
+    css2['hyphens'] = r'none|manual|auto|all'
+    css2['-epub-hyphens'] = r'none|manual|auto|all'
+    css2['-webkit-hyphens'] = r'none|manual|auto|all'
+    css2['-moz-hyphens'] = r'none|manual|auto|all'
+    css2['adobe-hyphenate'] = r'none|explicit|auto'
+    module.profile.addProfiles([(
+        Profiles.CSS_LEVEL_2, css2, macros[Profiles.CSS_LEVEL_2]
+    )])
+
+    # set up additional amzn MEDIA_TYPES and handler for cssutils
+    module.stylesheets.MediaQuery.MEDIA_TYPES = \
+        module.stylesheets.MediaQuery.MEDIA_TYPES + \
+        ['amzn-mobi', 'amzn-mobi7', 'amzn-kf8']
+    module.log.setLog(csslog)
+    cssutils = module
+    return cssutils
+
 
 OPFNS = {'opf': 'http://www.idpf.org/2007/opf'}
-XHTMLNS = {'xhtml': 'http://www.w3.org/1999/xhtml'}
 DCNS = {'dc': 'http://purl.org/dc/elements/1.1/'}
 NCXNS = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
-SVGNS = {'svg': 'http://www.w3.org/2000/svg'}
 CRNS = {'cr': 'urn:oasis:names:tc:opendocument:xmlns:container'}
 
 
@@ -87,20 +127,17 @@ def unquote_urls(tree):
     return tree
 
 
-def check_wm_info(singf, tree, epub, _file_dec):
-    alltexts = etree.XPath('//xhtml:body//text()',
-                           namespaces=XHTMLNS)(tree)
+def check_wm_info(singf, tree, epub, report):
+    alltexts = pat.XHTML_BODY_TEXTS(tree)
     alltext = ' '.join(alltexts)
     alltext = alltext.replace(u'\u00AD', '').strip()
     if (alltext == 'Plik jest zabezpieczony znakiem wodnym' or
             'Ten ebook jest chroniony znakiem wodnym' in alltext):
-        print('%sWM info file found "%s"' % (_file_dec, singf))
+        report.finding('WM info file found "%s"' % singf)
 
 
-def check_display_none(singf, tree, epub, _file_dec, cont_src_list):
-    styles = etree.XPath('//*[@style]',
-                         namespaces=XHTMLNS)(tree)
-    for s in styles:
+def check_display_none(singf, tree, epub, report, cont_src_list):
+    for s in pat.WITH_STYLE(tree):
         if (
             (
                 ('display: none' in s.get('style')) or
@@ -108,44 +145,43 @@ def check_display_none(singf, tree, epub, _file_dec, cont_src_list):
             ) and (os.path.basename(
                    singf) + '#' + str(s.get('id'))) in cont_src_list
         ):
-            print('%sElement with problematic (for kindlegen) '
-                  'display:none style found in file "%s"'
-                  % (_file_dec, singf))
+            report.finding('Element with problematic (for kindlegen) '
+                           'display:none style found in file "%s"'
+                           % singf)
 
 
-def check_dl_in_html_toc(tree, dir, epub, _file_dec):
+def check_dl_in_html_toc(tree, dir, epub, report):
     try:
         html_toc_path = os.path.relpath(os.path.join(
             dir,
-            tree.xpath('//opf:reference[@type="toc"]',
-                       namespaces=OPFNS)[0].get('href')
+            pat.OPF_REFERENCE_BY_TYPE(tree, type='toc')[0].get('href')
         )).replace('\\', '/')
         raw = epub.read(html_toc_path)
         if '<dl>' in raw:
-            print(_file_dec + 'Problematic DL tag in HTML TOC found...')
+            report.finding('Problematic DL tag in HTML TOC found...')
     except:
         pass
 
 
-def check_meta_html_covers(tree, dir, epub, _file_dec):
+def check_meta_html_covers(tree, dir, epub, report):
     try:
-        html_cover_path = etree.XPath('//opf:reference[@type="cover"]',
-                                      namespaces=OPFNS)(tree)[0].get('href')
+        html_cover_path = pat.OPF_REFERENCE_BY_TYPE(
+            tree, type='cover'
+        )[0].get('href')
     except:
         return 0
     try:
         meta_cover_id = etree.XPath('//opf:meta[@name="cover"]',
                                     namespaces=OPFNS)(tree)[0].get('content')
     except:
-        print(_file_dec + 'Meta cover image is NOT defined.')
+        report.finding('Meta cover image is NOT defined.')
         return 0
     try:
-        meta_cover_path = etree.XPath(
-            '//opf:item[@id="' + meta_cover_id + '"]',
-            namespaces=OPFNS
-        )(tree)[0].get('href')
+        meta_cover_path = pat.OPF_ITEM_BY_ID(
+            tree, id=meta_cover_id
+        )[0].get('href')
     except IndexError:
-        print(_file_dec + 'Meta cover is NOT properly defined.')
+        report.finding('Meta cover is NOT properly defined.')
         return 0
     parser = etree.XMLParser(recover=True)
     try:
@@ -156,31 +192,28 @@ def check_meta_html_covers(tree, dir, epub, _file_dec):
             parser
         )
     except KeyError, e:
-        print(_file_dec + 'Problem with parsing HTML cover: ' + str(
+        report.finding('Problem with parsing HTML cover: ' + str(
             e).decode(SFENC))
         html_cover_tree = None
         pass
     try:
-        cover_texts = etree.XPath(
-            '//xhtml:body//text()',
-            namespaces=XHTMLNS
-        )(html_cover_tree)
+        cover_texts = pat.XHTML_BODY_TEXTS(html_cover_tree)
         cover_texts = ' '.join(cover_texts)
         if u'\xa0' in cover_texts:
-            print(_file_dec + 'HTML cover should not contain any text...')
+            report.finding('HTML cover should not contain any text...')
         else:
             cover_texts = cover_texts.strip()
             if cover_texts != '':
-                print(_file_dec + 'HTML cover should not contain any text...')
+                report.finding('HTML cover should not contain any text...')
     except:
         pass
     if html_cover_tree is None:
-        print(_file_dec + 'Error loading HTML cover... '
-              'Probably not a html file...')
+        report.finding('Error loading HTML cover... '
+                       'Probably not a html file...')
         return 0
-    allimgs = etree.XPath('//xhtml:img', namespaces=XHTMLNS)(html_cover_tree)
+    allimgs = pat.XHTML_IMGS(html_cover_tree)
     if len(allimgs) > 1:
-        print(_file_dec + 'HTML cover should have only one image...')
+        report.finding('HTML cover should have only one image...')
     for img in allimgs:
         if (
                 len(allimgs) == 1 and
@@ -188,10 +221,10 @@ def check_meta_html_covers(tree, dir, epub, _file_dec):
                     meta_cover_path.split('/')[-1]
                 )
         ) == -1:
-            print(_file_dec + 'Meta cover and HTML cover mismatched.')
-    allsvgimgs = etree.XPath('//svg:image', namespaces=SVGNS)(html_cover_tree)
+            report.finding('Meta cover and HTML cover mismatched.')
+    allsvgimgs = pat.SVG_IMAGES(html_cover_tree)
     if len(allsvgimgs) > 1:
-        print(_file_dec + 'HTML cover should have only one image...')
+        report.finding('HTML cover should have only one image...')
     for svgimg in allsvgimgs:
         if (
                 len(allsvgimgs) == 1 and
@@ -199,10 +232,10 @@ def check_meta_html_covers(tree, dir, epub, _file_dec):
                     '{http://www.w3.org/1999/xlink}href'
                 ).split('/')[-1].find(meta_cover_path.split('/')[-1]) == -1
         ):
-            print(_file_dec + 'Meta cover and HTML cover mismatched.')
+            report.finding('Meta cover and HTML cover mismatched.')
 
 
-def find_cover_image(_opftree, _file_dec):
+def find_cover_image(_opftree, report):
     images = etree.XPath('//opf:item[@media-type="image/jpeg"]',
                          namespaces=OPFNS)(_opftree)
     cover_found = 0
@@ -212,22 +245,22 @@ def find_cover_image(_opftree, _file_dec):
             if (img_href_lower.find('cover') != -1 or
                     img_href_lower.find('okladka') != -1):
                 cover_found = 1
-                print(_file_dec + 'Candidate image for cover found:' +
-                      ' href=' + imag.get('href') +
-                      ' id=' + imag.get('id'))
+                report.finding('Candidate image for cover found:' +
+                               ' href=' + imag.get('href') +
+                               ' id=' + imag.get('id'))
                 break
         if cover_found == 0:
-            print(_file_dec + 'No candidate cover images found. '
-                  'Check a list of all images:')
+            report.finding('No candidate cover images found. '
+                           'Check a list of all images:')
             for imag in images:
-                print(imag.get('href'))
+                report.detail(imag.get('href'))
     else:
-        print(_file_dec + 'No images in an entire book found...')
+        report.finding('No images in an entire book found...')
 
 
-def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
+def qcheck_opf_file(opf_root, opf_path, _epubfile, report, alter, graph):
 
-    def check_orphan_files(epub, opftree, root, _file_dec):
+    def check_orphan_files(epub, opftree, graph, report):
         def is_exluded(name):
             excludes = ['mimetype',
                         'META-INF/container.xml',
@@ -240,32 +273,16 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
                     return True
             return False
 
-        nlist = []
         enc_found = False
         for n in epub.namelist():
             if 'META-INF/encryption.xml' in n:
                 enc_found = True
-            if not isinstance(n, unicode):
-                n = n.decode('utf-8')
+
+        graph.add_document(opf_path, opftree)
+        for n in graph.orphans(opf_path):
             if not is_exluded(n):
-                nlist.append(os.path.relpath(n))
-
-        hlist = []
-        for i in opftree.xpath('//*[@href]'):
-            h = i.get('href')
-            if not isinstance(h, unicode):
-                h = h.decode('utf-8')
-            hlist.append(os.path.relpath(os.path.join(root, h)))
-
-        for n in nlist:
-            found = False
-            for h in hlist:
-                if n == h:
-                    found = True
-                    break
-            if not found:
-                print('%sORPHAN file "%s" is NOT defined in OPF file'
-                      % (_file_dec, n.encode('utf-8')))
+                report.finding('ORPHAN file "%s" is NOT defined in OPF file'
+                               % n.encode('utf-8'))
         return enc_found
 
     def check_dupl_ids_insensitive(tree):
@@ -279,8 +296,8 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
             else:
                 dupl.append(x)
         if len(dupl) > 0:
-            print('%sDuplicated problematic case-insensitive '
-                  'ids: %s found in <spine>' % (_file_dec, dupl))
+            report.finding('Duplicated problematic case-insensitive '
+                           'ids: %s found in <spine>' % dupl)
 
     def check_mime_types(tree):
         items = tree.xpath('//opf:item[@href]', namespaces=OPFNS)
@@ -291,23 +308,26 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
                      i.get('href').lower().endswith('.ttf')) and
                     i.get('media-type') != 'application/vnd.ms-opentype'
             ):
-                print('%sFont file "%s" has incorrect media-type "%s".' % (
-                    _file_dec, i.get('href'), i.get('media-type')
-                ))
+                report.finding(
+                    'Font file "%s" has incorrect media-type "%s".' % (
+                        i.get('href'), i.get('media-type')
+                    )
+                )
             elif i.get('href').lower().endswith('.ttc'):
-                print('%sFont file "%s" has problematic format "TTC".' % (
-                    _file_dec, i.get('href'))
+                report.finding(
+                    'Font file "%s" has problematic format "TTC".' %
+                    i.get('href')
                 )
             elif i.get('media-type') == 'text/html':
-                print('%sA file "%s" has incorrect media-type "%s".' % (
-                    _file_dec, i.get('href'), i.get('media-type')
+                report.finding('A file "%s" has incorrect media-type "%s".' % (
+                    i.get('href'), i.get('media-type')
                 ))
             if (i.get('href').lower().endswith('.xml') and
                     i.get('media-type') == 'application/xhtml+xml'):
-                print(
-                    '%sA file "%s" has incorrect extension ".xml" '
+                report.finding(
+                    'A file "%s" has incorrect extension ".xml" '
                     'for specified media-type "%s".' % (
-                        _file_dec, i.get('href'), i.get('media-type')
+                        i.get('href'), i.get('media-type')
                     )
                 )
     if opf_root == '':
@@ -317,9 +337,9 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
     try:
         opftree = etree.fromstring(_epubfile.read(opf_path))
     except etree.XMLSyntaxError, e:
-        print('%sCRITICAL! XML file "%s" is not well '
-              'formed: "%s"' % (_file_dec, os.path.basename(opf_path),
-                                str(e).decode(SFENC)))
+        report.finding('CRITICAL! XML file "%s" is not well '
+                       'formed: "%s"' % (os.path.basename(opf_path),
+                                         str(e).decode(SFENC)))
         opfstring = StringIO.StringIO(_epubfile.read(opf_path))
         try:
             opftree = etree.parse(opfstring, recover_parser)
@@ -330,63 +350,63 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
         book_ver = opftree.xpath('//opf:package',
                                  namespaces=OPFNS)[0].get('version')
         if not alter and book_ver != '2.0':
-            print(_file_dec + 'Info: EPUB version: ' + book_ver)
+            report.finding('Info: EPUB version: ' + book_ver)
     except:
-        print(_file_dec + 'CRITICAL! No EPUB version info...')
-    enc_found = check_orphan_files(_epubfile, opftree, _folder, _file_dec)
+        report.finding('CRITICAL! No EPUB version info...')
+    enc_found = check_orphan_files(_epubfile, opftree, graph, report)
     if opftree.xpath('//opf:metadata', namespaces=OPFNS) is None:
-        print(_file_dec + 'CRITICAL! No metadata defined in OPF file...')
+        report.finding('CRITICAL! No metadata defined in OPF file...')
     creators = opftree.xpath('//dc:creator', namespaces=DCNS)
     if creators is None:
-        print(_file_dec + 'CRITICAL! dc:creator (book author) element is NOT '
-              'defined in OPF file...')
+        report.finding('CRITICAL! dc:creator (book author) element is NOT '
+                       'defined in OPF file...')
     else:
         for c in creators:
             if c.text is None or c.text.strip() == '':
-                print(_file_dec + 'CRITICAL! dc:creator (book author) is '
-                      'empty...')
+                report.finding('CRITICAL! dc:creator (book author) is '
+                               'empty...')
             elif '\n' in c.text or '\r' in c.text:
-                print(_file_dec + 'CRITICAL! dc:creator (book author) contains'
-                      ' problematic marks "\r" or "\n"...')
+                report.finding('CRITICAL! dc:creator (book author) contains'
+                               ' problematic marks "\r" or "\n"...')
             elif c.text is not None:
                 if c.text.isupper():
-                    print(_file_dec + 'dc:creator (book author) UPPERCASED: '
-                          '"%s". Consider changing...' % c.text)
+                    report.finding('dc:creator (book author) UPPERCASED: '
+                                   '"%s". Consider changing...' % c.text)
     titles = opftree.xpath('//dc:title', namespaces=DCNS)
     if len(titles) == 0:
-        print(_file_dec + 'CRITICAL! dc:title (book title) element is NOT '
-              'defined in OPF file...')
+        report.finding('CRITICAL! dc:title (book title) element is NOT '
+                       'defined in OPF file...')
     else:
         if len(titles) > 1:
-            print(_file_dec + 'Warning! Multiple dc:title (book title) '
-                  'elements defined in OPF file may be problematic...')
+            report.finding('Warning! Multiple dc:title (book title) elements '
+                           'defined in OPF file may be problematic...')
         for t in titles:
             if t.text is None or t.text.strip() == '':
-                print(_file_dec + 'CRITICAL! dc:title (book title) is '
-                      'empty...')
+                report.finding('CRITICAL! dc:title (book title) is '
+                               'empty...')
             elif '\n' in t.text or '\r' in t.text:
-                print(_file_dec + 'CRITICAL! dc:title (book title) contains'
-                      ' problematic marks "\r" or "\n"...')
+                report.finding('CRITICAL! dc:title (book title) contains'
+                               ' problematic marks "\r" or "\n"...')
             elif t.text is not None:
                 if t.text.isupper():
-                    print(_file_dec + 'dc:title (book title) UPPERCASED: '
-                          '"%s". Consider changing...' % titles[0].text)
+                    report.finding('dc:title (book title) UPPERCASED: "%s". '
+                                   'Consider changing...' % titles[0].text)
     language_tags = etree.XPath('//dc:language/text()',
                                 namespaces=DCNS)(opftree)
     if len(language_tags) == 0:
-        print(_file_dec + 'No dc:language defined')
+        report.finding('No dc:language defined')
     else:
         if len(language_tags) > 1:
-            print(_file_dec + 'Multiple dc:language tags')
+            report.finding('Multiple dc:language tags')
         for _lang in language_tags:
             if _lang != 'pl':
-                print(_file_dec + 'Problem with '
-                      'dc:language. Current value: ' + _lang)
+                report.finding('Problem with '
+                               'dc:language. Current value: ' + _lang)
 
     _metacovers = etree.XPath('//opf:meta[@name="cover"]',
                               namespaces=OPFNS)(opftree)
     if len(_metacovers) > 1:
-        print(_file_dec + 'Multiple meta cover images defined.')
+        report.finding('Multiple meta cover images defined.')
 
     _references = etree.XPath('//opf:reference', namespaces=OPFNS)(opftree)
     _refcovcount = _reftoccount = _reftextcount = 0
@@ -399,26 +419,26 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
             _reftextcount += 1
 
     if _refcovcount == 0:
-        print(_file_dec + 'HTML cover is NOT defined.')
+        report.finding('HTML cover is NOT defined.')
     if _refcovcount > 1:
-        print(_file_dec + 'Multiple HTML covers defined.')
+        report.finding('Multiple HTML covers defined.')
 
     if _reftoccount == 0:
-        print(_file_dec + 'HTML TOC is NOT defined.')
+        report.finding('HTML TOC is NOT defined.')
     elif _reftoccount > 1:
-        print(_file_dec + 'Multiple HTML TOCs defined.')
+        report.finding('Multiple HTML TOCs defined.')
 
     if _reftextcount == 0:
-        pass  # print(_file_dec + 'No text guide element defined.')
+        pass  # report.finding('No text guide element defined.')
     elif _reftextcount > 1:
-        print(_file_dec + 'Multiple text guide elements defined.')
+        report.finding('Multiple text guide elements defined.')
 
     if len(_metacovers) == 0 and _refcovcount == 0:
-        find_cover_image(opftree, _file_dec)
+        find_cover_image(opftree, report)
     else:
-        check_meta_html_covers(opftree, _folder, _epubfile, _file_dec)
+        check_meta_html_covers(opftree, _folder, _epubfile, report)
 
-    check_dl_in_html_toc(opftree, _folder, _epubfile, _file_dec)
+    check_dl_in_html_toc(opftree, _folder, _epubfile, report)
 
     _htmlfiletags = etree.XPath(
         '//opf:item[@media-type="application/xhtml+xml"]', namespaces=OPFNS
@@ -432,29 +452,27 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
             html_str = _epubfile.read(os.path.relpath(os.path.join(
                 _folder, _htmlfilepath
             )).replace('\\', '/'))
-            for key in entities.iterkeys():
-                html_str = html_str.replace(key, entities[key])
+            html_str = replace_entities(html_str)
             if is_tidy:
                 document, errors = tidy_document(html_str)
                 if errors != '':
-                    print(_file_dec + 'HTML Tidy problems '
-                          'for: ' + _htmlfilepath)
+                    report.finding('HTML Tidy problems '
+                                   'for: ' + _htmlfilepath)
                     for i in errors.split('\n'):
                         if i != '':
-                            print('  ' + i)
+                            report.detail('  ' + i)
             _xhtmlsoup = etree.fromstring(html_str, parser)
         except (KeyError, zipfile.BadZipfile) as e:
-            print(_file_dec + 'Problem with a file: ' + str(e).decode(SFENC))
+            report.finding('Problem with a file: ' + str(e).decode(SFENC))
             continue
         except etree.XMLSyntaxError, e:
-            print(_file_dec + 'XML file: ' + _htmlfilepath +
-                  ' not well formed: "' + str(e).decode(SFENC) + '"')
+            report.finding('XML file: ' + _htmlfilepath +
+                           ' not well formed: "' + str(e).decode(SFENC) + '"')
             continue
 
         # build list with body tags with id attributes
         try:
-            body_id = etree.XPath('//xhtml:body[@id]',
-                                  namespaces=XHTMLNS)(_xhtmlsoup)[0]
+            body_id = pat.XHTML_BODY_WITH_ID(_xhtmlsoup)[0]
         except IndexError:
             body_id = None
         if body_id is not None:
@@ -463,45 +481,40 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
             ) + '#' + body_id.get('id'))
 
         if _wmfound is False:
-            _watermarks = etree.XPath('//*[starts-with(text(),"===")]',
-                                      namespaces=XHTMLNS)(_xhtmlsoup)
+            _watermarks = pat.WM_MARKS(_xhtmlsoup)
             if len(_watermarks) > 0:
-                print(_file_dec + 'Potential problematic WM found ("===")...')
+                report.finding('Potential problematic WM found ("===")...')
                 _wmfound = True
 
         if metcharfound is False:
-            _metacharsets = etree.XPath('//xhtml:meta[@charset="utf-8"]',
-                                        namespaces=XHTMLNS)(_xhtmlsoup)
+            _metacharsets = pat.XHTML_META_CHARSET(_xhtmlsoup)
             if len(_metacharsets) > 0:
-                print(_file_dec + 'At least one xhtml file hase problematic'
-                      ' <meta charset="utf-8" /> defined...')
+                report.finding('At least one xhtml file hase problematic'
+                               ' <meta charset="utf-8" /> defined...')
                 metcharfound = True
 
-        _alltexts = etree.XPath('//xhtml:body//text()',
-                                namespaces=XHTMLNS)(_xhtmlsoup)
+        _alltexts = pat.XHTML_BODY_TEXTS(_xhtmlsoup)
         _alltext = ' '.join(_alltexts)
 
         if _reftoccount == 0 and _alltext.find(u'Spis treści') != -1:
-                print(_file_dec + 'Html TOC candidate found: ' +
-                      _htmlfilepath)
+                report.finding('Html TOC candidate found: ' +
+                               _htmlfilepath)
         check_hyphs = False
         if check_hyphs:
             if not _ufound and _alltext.find(u'\u00AD') != -1:
-                print(_file_dec + 'U+00AD hyphenate marks found.')
+                report.finding('U+00AD hyphenate marks found.')
                 _ufound = True
             if not _unbfound and _alltext.find(u'\u00A0') != -1:
-                print(_file_dec + 'U+00A0 non-breaking space found.')
+                report.finding('U+00A0 non-breaking space found.')
                 _unbfound = True
-        p_is = etree.XPath('//processing-instruction("fragment")')(_xhtmlsoup)
-        for p in p_is:
-            print(_file_dec + 'Useless ' + etree.tostring(p) + ' processing '
-                  'instruction found...')
-        _links = etree.XPath('//xhtml:link', namespaces=XHTMLNS)(_xhtmlsoup)
-        for _link in _links:
+        for p in pat.FRAGMENT_PIS(_xhtmlsoup):
+            report.finding('Useless ' + etree.tostring(p) + ' processing '
+                           'instruction found...')
+        for _link in pat.XHTML_LINKS(_xhtmlsoup):
             if not _linkfound and (_link.get('type') is None):
                 _linkfound = True
-                print(_file_dec + 'At least one xhtml file has link tag '
-                      'without type attribute defined')
+                report.finding('At least one xhtml file has link tag '
+                               'without type attribute defined')
 
     # Check dtb:uid - should be identical go dc:identifier
     try:
@@ -512,42 +525,38 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
         ncxstr = _epubfile.read(os.path.relpath(os.path.join(_folder,
                                 ncxfile)).replace('\\', '/'))
     except (IndexError, KeyError):
-        print('%sCRITICAL! NCX file is missing...' % (_file_dec))
+        report.finding('CRITICAL! NCX file is missing...')
         ncxstr = '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" />'
     try:
         ncxtree = etree.fromstring(ncxstr)
     except etree.XMLSyntaxError, e:
-        print('%sCRITICAL! XML file "%s" is not well '
-              'formed: "%s"' % (_file_dec, ncxfile, str(e).decode(SFENC)))
+        report.finding('CRITICAL! XML file "%s" is not well '
+                       'formed: "%s"' % (ncxfile, str(e).decode(SFENC)))
         ncxtree = etree.parse(StringIO.StringIO(ncxstr), recover_parser)
-    contents = etree.XPath('//ncx:content[@src]', namespaces=NCXNS)(ncxtree)
+    contents = pat.NCX_CONTENTS_WITH_SRC(ncxtree)
     cont_src_list = []
     for c in contents:
         cont_src_list.append(c.get('src').split('/')[-1])
     try:
-        uniqid = etree.XPath(
-            '//opf:package',
-            namespaces=OPFNS)(opftree)[0].get('unique-identifier')
+        uniqid = pat.OPF_PACKAGE(opftree)[0].get('unique-identifier')
     except IndexError:
         uniqid = None
     if uniqid is not None:
         try:
-            dc_identifier = etree.XPath('//dc:identifier[@id="' + uniqid +
-                                        '"]/text()',
-                                        namespaces=DCNS)(opftree)[0]
+            dc_identifier = pat.DC_IDENTIFIER_TEXT(opftree, id=uniqid)[0]
         except:
             dc_identifier = ''
-            print(_file_dec + 'dc:identifier with unique-id not found')
+            report.finding('dc:identifier with unique-id not found')
     else:
         dc_identifier = ''
-        print(_file_dec + 'no unique-identifier found')
+        report.finding('no unique-identifier found')
     try:
         metadtb = etree.XPath('//ncx:meta[@name="dtb:uid"]',
                               namespaces=NCXNS)(ncxtree)[0]
         if metadtb.get('content') != dc_identifier:
-            print(_file_dec + 'dtb:uid and dc:identifier mismatched')
+            report.finding('dtb:uid and dc:identifier mismatched')
     except IndexError:
-        print(_file_dec + 'dtb:uid not properly defined')
+        report.finding('dtb:uid not properly defined')
 
     # Check for duplicated content attribute of navPoints in NCX file
     srcs = etree.XPath('//ncx:content/@src',
@@ -562,26 +571,26 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
 
         # check if NCX item links to body with id (kindlegen reports error)
         if x.split('/')[-1] in body_id_list:
-            print('* Problem: NCX item links to body with id: ' + x)
+            report.finding('Problem: NCX item links to body with id: ' + x)
 
     if len(dupl) > 0:
-        print('%sDuplicated content attributes of navPoints: '
-              '%s found in NCX file' % (_file_dec, dupl))
+        report.finding('Duplicated content attributes of navPoints: '
+                       '%s found in NCX file' % dupl)
 
     for meta in opftree.xpath("//opf:meta[starts-with(@name, 'calibre')]",
                               namespaces=OPFNS):
-        print(_file_dec + 'calibre staff found')
+        report.finding('calibre staff found')
         break
     for meta in opftree.xpath("//opf:meta[@name='Sigil version']",
                               namespaces=OPFNS):
-        print(_file_dec + 'Sigil version info found')
+        report.finding('Sigil version info found')
         break
     for dcid in opftree.xpath(
         "//dc:identifier[@opf:scheme='calibre']",
         namespaces={'dc': 'http://purl.org/dc/elements/1.1/',
                     'opf': 'http://www.idpf.org/2007/opf'}
     ):
-        print(_file_dec + 'other calibre staff found')
+        report.finding('other calibre staff found')
         break
 
     check_dupl_ids_insensitive(opftree)
@@ -590,7 +599,7 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
     # check for empty tours element
     for i in opftree.xpath('//opf:tours', namespaces=OPFNS):
         if len(list(i)) == 0:
-            print(_file_dec + 'Obsolete empty <tours> element found')
+            report.finding('Obsolete empty <tours> element found')
 
     if enc_found:
         uid = None
@@ -604,17 +613,24 @@ def qcheck_opf_file(opf_root, opf_path, _epubfile, _file_dec, alter):
                     uid = dcid.text
                     break
         if uid is None:
-            print(_file_dec + 'UUID identifier in content.opf missing')
+            report.finding('UUID identifier in content.opf missing')
     return cont_src_list
 
 
-def find_opf(epub):
+def find_opf(epub, report=None):
+
+    def critical(message):
+        if report is None:
+            print('* ' + message)
+        else:
+            report.finding(message)
+
     if epub.namelist()[0] != 'mimetype':
-        print('* CRITICAL! mimetype file is missing or '
-              'is not the first file in the archive.')
+        critical('CRITICAL! mimetype file is missing or '
+                 'is not the first file in the archive.')
     elif epub.read('mimetype') != 'application/epub+zip':
-        print('* CRITICAL! mimetype file has defined incorrect '
-              'MIME type: ' + epub.read('mimetype'))
+        critical('CRITICAL! mimetype file has defined incorrect '
+                 'MIME type: ' + epub.read('mimetype'))
     try:
         cr_tree = etree.fromstring(epub.read('META-INF/container.xml'))
         opf_path = cr_tree.xpath('//cr:rootfile',
@@ -623,62 +639,22 @@ def find_opf(epub):
         # try to find OPF file other way
         for i in epub.namelist():
             if i.endswith('.opf'):
-                print('* CRITICAL! META-INF/container.xml '
-                      'is missing or is broken.')
+                critical('CRITICAL! META-INF/container.xml '
+                         'is missing or is broken.')
                 return os.path.dirname(i), i
-        print('* CRITICAL! Parsing container.xml failed!'
-              'Probably broken EPUB file...')
+        critical('CRITICAL! Parsing container.xml failed!'
+                 'Probably broken EPUB file...')
         return None, None
     return os.path.dirname(opf_path), opf_path
 
 
-def check_urls_in_css(singf, epub, prepnl, _file_dec):
-    with epub.open(singf) as f:
-        cl = re.sub(r'\/\*[^*]*\*+([^/*][^*]*\*+)*\/',
-                    '', f.read()).splitlines()
-        for line in cl:
-            m = re.match(r'.+?url\([ ]?(\"|\')?(.+?)(\"|\')?[ ]?\)', line)
-            if m is not None:
-                check_url(unquote(m.group(2)), singf, prepnl, _file_dec)
-
-
-def check_urls(singf, tree, prepnl, _file_dec):
-    exclude_urls = ('http://', 'https://', 'mailto:', 'tel:', 'data:', '#')
-    for u in tree.xpath('//*[@href or @src]'):
-        if u.get('src'):
-            url = u.get('src')
-        elif u.get('href'):
-            url = u.get('href')
-        if url.lower().startswith(exclude_urls):
-            continue
-        url = unquote(url)
-        if '#' in url:
-            url = url.split('#')[0]
-        check_url(url, singf, prepnl, _file_dec)
+def check_urls(singf, graph, report):
+    for ref in graph.broken(singf):
+        report.finding('Linked resource "%s" in "%s" does NOT exist'
+                       % (ref.path, singf))
 
 
-def check_url(url, singf, nlist, _file_dec):
-    if not isinstance(url, unicode):
-        url = url.decode('utf-8')
-    try:
-        relp = os.path.relpath(
-            os.path.join("/".join(singf.split("/")[:-1]), url)
-        ).replace('\\', '/')
-    except ValueError:
-        print('%sLinked resource "%s" in "%s" does NOT exist'
-              % (_file_dec, url, singf))
-        return None
-    found_proper_url = False
-    for n in nlist:
-        if n == relp:
-            found_proper_url = True
-            break
-    if not found_proper_url:
-        print('%sLinked resource "%s" in "%s" does NOT exist'
-              % (_file_dec, url, singf))
-
-
-def check_body_font_family(singf, epub, _file_dec, is_body_family,
+def check_body_font_family(singf, epub, report, is_body_family,
                            is_font_face, ff, sfound):
     with epub.open(singf) as f:
         fs = f.read()
@@ -686,8 +662,7 @@ def check_body_font_family(singf, epub, _file_dec, is_body_family,
         for e in lis:
             if 'body' in e or '.calibre' in e:
                 try:
-                    fft = re.search(r'font-family\s*:\s*(.*?)(;|$)',
-                                    e).group(1)
+                    fft = pat.FONT_FAMILY_LINE.search(e).group(1)
                     ff = fft.split(',')[0]
                     is_body_family = True
                     sfound = singf
@@ -708,10 +683,10 @@ def check_body_font_family(singf, epub, _file_dec, is_body_family,
                 elif 'body' in e:
                     continue
                 if re.search(r'font-family\s*:\s*(\"|\')?' + re.escape(ff), e):
-                    print('%sProblematic (same as in body) '
-                          'font-family: "%s" found in at least one other '
-                          'declaration in file: "%s"'
-                          % (_file_dec, ff, singf))
+                    report.finding('Problematic (same as in body) '
+                                   'font-family: "%s" found in at least one '
+                                   'other declaration in file: "%s"'
+                                   % (ff, singf))
     return is_body_family, is_font_face, ff, sfound
 
 
@@ -727,50 +702,40 @@ def list_font_basic_properties(raw_file):
     return font_family, regular, bold, italic
 
 
-def qcheck(root, _file, alter, mod, is_list_fonts):
-    if alter:
-        _file_dec = _file + ': '
-    else:
-        _file_dec = '* '
-    if not alter:
-        print('')
-        print('START qcheck for: ' + _file)
+def qcheck(root, _file, mod, is_list_fonts, report):
+    setup_cssutils()
     try:
         epubfile = zipfile.ZipFile(os.path.join(root, _file))
     except zipfile.BadZipfile, e:
-        print('%sCRITICAL! "%s" is invalid: "%s"' % (
-              _file_dec, _file, str(e).decode(SFENC)))
+        report.finding('CRITICAL! "%s" is invalid: "%s"' % (
+                       _file, str(e).decode(SFENC)))
         return None
-    opf_root, opf_path = find_opf(epubfile)
+    opf_root, opf_path = find_opf(epubfile, report)
     if not opf_path:
-        if not alter:
-            print('FINISH qcheck for: ' + _file)
+        report.is_finished = True
         return None
-    cont_src_list = qcheck_opf_file(opf_root, opf_path, epubfile, _file_dec,
-                                    alter)
-    prepnl = []
-    for n in epubfile.namelist():
-        if not isinstance(n, unicode):
-            n = n.decode('utf-8')
-        prepnl.append(os.path.relpath(n).replace('\\', '/'))
+    # references between files of the book, see lib/epubqrefs.py
+    graph = ReferenceGraph(epubfile.namelist())
+    cont_src_list = qcheck_opf_file(opf_root, opf_path, epubfile, report,
+                                    report.alter, graph)
     is_body_family = is_font_face = False
     ff = sfound = ''
     for singlefile in epubfile.namelist():
         if '../' in singlefile:
-            print(_file_dec + 'CRITICAL! Problematic path found'
-                  ' in ePUB archive: ' + singlefile)
+            report.finding('CRITICAL! Problematic path found'
+                           ' in ePUB archive: ' + singlefile)
         if 'META-INF/encryption.xml' in singlefile:
-            print('%sEncryption.xml file found: "%s" '
-                  % (_file_dec, singlefile))
+            report.finding('Encryption.xml file found: "%s" '
+                           % singlefile)
         elif 'jacket.xhtml' in singlefile.lower():
-            print('%scalibre Jacket file found: %s'
-                  % (_file_dec, singlefile))
+            report.finding('calibre Jacket file found: %s'
+                           % singlefile)
         elif 'calibre_bookmarks.txt' in singlefile.lower():
-            print('%scalibre bookmarks file found: %s'
-                  % (_file_dec, singlefile))
+            report.finding('calibre bookmarks file found: %s'
+                           % singlefile)
         elif 'itunesmetadata.plist' in singlefile.lower():
-            print('%siTunesMetadata file found: %s'
-                  % (_file_dec, singlefile))
+            report.finding('iTunesMetadata file found: %s'
+                           % singlefile)
         elif (
                 singlefile.lower().endswith('.otf') or
                 singlefile.lower().endswith('.ttf')
@@ -779,40 +744,39 @@ def qcheck(root, _file, alter, mod, is_list_fonts):
             try:
                 epubfile.extract(singlefile, temp_font_dir)
             except zipfile.BadZipfile:
-                print(_file_dec + 'Font file: ' + singlefile +
-                      ' is corrupted!')
+                report.finding('Font file: ' + singlefile +
+                               ' is corrupted!')
                 continue
             is_empty = False
             try:
                 if os.path.getsize(
                         os.path.join(temp_font_dir, singlefile)
                 ) == 0:
-                    print('%sERROR! Font file "%s" is EMPTY!'
-                          % (_file_dec, singlefile))
+                    report.finding('ERROR! Font file "%s" is EMPTY!'
+                                   % singlefile)
                     is_empty = True
             except (OSError, IOError) as e:
                     is_empty = True
-                    print('%sERROR! Problem with file "%s": %s'
-                          % (_file_dec, os.path.basename(singlefile),
+                    report.finding('ERROR! Problem with file "%s": %s'
+                                   % (os.path.basename(singlefile),
                              str(e).decode(SFENC)))
             if not is_empty:
                 is_font, signature = check_font(
                     os.path.join(temp_font_dir, singlefile)
                 )
                 if not is_font:
-                    print('%sFont file "%s" is probably encrypted.'
-                          ' Incorrect signature %r.'
-                          % (_file_dec, singlefile, signature))
+                    report.finding('Font file "%s" is probably encrypted.'
+                                   ' Incorrect signature %r.'
+                                   % (singlefile, signature))
                 elif is_list_fonts:
                     with open(os.path.join(temp_font_dir, singlefile),
                               'rb') as f:
                         c = f.read()
                         try:
-                            print(
-                                '%sFont info for %s, Family name: "%s", '
+                            report.finding(
+                                'Font info for %s, Family name: "%s", '
                                 'isRegular: %s, isBold: %s, isItalic: %s' %
                                 (
-                                    _file_dec,
                                     singlefile,
                                     list_font_basic_properties(c)[0],
                                     list_font_basic_properties(c)[1],
@@ -822,44 +786,143 @@ def qcheck(root, _file, alter, mod, is_list_fonts):
                             )
                         except (lib.fntutls.UnsupportedFont,
                                 struct.error) as e:
-                            print(
-                                '%sERROR! Problem with font file "%s": %s' %
-                                (_file_dec, singlefile, e)
+                            report.finding(
+                                'ERROR! Problem with font file "%s": %s' %
+                                (singlefile, e)
                             )
 
             if os.path.isdir(temp_font_dir):
                 shutil.rmtree(temp_font_dir)
         elif singlefile.lower().endswith('.css'):
-            with epubfile.open(singlefile) as f:
-                cssutils.log.setLog(logging.getLogger(singlefile))
-                cssutils.log.addHandler(streamhandler)
-                cssutils.log.setLevel(logging.WARNING)
-                cssutils.parseString(f.read(), validate=True)
-            check_urls_in_css(singlefile, epubfile, prepnl, _file_dec)
+            css = epubfile.read(singlefile)
+            csshandler.report = report
+            csshandler.css_file = singlefile
+            # beautify_book silences cssutils for the whole process
+            level = cssutils.log.getEffectiveLevel()
+            cssutils.log.setLevel(logging.WARNING)
+            try:
+                cssutils.parseString(css, validate=True)
+            finally:
+                cssutils.log.setLevel(level)
+            graph.add_stylesheet(singlefile, css)
+            check_urls(singlefile, graph, report)
             # TODO: not a real problem with file (make separate check for it)
             # is_body_family, is_font_face, ff, sfound\
             #     = check_body_font_family(
-            #         singlefile, epubfile, _file_dec,
+            #         singlefile, epubfile, report,
             #         is_body_family, is_font_face, ff, sfound
             #     )
         else:
             try:
                 c = epubfile.read(singlefile)
-                for key in entities.iterkeys():
-                    c = c.replace(key, entities[key])
+                c = replace_entities(c)
                 sftree = etree.fromstring(c)
             except:
                 sftree = None
             if sftree is not None:
-                check_urls(singlefile, sftree, prepnl, _file_dec)
-                check_wm_info(singlefile, sftree, epubfile, _file_dec)
-                check_display_none(singlefile, sftree, epubfile, _file_dec,
+                graph.add_document(singlefile, sftree)
+                check_urls(singlefile, graph, report)
+                check_wm_info(singlefile, sftree, epubfile, report)
+                check_display_none(singlefile, sftree, epubfile, report,
                                    cont_src_list)
     if is_body_family:
         if not mod:
-            print('%sfont-family for body: "%s" found in "%s"'
-                  % (_file_dec, ff, sfound))
+            report.finding('font-family for body: "%s" found in "%s"'
+                           % (ff, sfound))
     elif is_font_face:
-        print('%sWarning! Potential "stripping font" problem!' % (_file_dec))
-    if not alter:
-        print('FINISH qcheck for: ' + _file)
+        report.finding('Warning! Potential "stripping font" problem!')
+    report.is_finished = True
+
+
+def decode(text):
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+class QcheckReport(object):
+    """
+    Report of qcheck() for a single book.
+
+    Checks record every finding with finding() and lines explaining the
+    last finding (e.g. HTML Tidy messages) with detail(), instead of
+    printing them. So a report of a book checked in a worker process can
+    be printed at once, and it is formatted from these records: a finding
+    per line decorated with "* " between START and FINISH lines or, with
+    -a, with the file name.
+    """
+
+    def __init__(self, _file, alter):
+        self.file = _file
+        self.alter = alter
+        # list of (message, details) tuples
+        self.findings = []
+        self.is_finished = False
+
+    def finding(self, message):
+        self.findings.append((message, []))
+
+    def detail(self, line):
+        self.findings[-1][1].append(line)
+
+    def format(self):
+        """Return chunks of the report to be written to sys.stdout."""
+        chunks = []
+        if self.alter:
+            # one line per finding, every line starts with the file name
+            file_dec = decode(self.file) + u': '
+            for message, details in self.findings:
+                chunks.append(file_dec + decode(message) + u'\n')
+                chunks.extend(file_dec + decode(d) + u'\n' for d in details)
+            return chunks
+        chunks.append('\n')
+        chunks.append('START qcheck for: ' + self.file + '\n')
+        for message, details in self.findings:
+            chunks.append('* ' + message + '\n')
+            chunks.extend(d + '\n' for d in details)
+        if self.is_finished:
+            chunks.append('FINISH qcheck for: ' + self.file + '\n')
+        return chunks
+
+
+def qcheck_report(task):
+    """
+    Run qcheck() for a single book and return its QcheckReport.
+
+    The task is a (root, _file, alter, mod, is_list_fonts) tuple.
+    """
+    root, _file, alter, mod, is_list_fonts = task
+    report = QcheckReport(_file, alter)
+    try:
+        qcheck(root, _file, mod, is_list_fonts, report)
+    except Exception:
+        report.finding('CRITICAL! Unexpected error while checking file '
+                       '"%s":' % _file)
+        for ln in traceback.format_exc().decode(SFENC).splitlines():
+            report.detail(ln)
+    finally:
+        csshandler.report = None
+    return report
+
+
+def qcheck_library(tasks, jobs):
+    """
+    Check many books in a pool of worker processes.
+
+    Reports are yielded in the order of tasks, as produced by
+    qcheck_report().
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield qcheck_report(task)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for report in pool.imap(qcheck_report, tasks):
+            yield report
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+from lib.epubqworkspace import normalize
+
+
+class StylesheetStore(object):
+    """
+    CSS files of a book, each read from the workspace at most once.
+
+    A stylesheet has a text view returned by text() and a cssutils model
+    returned by sheet(), which is parsed lazily from the text. Only one
+    view is changed at a time: set_text() drops the parsed model, and after
+    the model is changed touch() makes the text serialized again from the
+    model when it is needed. So both views are always in sync.
+
+    Changed stylesheets are written back to the workspace once by flush().
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        # name -> text of stylesheets read or set so far
+        self.texts = {}
+        # name -> cssutils model of stylesheets parsed so far
+        self.sheets = {}
+        # names of stylesheets with the model changed after the text
+        self.stale = set()
+        # names of stylesheets changed since they were read or flushed
+        self.dirty = set()
+
+    def text(self, name):
+        name = normalize(name)
+        if name in self.stale:
+            self.stale.remove(name)
+            self.texts[name] = self.sheets[name].cssText
+        if name not in self.texts:
+            self.texts[name] = self.ws.read(name)
+        return self.texts[name]
+
+    def set_text(self, name, text):
+        name = normalize(name)
+        self.texts[name] = text
+        self.sheets.pop(name, None)
+        self.stale.discard(name)
+        self.dirty.add(name)
+
+    def sheet(self, name):
+        """Return the cssutils model, the same one for every call."""
+        name = normalize(name)
+        if name not in self.sheets:
+            from lib.epubqcheck import setup_cssutils
+            self.sheets[name] = setup_cssutils().parseString(
+                self.text(name), validate=True
+            )
+        return self.sheets[name]
+
+    def touch(self, name):
+        """Mark the model of the stylesheet name as modified."""
+        name = normalize(name)
+        if name in self.sheets:
+            self.stale.add(name)
+            self.dirty.add(name)
+
+    def flush(self):
+        """Write all changed stylesheets to the workspace."""
+        for name in sorted(self.dirty):
+            self.ws.write(name, self.text(name))
+        self.dirty.clear()
@@ -7,23 +7,29 @@
 
 from __future__ import print_function
 import hashlib
+import multiprocessing
 import os
 import re
 import tempfile
 import shutil
 import subprocess
 import sys
+import traceback
 import zipfile
 import uuid
-import unicodedata
 import StringIO
 
 from pkgutil import get_data
 from urllib import unquote
 from itertools import cycle
-from lib.htmlconstants import entities
-from lib.hyphenator import Hyphenator
-from lib.beautify_book import beautify_book
+from lib.htmlconstants import replace_entities
+from lib.hyphenator import Hyphenator, LRU_cache, CACHE_SIZE, load_compiled
+from lib.epubqworkspace import EpubWorkspace, open_workspace
+from lib.epubqcache import CACHE_DIR, HyphenationCache
+from lib.epubqcss import StylesheetStore
+from lib.epubqopf import OpfPackage
+from lib import epubqpatterns as pat
+from lib.epubqrefs import ReferenceGraph
 
 try:
     from lxml import etree
@@ -33,24 +39,114 @@ except ImportError as e:
 # set up recover parser for malformed XML
 recover_parser = etree.XMLParser(encoding='utf-8', recover=True)
 
-if not hasattr(sys, 'frozen'):
+
+def load_hyphenator():
+    """
+    Return Hyphenator for the Polish dictionary.
+
+    The dictionary is compiled once next to its source file or, if that
+    directory is not writable, into the cache directory. The compiled file
+    is memory mapped, so it is neither copied nor parsed on startup.
+    """
+    if not hasattr(sys, 'frozen'):
+        dic_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'resources', 'dictionaries')
+        data = get_data('lib', 'resources/dictionaries/hyph_pl_PL.dic')
+    else:
+        dic_dir = os.path.join(os.path.dirname(sys.executable), 'resources',
+                               'dictionaries')
+        with open(os.path.join(dic_dir, 'hyph_pl_PL.dic'), 'rb') as f:
+            data = f.read()
+    compiled = load_compiled('hyph_pl_PL.dic', data, [dic_dir, CACHE_DIR])
+    if compiled is not None:
+        return Hyphenator(compiled)
     dic_tmp_dir = tempfile.mkdtemp(suffix='', prefix='epubQTools-tmp-')
     dic_name = os.path.join(dic_tmp_dir, 'hyph_pl_PL.dic')
     try:
         with open(dic_name, 'wb') as f:
-            data = get_data('lib', 'resources/dictionaries/hyph_pl_PL.dic')
             f.write(data)
-        hyph = Hyphenator(dic_name)
+        return Hyphenator(dic_name)
     finally:
         shutil.rmtree(dic_tmp_dir)
-else:
-    hyph = Hyphenator(os.path.join(
-        os.path.dirname(sys.executable), 'resources',
-        'dictionaries', 'hyph_pl_PL.dic'
-    ))
+
+# loaded by get_hyphenator() when a book is hyphenated for the first time
+hyph = None
+hyph_setup = (CACHE_SIZE, None)
+# XHTML files not hyphenated, because they were hyphenated already, in
+# written books and in the last processed book
+skipped_files = 0
+book_skipped_files = 0
+
+
+def get_hyphenator():
+    """Return Hyphenator for the Polish dictionary, load it on first use."""
+    global hyph
+    if hyph is None:
+        hyph = load_hyphenator()
+        configure_hyphenator()
+    return hyph
+
+
+def hyphenation_cache(path):
+    """Return HyphenationCache for the Polish dictionary."""
+    return HyphenationCache(path, get_hyphenator().hd.digest)
+
+
+def configure_hyphenator():
+    cache_size, words_path = hyph_setup
+    hyph.hd.cache = LRU_cache(cache_size)
+    if hyph.hd.words is not None:
+        hyph.hd.words.close()
+    if words_path is not None:
+        # words missing in the word cache are looked up in the database
+        hyph.hd.words = hyphenation_cache(words_path)
+        hyph.hd.new_words = {}
+    else:
+        hyph.hd.words = hyph.hd.new_words = None
+
+
+def setup_hyphenation(cache_size, words_path=None):
+    """
+    Set the capacity of the word cache of the hyphenator and the database
+    words_path of words hyphenated in previous runs.
+
+    Used as the initializer of worker processes too, so it does nothing
+    if the hyphenator is already set up the same way.
+    """
+    global hyph_setup
+    if hyph_setup == (cache_size, words_path):
+        return
+    hyph_setup = (cache_size, words_path)
+    if hyph is not None:
+        configure_hyphenator()
+
+
+def take_new_words():
+    """Return words hyphenated for the first time since the last call."""
+    if hyph is None:
+        return {}
+    return hyph.take_new_words()
+
+
+def take_skipped_files():
+    """Return the number of already hyphenated files since the last call."""
+    global skipped_files
+    count, skipped_files = skipped_files, 0
+    return count
+
+
 MY_LANGUAGE = 'pl'
 MY_LANGUAGE2 = 'pl-PL'
 HYPHEN_MARK = u'\u00AD'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+# texts in these tags are not hyphenated with --skip-hyphenate-headers
+HEADER_TAGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'title'])
+WORD_SPLIT = re.compile(r'(\w+)', re.UNICODE).split
+SINGLE_CONJUNCTION = re.compile(r'(?<=\s\w)\s+').sub
+SOFT_HYPHENS = ('\xc2\xad', '&shy;', '&#173;', '&#xad;', '&#xAD;')
+# soft hyphens per space in a file hyphenated by a tool, a few soft hyphens
+# put by hand do not count
+HYPHENATED_DENSITY = 0.2
 
 HOME = os.path.expanduser("~")
 DTD = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
@@ -60,7 +156,6 @@ OPFNS = {'opf': 'http://www.idpf.org/2007/opf'}
 XHTMLNS = {'xhtml': 'http://www.w3.org/1999/xhtml'}
 DCNS = {'dc': 'http://purl.org/dc/elements/1.1/'}
 NCXNS = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
-SVGNS = {'svg': 'http://www.w3.org/2000/svg'}
 ADOBE_OBFUSCATION = 'http://ns.adobe.com/pdf/enc#RC'
 IDPF_OBFUSCATION = 'http://www.idpf.org/2008/embedding'
 CRNS = {'cr': 'urn:oasis:names:tc:opendocument:xmlns:container'}
@@ -151,6 +246,7 @@ def rename_files(opf_path, _root, _epubfile, _filename, _file_dec):
                 _file_dec, nfname
             ))
             is_renamed = True
+            new_filename = nfname + '.epub'
             break
         elif not os.path.exists(os.path.join(_root, nfname + ' (' +
                                 str(counter) + ').epub')):
@@ -162,16 +258,17 @@ def rename_files(opf_path, _root, _epubfile, _filename, _file_dec):
                 _file_dec, nfname, str(counter)
             ))
             is_renamed = True
+            new_filename = nfname + ' (' + str(counter) + ').epub'
             break
         else:
             counter += 1
     if not is_renamed:
         print('= Renaming file "%s" is not needed.' % _file_dec)
+        return 0
+    return new_filename
 
 
-def check_font(path):
-    with open(path, 'rb') as f:
-        raw = f.read()
+def check_font(raw):
     signature = raw[:4]
     return (signature in {b'\x00\x01\x00\x00', b'OTTO'}, signature)
 
@@ -183,8 +280,8 @@ def unquote_urls(tree):
         if not isinstance(raw, unicode):
             raw = raw.decode('utf-8')
         return raw
-    for item in tree.xpath('//opf:item', namespaces=OPFNS):
-        item.set('href', get_href(item))
+    for item in tree.items():
+        tree.set(item, 'href', get_href(item))
     for item in tree.xpath('//opf:reference', namespaces=OPFNS):
         item.set('href', get_href(item))
     return tree
@@ -207,10 +304,56 @@ def remove_node(node):
     parent.remove(node)
 
 
+def unwrap(node):
+    """Replace node with its text and children, keep its tail."""
+    parent = node.getparent()
+    index = parent.index(node)
+    children = list(node)
+    if children:
+        text = node.text
+        if node.tail:
+            children[-1].tail = (children[-1].tail or '') + node.tail
+    else:
+        text = (node.text or '') + (node.tail or '')
+    if text:
+        if index == 0:
+            parent.text = (parent.text or '') + text
+        else:
+            parent[index - 1].tail = (parent[index - 1].tail or '') + text
+    node.tail = None
+    parent[index:index + 1] = children
+
+
+def apply_rules(tree, rules):
+    """
+    Walk tree once and apply rules to matching nodes.
+
+    rules are (tag, match, action) tuples. tag '?target' stands for
+    processing instructions with that target, match None matches every
+    node with the tag. Actions are called after the walk, rule after rule
+    in document order, so they may modify the tree.
+    """
+    dispatch = {}
+    for i, (tag, match, action) in enumerate(rules):
+        dispatch.setdefault(tag, []).append((i, match))
+    matched = [[] for rule in rules]
+    for node in tree.iter():
+        tag = node.tag
+        if tag is etree.PI:
+            tag = '?' + node.target
+        for i, match in dispatch.get(tag, ()):
+            if match is None or match(node):
+                matched[i].append(node)
+    for (tag, match, action), nodes in zip(rules, matched):
+        for node in nodes:
+            action(node)
+    return tree
+
+
 # based on calibri work
-def process_encryption(encfile, opftree, fontdir):
+def process_encryption(ws, encfile, opftree, fontdir):
     print('* Font decrypting started...')
-    root = etree.parse(encfile)
+    root = etree.fromstring(ws.read(encfile))
     for em in root.xpath(
             'descendant::*[contains(name(), "EncryptionMethod")]'
     ):
@@ -221,11 +364,11 @@ def process_encryption(encfile, opftree, fontdir):
             'descendant::*[contains(name(), "CipherReference")]'
         )[0]
         uri = cr.get('URI')
-        font_path = os.path.abspath(os.path.join(os.path.dirname(encfile),
-                                    '..', *uri.split('/')))
+        # URIs are relative to the root of the EPUB file
+        font_name = ws.join(os.path.dirname(encfile), '..', uri)
         key = find_encryption_key(opftree, algorithm)
-        if (key and os.path.exists(font_path)):
-            decrypt_font(font_path, key, algorithm, fontdir)
+        if (key and ws.exists(font_name)):
+            decrypt_font(ws, font_name, key, algorithm, fontdir)
     return True
 
 
@@ -266,23 +409,20 @@ def find_encryption_key(opftree, method):
 
 
 # based on calibri work
-def decrypt_font(path, key, method, fontdir):
+def decrypt_font(ws, path, key, method, fontdir):
     global qfixerr
     if method == ADOBE_OBFUSCATION:
         crypt_len = 1024
     elif method == IDPF_OBFUSCATION:
         crypt_len = 1040
-    with open(path, 'rb') as f:
-        raw = f.read()
+    raw = ws.read(path)
     crypt = bytearray(raw[:crypt_len])
     key = cycle(iter(bytearray(key)))
     decrypt = bytes(bytearray(x ^ key.next() for x in crypt))
     print('* Starting decryption of font file "%s"...'
           % os.path.basename(path), end=' ')
-    with open(path, 'wb') as f:
-        f.write(decrypt)
-        f.write(raw[crypt_len:])
-    is_font, signature = check_font(path)
+    ws.write(path, decrypt + raw[crypt_len:])
+    is_font, signature = check_font(ws.read(path))
     if not is_font:
         print('FAILED!')
     else:
@@ -304,12 +444,10 @@ def decrypt_font(path, key, method, fontdir):
         for font_path in font_paths:
             if os.path.exists(os.path.join(font_path,
                               os.path.basename(path))):
-                os.remove(path)
-                shutil.copyfile(
-                    os.path.join(font_path, os.path.basename(path)),
-                    path
-                )
-        is_font, signature = check_font(path)
+                with open(os.path.join(font_path,
+                                       os.path.basename(path)), 'rb') as f:
+                    ws.write(path, f.read())
+        is_font, signature = check_font(ws.read(path))
         if is_font:
             print('OK! Replaced.')
         else:
@@ -317,45 +455,42 @@ def decrypt_font(path, key, method, fontdir):
             print('FAILED! Substitute did NOT found.')
 
 
-def find_and_replace_fonts(opftree, rootepubdir, fontdir):
-    items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(opftree)
-    for item in items:
+def find_and_replace_fonts(opftree, ws, fontdir):
+    for item in opftree.items():
         if (item.get('href').lower().endswith('.otf') or
                 item.get('href').lower().endswith('.ttf')):
-            actual_font_path = os.path.join(rootepubdir, item.get('href'))
-            replace_font(actual_font_path, fontdir)
+            actual_font_path = ws.href_name(item.get('href'))
+            replace_font(ws, actual_font_path, fontdir)
 
 
-def xml2html_extension(opftree, rootepubdir):
+def xml2html_extension(opftree, ws):
     is_xml_ext_fixed = False
-    items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(opftree)
-    for i in items:
+    for i in opftree.items():
         if (i.get('media-type') == 'application/xhtml+xml' and
                 i.get('href').lower().endswith('.xml')):
             is_xml_ext_fixed = True
-            os.rename(
-                os.path.join(rootepubdir, i.get('href')),
-                os.path.join(rootepubdir, i.get('href')[:-4] + '.html')
+            ws.rename(
+                ws.href_name(i.get('href')),
+                ws.href_name(i.get('href')[:-4] + '.html')
             )
-            i.set('href', i.get('href')[:-4] + '.html')
-    items = etree.XPath('//opf:reference[@href]', namespaces=OPFNS)(opftree)
+            opftree.set(i, 'href', i.get('href')[:-4] + '.html')
+    items = opftree.xpath('//opf:reference[@href]', namespaces=OPFNS)
     for i in items:
         url = i.get('href')
         if (
-            not os.path.isfile(os.path.join(rootepubdir, url)) and
-            os.path.isfile(os.path.join(rootepubdir, url[:-4] + '.html')) and
+            not ws.exists(ws.href_name(url)) and
+            ws.exists(ws.href_name(url[:-4] + '.html')) and
             url.lower().endswith('.xml')
         ):
             i.set('href', i.get('href')[:-4] + '.html')
     return opftree, is_xml_ext_fixed
 
 
-def xml2html_fix_references(tree, file_dir, ncx):
+def xml2html_fix_references(tree, ws, file_dir, ncx):
     if ncx:
-        items = etree.XPath('//ncx:content', namespaces=NCXNS)(tree)
+        items = pat.NCX_CONTENTS(tree)
     else:
-        items = etree.XPath('//xhtml:*[@href or @src]',
-                            namespaces=XHTMLNS)(tree)
+        items = pat.XHTML_WITH_URL(tree)
     exclude_urls = ('http://', 'https://', 'mailto:', 'tel:', 'data:', '#')
     for u in items:
         if u.get('src'):
@@ -371,8 +506,8 @@ def xml2html_fix_references(tree, file_dir, ncx):
         else:
             frag_url = ''
         if (
-            not os.path.isfile(os.path.join(file_dir, url)) and
-            os.path.isfile(os.path.join(file_dir, url[:-4] + '.html')) and
+            not ws.exists(ws.join(file_dir, url)) and
+            ws.exists(ws.join(file_dir, url[:-4] + '.html')) and
             url.lower().endswith('.xml')
         ):
             if u.get('src'):
@@ -382,35 +517,19 @@ def xml2html_fix_references(tree, file_dir, ncx):
     return tree
 
 
-def fix_ncx(opftree, rootepubdir):
-    try:
-        toc_ncx_file = etree.XPath(
-            '//opf:item[@media-type="application/x-dtbncx+xml"]',
-            namespaces=OPFNS
-        )(opftree)[0].get('href')
-    except IndexError:
-        return None
-    ncxtree = etree.parse(
-        os.path.join(rootepubdir, toc_ncx_file),
-        parser=etree.XMLParser(recover=True)
-    )
-    ncxtree = xml2html_fix_references(ncxtree, rootepubdir, True)
+def fix_ncx(ncxtree, ws):
+    ncxtree = xml2html_fix_references(ncxtree, ws, ws.opf_dir, True)
 
     # fix incorrect ids set by one publisher
-    navPoints = etree.XPath('//ncx:navPoint', namespaces=NCXNS)(ncxtree)
-    for i in navPoints:
+    for i in pat.NCX_NAVPOINTS(ncxtree):
         chid = i.get('id')
         if chid[0].isdigit():
             chid = 'eqt' + chid
-        i.set('id', re.sub('[^0-9a-zA-Z_.-]+', '', chid))
-
-    # write all NCX changes back to file
-    with open(os.path.join(rootepubdir, toc_ncx_file), 'w') as f:
-        f.write(etree.tostring(ncxtree.getroot(), pretty_print=True,
-                standalone=False, xml_declaration=True, encoding='utf-8'))
+        i.set('id', pat.NCX_INVALID_ID.sub('', chid))
+    return ncxtree
 
 
-def replace_font(actual_font_path, fontdir):
+def replace_font(ws, actual_font_path, fontdir):
     global qfixerr
     if fontdir is None:
         fontdir = ''
@@ -428,11 +547,10 @@ def replace_font(actual_font_path, fontdir):
         if os.path.exists(
                 os.path.join(font_path, os.path.basename(actual_font_path))
         ):
-            os.remove(actual_font_path)
-            shutil.copyfile(
-                os.path.join(font_path, os.path.basename(actual_font_path)),
-                actual_font_path
-            )
+            with open(os.path.join(
+                font_path, os.path.basename(actual_font_path)
+            ), 'rb') as f:
+                ws.write(actual_font_path, f.read())
             font_replaced = True
     if font_replaced:
         print('* Font replaced: ' + os.path.basename(actual_font_path))
@@ -442,199 +560,151 @@ def replace_font(actual_font_path, fontdir):
               % os.path.basename(actual_font_path))
 
 
-def unpack_epub(source_epub):
-    epubzipfile = zipfile.ZipFile(source_epub)
-    tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-tmp-')
-    epubzipfile.extractall(tempdir)
-    try:
-        os.remove(os.path.join(tempdir, 'mimetype'))
-    except OSError:
-        pass
-    for f in epubzipfile.namelist():
-        if '../' in f:
-            orgf = os.path.join(tempdir, f.replace('../', ''))
-            newf = os.path.join(tempdir, os.path.relpath(f))
-            shutil.move(orgf, newf)
-    return tempdir
-
-
-def pack_epub(output_filename, source_dir):
-    with zipfile.ZipFile(output_filename, "w") as z:
-        z.writestr("mimetype", "application/epub+zip")
-    relroot = source_dir
-    with zipfile.ZipFile(output_filename, "a", zipfile.ZIP_DEFLATED) as z:
-        for root, dirs, files in os.walk(source_dir):
-            for f in files:
-                filename = os.path.join(root, f)
-                if os.path.isfile(filename):
-                    arcname = os.path.join(os.path.relpath(root, relroot),
-                                           f)
-                    if sys.platform == 'darwin':
-                        arcname = unicodedata.normalize(
-                            'NFC', unicode(arcname, 'utf-8')
-                        ).encode('utf-8')
-                    z.write(filename, arcname.decode(SFENC))
-
-
-def clean_temp(sourcedir):
-    for p in os.listdir(os.path.join(sourcedir, os.pardir)):
-            if 'epubQTools-tmp-' in p:
-                if os.path.isdir(os.path.join(sourcedir, os.pardir, p)):
-                    try:
-                        shutil.rmtree(os.path.join(sourcedir, os.pardir, p))
-                    except:
-                        if sys.platform == 'win32':
-                            os.system('rmdir /S /Q \"{}\"'.format(
-                                os.path.join(sourcedir, os.pardir, p)
-                            ))
-                        else:
-                            raise
-
-
-def find_roots(tempdir):
+def find_roots(ws):
     global qfixerr
     try:
-        cr_tree = etree.parse(os.path.join(tempdir, 'META-INF',
-                                           'container.xml'))
+        cr_tree = etree.fromstring(ws.read('META-INF/container.xml'))
         opf_path = cr_tree.xpath('//cr:rootfile',
                                  namespaces=CRNS)[0].get('full-path')
     except:
         # try to find OPF file other way and rebuild META-INF/container.xml
-        for r, d, fs in os.walk(tempdir):
-            for f in fs:
-                if f.endswith('.opf'):
-                    reldir = os.path.relpath(r, tempdir)
-                    if reldir == '.':
-                        reldir = ''
-                    cont_file = os.path.join(tempdir, 'META-INF',
-                                             'container.xml')
-                    cr_tree = etree.fromstring(
-                        get_data('lib', 'resources/container.xml')
-                    )
-                    cr_tree.xpath(
-                        '//cr:rootfile',
-                        namespaces=CRNS
-                    )[0].set('full-path', os.path.join(reldir, f))
-                    if not os.path.exists(os.path.dirname(cont_file)):
-                        os.makedirs(os.path.dirname(cont_file))
-                    with open(cont_file, 'w') as c:
-                        c.write(
-                            etree.tostring(
-                                cr_tree,
-                                pretty_print=True,
-                                standalone=False,
-                                xml_declaration=True,
-                                encoding='utf-8'
-                            )
-                        )
-                    return os.path.dirname(f), f, True
+        for f in ws.namelist():
+            if f.endswith('.opf'):
+                cr_tree = etree.fromstring(
+                    get_data('lib', 'resources/container.xml')
+                )
+                cr_tree.xpath(
+                    '//cr:rootfile',
+                    namespaces=CRNS
+                )[0].set('full-path', f)
+                ws.write('META-INF/container.xml', etree.tostring(
+                    cr_tree,
+                    pretty_print=True,
+                    standalone=False,
+                    xml_declaration=True,
+                    encoding='utf-8'
+                ))
+                ws.opf_dir = os.path.dirname(f)
+                return ws.opf_dir, f, True
         print('* Parsing container.xml failed. Not an EPUB file?')
         qfixerr = True
         return None, None, False
-    return os.path.dirname(opf_path), opf_path, False
+    ws.opf_dir = os.path.dirname(ws.join(opf_path))
+    return ws.opf_dir, ws.join(opf_path), False
 
 
-def find_xhtml_files(rootepubdir, opftree):
+def find_xhtml_files(ws, opftree):
     global qfixerr
-    try:
-        xhtml_items = etree.XPath(
-            '//opf:item[@media-type="application/xhtml+xml" or '
-            '@media-type="text/html"]',
-            namespaces=OPFNS
-        )(opftree)
-    except:
-        print('* XHTML files not found...')
-        qfixerr = True
+    xhtml_items = opftree.items('application/xhtml+xml', 'text/html')
     xhtml_files = []
     xhtml_file_paths = []
     for xhtml_item in xhtml_items:
-        xhtml_files.append(os.path.join(rootepubdir, xhtml_item.get('href')))
+        xhtml_files.append(ws.href_name(xhtml_item.get('href')))
         xhtml_file_paths.append(xhtml_item.get('href'))
     return xhtml_files, xhtml_file_paths
 
 
 def hyphenate_and_fix_conjunctions(source_file, hyphen_mark, hyph,
                                    dont_hyph_headers):
+    """
+    Hyphenate texts in Polish and join single letter conjunctions with
+    the next word by a non-breaking space.
+
+    The body is walked once. The inherited xml:lang and the number of open
+    headers are tracked during the walk, every text run is tokenized once
+    and unique words of the whole file are hyphenated together. With hyph
+    None only conjunctions are fixed.
+    """
     # set correct xml:lang attribute for html tag
-
-    def fix_hanging_single_conjunctions_and_place_back(tel, txt):
-        newt = re.sub(r'(?<=\s\w)\s+', u'\u00A0', txt)
-        if tel.is_text:
-            parent.text = newt
-        elif tel.is_tail:
-            parent.tail = newt
-
-    html_tag = source_file.xpath('//xhtml:html', namespaces=XHTMLNS)[0]
+    html_tag = pat.XHTML_HTML(source_file)[0]
     html_tag.attrib['{http://www.w3.org/XML/1998/namespace}lang'] = MY_LANGUAGE
     if 'lang' in html_tag.attrib:
         del html_tag.attrib['lang']
 
-    try:
-        texts = etree.XPath(
-            '//xhtml:body//text()',
-            namespaces=XHTMLNS
-        )(source_file)
-    except:
-        print('* No texts found...')
-    # Tag list used to ignore hyphenation
-    ignore_list = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'title']
-    for t in texts:
-        parent = t.getparent()
-        if dont_hyph_headers:
-            # if parent in ignore_list do not hyphenate
-            try:
-                if (parent.tag.replace('{http://www.w3.org/1999/xhtml}',
-                                       '') in ignore_list):
-                    fix_hanging_single_conjunctions_and_place_back(t, t)
-                    continue
-            except AttributeError:
-                continue
-
-            # define entire list of ancestors of parent tag without namespace
-            # for fixing such problem: <h1><a>text</a></h1>
-            ancestors = [ancestor.xpath(
-                'local-name()'
-            ) for ancestor in parent.iterancestors()]
-
-            # create list with duplicates of ancestor list and ignore list
-            tags = filter(set(ancestors).__contains__, ignore_list)
-            if len(tags) > 0:
-                fix_hanging_single_conjunctions_and_place_back(t, t)
-                continue
-        lang = parent.get('{http://www.w3.org/XML/1998/namespace}lang')
-        if lang is not None and lang != MY_LANGUAGE and lang != MY_LANGUAGE2:
-            continue
-        newt = ''
-        wlist = re.compile(r'\w+|[^\w]', re.UNICODE).findall(t)
-        for w in wlist:
-            newt += hyph.inserted(w, hyphen_mark)
-        fix_hanging_single_conjunctions_and_place_back(t, newt)
+    runs = []
+
+    def add_run(el, is_tail, text):
+        if not text:
+            return
+        # headers are checked before the language, so conjunctions in
+        # headers are fixed in any language
+        if dont_hyph_headers and headers:
+            runs.append((el, is_tail, [text]))
+        elif lang[-1] not in (MY_LANGUAGE, MY_LANGUAGE2):
+            return
+        elif hyph is None:
+            runs.append((el, is_tail, [text]))
+        else:
+            runs.append((el, is_tail, WORD_SPLIT(text)))
+
+    for body in pat.XHTML_BODY(source_file):
+        # xml:lang inherited by the body, html tag has it always set
+        el = body
+        while el.get(XML_LANG) is None and el.getparent() is not None:
+            el = el.getparent()
+        lang = [el.get(XML_LANG, MY_LANGUAGE)]
+        headers = 0
+        for event, el in etree.iterwalk(body, events=('start', 'end')):
+            is_header = (el is not body and
+                         etree.QName(el).localname in HEADER_TAGS)
+            if event == 'start':
+                if el is not body:
+                    lang.append(el.get(XML_LANG, lang[-1]))
+                if is_header:
+                    headers += 1
+                add_run(el, False, el.text)
+                # comments and processing instructions are not walked
+                for child in el:
+                    if not isinstance(child.tag, basestring):
+                        add_run(child, True, child.tail)
+            else:
+                if is_header:
+                    headers -= 1
+                if el is not body:
+                    lang.pop()
+                    add_run(el, True, el.tail)
+
+    # words are at odd indexes of split text runs
+    words = set(w for el, is_tail, parts in runs for w in parts[1::2])
+    hyphenated = dict((w, hyph.inserted(w, hyphen_mark)) for w in words)
+    for el, is_tail, parts in runs:
+        parts[1::2] = [hyphenated[w] for w in parts[1::2]]
+        newt = SINGLE_CONJUNCTION(u'\u00A0', u''.join(parts))
+        if is_tail:
+            el.tail = newt
+        else:
+            el.text = newt
     return source_file
 
 
-def fix_styles(source_file):
+def is_hyphenated(ws, xhfile, was_fixed):
+    """
+    Return True if the XHTML file seems to be hyphenated already.
+
+    Soft hyphens are counted in raw bytes of the file. In books fixed by
+    epubQTools before (was_fixed) any soft hyphen is enough.
+    """
     try:
-        links = etree.XPath(
-            '//xhtml:link',
-            namespaces=XHTMLNS
-        )(source_file)
-    except:
-        print('* No links found...')
-    for link in links:
-        if link.get('type') is None:
-            link.set('type', 'text/css')
-    return source_file
+        raw = ws.read(xhfile)
+    except IOError:
+        return False
+    shy = sum(raw.count(s) for s in SOFT_HYPHENS)
+    if not shy:
+        return False
+    return was_fixed or shy >= HYPHENATED_DENSITY * raw.count(' ')
+
+
+def fix_styles(link):
+    link.set('type', 'text/css')
 
 
-def fix_nav_in_cover_file(opftree, tempdir):
+def fix_nav_in_cover_file(opftree, ws):
 
-    def move_nav_to_new_toc(tempdir, cover_href, toc_href):
+    def move_nav_to_new_toc(ws, cover_href, toc_href):
         print('* Moving problematic nav element from a cover file '
               'to a toc file...')
-        cover_tree = etree.parse(os.path.join(tempdir, cover_href),
-                                 parser=etree.XMLParser(recover=True))
-        toc_tree = etree.parse(os.path.join(tempdir, toc_href),
-                               parser=etree.XMLParser(recover=True))
+        cover_tree = ws.document(ws.href_name(cover_href))
+        toc_tree = ws.document(ws.href_name(toc_href))
         nav = etree.XPath('//xhtml:nav',
                           namespaces=XHTMLNS)(cover_tree)[0]
         remove_node(nav)
@@ -642,34 +712,16 @@ def fix_nav_in_cover_file(opftree, tempdir):
             '//xhtml:body',
             namespaces=XHTMLNS
         )(toc_tree)[0].append(nav)
-        with open(os.path.join(tempdir, cover_href),
-                  "w") as f:
-            f.write(etree.tostring(
-                cover_tree,
-                pretty_print=True,
-                xml_declaration=True,
-                standalone=False,
-                encoding="utf-8",
-                doctype=set_dtd(opftree)
-            ))
-        with open(os.path.join(tempdir, toc_href),
-                  "w") as f:
-            f.write(etree.tostring(
-                toc_tree,
-                pretty_print=True,
-                xml_declaration=True,
-                standalone=False,
-                encoding="utf-8",
-                doctype=set_dtd(opftree)
-            ))
+        ws.touch(ws.href_name(cover_href))
+        ws.touch(ws.href_name(toc_href))
     if opftree.xpath('//opf:package', namespaces=OPFNS)[0].get(
         'version'
     ) != '3.0':
         return opftree
-    reftocs = etree.XPath('//opf:reference[@type="toc"]',
-                          namespaces=OPFNS)(opftree)
-    refcovers = etree.XPath('//opf:reference[@type="cover"]',
-                            namespaces=OPFNS)(opftree)
+    reftocs = opftree.xpath('//opf:reference[@type="toc"]',
+                            namespaces=OPFNS)
+    refcovers = opftree.xpath('//opf:reference[@type="cover"]',
+                              namespaces=OPFNS)
     if len(refcovers) != 1:
         return opftree
     else:
@@ -678,31 +730,44 @@ def fix_nav_in_cover_file(opftree, tempdir):
         return opftree
     else:
         toc_href = reftocs[0].get('href')
-    items = etree.XPath('//opf:item', namespaces=OPFNS)(opftree)
-    for i in items:
-        if i.get('href') == cover_href and i.get('properties') == 'nav':
-            i.attrib.pop('properties')
-            for e in items:
-                if e.get('href') == toc_href:
-                    e.set('properties', 'nav')
-                    move_nav_to_new_toc(tempdir, cover_href, toc_href)
-                    break
-            break
+    i = opftree.item_by_href(cover_href)
+    if i is not None and i.get('properties') == 'nav':
+        i.attrib.pop('properties')
+        e = opftree.item_by_href(toc_href)
+        if e is not None:
+            e.set('properties', 'nav')
+            move_nav_to_new_toc(ws, cover_href, toc_href)
     return opftree
 
 
-def fix_html_toc(soup, tempdir, xhtml_files, xhtml_file_paths):
-    reftocs = etree.XPath('//opf:reference[@type="toc"]',
-                          namespaces=OPFNS)(soup)
+ncx2end = []
+
+
+def ncx2end_transform():
+    """Return XSLT generating HTML TOC from NCX, compiled on first use."""
+    if not ncx2end:
+        if not hasattr(sys, 'frozen'):
+            ncx2end.append(etree.XSLT(etree.fromstring(get_data(
+                'lib', 'resources/ncx2end-0.2.xsl'
+            ))))
+        else:
+            ncx2end.append(etree.XSLT(etree.parse(os.path.join(
+                os.path.dirname(sys.executable), 'resources',
+                'ncx2end-0.2.xsl'
+            ))))
+    return ncx2end[0]
+
+
+def fix_html_toc(soup, ncxtree, ws, xhtml_files, xhtml_file_paths):
+    reftocs = soup.xpath('//opf:reference[@type="toc"]', namespaces=OPFNS)
     if len(reftocs) == 0:
         html_toc = None
         for xhtml_file in xhtml_files:
             try:
-                xhtmltree = etree.parse(xhtml_file,
-                                        parser=etree.XMLParser(recover=True))
+                xhtmltree = ws.document(xhtml_file)
             except (etree.XMLSyntaxError, IOError):
                 continue
-            alltexts = etree.XPath('//text()', namespaces=XHTMLNS)(xhtmltree)
+            alltexts = pat.TEXTS(xhtmltree)
             alltext = ' '.join(alltexts)
             if alltext.find(u'Spis treści') != -1:
                 html_toc = xhtml_file
@@ -718,28 +783,7 @@ def fix_html_toc(soup, tempdir, xhtml_files, xhtml_file_paths):
             )
         else:
             print('* Fix for a missing HTML TOC file. Generating a new TOC...')
-            parser = etree.XMLParser(remove_blank_text=True)
-            if not hasattr(sys, 'frozen'):
-                transform = etree.XSLT(etree.fromstring(get_data('lib',
-                                       'resources/ncx2end-0.2.xsl')))
-            else:
-                transform = etree.XSLT(etree.parse(os.path.join(
-                    os.path.dirname(sys.executable), 'resources',
-                    'ncx2end-0.2.xsl'
-                )))
-            try:
-                toc_ncx_file = etree.XPath(
-                    '//opf:item[@media-type="application/x-dtbncx+xml"]',
-                    namespaces=OPFNS
-                )(soup)[0].get('href')
-            except IndexError:
-                return soup
-            try:
-                ncxtree = etree.parse(os.path.join(tempdir, toc_ncx_file),
-                                      parser)
-            except:
-                return soup
-            result = transform(ncxtree)
+            result = ncx2end_transform()(ncxtree)
             ncx_contents = ncxtree.xpath('//ncx:content', namespaces=NCXNS)
             if all(
                 os.path.dirname(x.get('src')) == os.path.dirname(
@@ -756,41 +800,31 @@ def fix_html_toc(soup, tempdir, xhtml_files, xhtml_file_paths):
             else:
                 textdir = ''
             head = result.xpath('//xhtml:head', namespaces=XHTMLNS)[0]
-            for ci in soup.xpath('//opf:item[@media-type="text/css"]',
-                                 namespaces=OPFNS):
+            for ci in soup.items('text/css'):
                 head.append(etree.fromstring(
                     '<link href="%s" rel="stylesheet" type="text/css" />'
                     % os.path.join(
-                        os.path.relpath(tempdir,
-                                        os.path.join(tempdir, textdir)),
+                        ws.relpath('', textdir),
                         ci.get('href')
                     ).replace('\\', '/')
                 ))
-            with open(os.path.join(tempdir, textdir, 'epubQTools-toc.xhtml'),
-                      "w") as f:
-                f.write(etree.tostring(
+            ws.write(
+                ws.href_name(os.path.join(textdir, 'epubQTools-toc.xhtml')),
+                etree.tostring(
                     result,
                     pretty_print=True,
                     xml_declaration=True,
                     standalone=False,
                     encoding="utf-8",
                     doctype=set_dtd(soup)
-                ))
-            newtocmanifest = etree.Element(
-                '{http://www.idpf.org/2007/opf}item',
-                attrib={'media-type': 'application/xhtml+xml',
-                        'href': os.path.join(
-                            textdir, 'epubQTools-toc.xhtml'
-                        ).replace('\\', '/'),
-                        'id': 'epubQTools-toc'}
+                )
             )
-            soup.xpath('//opf:manifest',
-                       namespaces=OPFNS)[0].append(newtocmanifest)
-            newtocspine = etree.Element(
-                '{http://www.idpf.org/2007/opf}itemref',
-                idref='epubQTools-toc'
+            soup.add_item(
+                os.path.join(textdir,
+                             'epubQTools-toc.xhtml').replace('\\', '/'),
+                'epubQTools-toc', 'application/xhtml+xml'
             )
-            soup.xpath('//opf:spine', namespaces=OPFNS)[0].append(newtocspine)
+            soup.add_itemref('epubQTools-toc')
             newtocreference = etree.Element(
                 '{http://www.idpf.org/2007/opf}reference',
                 title='TOC',
@@ -809,7 +843,7 @@ def fix_html_toc(soup, tempdir, xhtml_files, xhtml_file_paths):
     return soup
 
 
-def fix_mismatched_covers(opftree, tempdir):
+def fix_mismatched_covers(opftree, ws):
     global qfixerr
     refcvs = opftree.xpath('//opf:reference[@type="cover"]', namespaces=OPFNS)
     if len(refcvs) > 1:
@@ -817,14 +851,13 @@ def fix_mismatched_covers(opftree, tempdir):
         qfixerr = True
         return opftree
     try:
-        cover_xhtml_file = os.path.join(tempdir, refcvs[0].get('href'))
+        cover_xhtml_file = ws.href_name(refcvs[0].get('href'))
     except:
         print('* HTML cover reference not found. Giving up...')
         qfixerr = True
         return opftree
     try:
-        xhtmltree = etree.parse(cover_xhtml_file,
-                                parser=etree.XMLParser(recover=True))
+        xhtmltree = ws.document(cover_xhtml_file)
     except:
         print('* Unable to parse HTML cover file. Giving up...')
         qfixerr = True
@@ -833,9 +866,9 @@ def fix_mismatched_covers(opftree, tempdir):
         print('* HTML cover file is empty...')
         qfixerr = True
         return opftree
-    allimgs = etree.XPath('//xhtml:img', namespaces=XHTMLNS)(xhtmltree)
+    allimgs = pat.XHTML_IMGS(xhtmltree)
     if not allimgs:
-        allsvgimgs = etree.XPath('//svg:image', namespaces=SVGNS)(xhtmltree)
+        allsvgimgs = pat.SVG_IMAGES(xhtmltree)
         len_svg_images = len(allsvgimgs)
     else:
         len_svg_images = 0
@@ -856,14 +889,12 @@ def fix_mismatched_covers(opftree, tempdir):
         )[0].get('content')
     except IndexError:
         meta_cover_id = ''
-    try:
-        meta_cover_image_file = opftree.xpath(
-            '//opf:item[@id="' + meta_cover_id + '"]',
-            namespaces=OPFNS
-        )[0].get('href').split('/')[-1]
-    except IndexError:
+    meta_cover_item = opftree.item_by_id(meta_cover_id)
+    if meta_cover_item is not None:
+        meta_cover_image_file = meta_cover_item.get('href').split('/')[-1]
+    else:
         if html_cover_img_file is not None:
-            for i in opftree.xpath('//opf:item', namespaces=OPFNS):
+            for i in opftree.items():
                 if html_cover_img_file in i.get('href'):
                     opftree = set_cover_meta_elem(opftree, i.get('id'))
         meta_cover_image_file = html_cover_img_file
@@ -875,38 +906,26 @@ def fix_mismatched_covers(opftree, tempdir):
                 html_cover_img_file, meta_cover_image_file
             )
         )
-        with open(cover_xhtml_file, "w") as f:
-            f.write(etree.tostring(
-                xhtmltree,
-                pretty_print=True,
-                xml_declaration=True,
-                standalone=False,
-                encoding="utf-8",
-                doctype=set_dtd(opftree))
-            )
+        ws.touch(cover_xhtml_file)
     return opftree
 
 
-def set_cover_guide_ref(_xhtml_files, _itemcoverhref, _xhtml_file_paths,
+def set_cover_guide_ref(ws, _xhtml_files, _itemcoverhref, _xhtml_file_paths,
                         _soup):
+    graph = ReferenceGraph(ws.namelist())
+    for xhtml_file in _xhtml_files:
+        graph.add_document(xhtml_file, ws.document(xhtml_file))
+    # files with cover image, the last one is used
+    cover_referrers = set(
+        ref.source for target in graph.targets()
+        if _itemcoverhref in target or 'okladka_fmt' in target.lower()
+        for ref in graph.referrers(target)
+        if ref.element.tag in COVER_IMAGE_TAGS
+    )
     cover_file = None
     for xhtml_file in _xhtml_files:
-        xhtmltree = etree.parse(xhtml_file,
-                                parser=etree.XMLParser(recover=True))
-
-        allimgs = etree.XPath('//xhtml:img', namespaces=XHTMLNS)(xhtmltree)
-        for img in allimgs:
-            if (img.get('src').find(_itemcoverhref) != -1 or
-                    img.get('src').lower().find('okladka_fmt') != -1):
-                cover_file = xhtml_file
-                break
-        allsvgimgs = etree.XPath('//svg:image', namespaces=SVGNS)(xhtmltree)
-        for svgimg in allsvgimgs:
-            svg_img_href = svgimg.get('{http://www.w3.org/1999/xlink}href')
-            if (svg_img_href.find(_itemcoverhref) != -1 or
-                    svg_img_href.lower().find('okladka_fmt') != -1):
-                cover_file = xhtml_file
-                break
+        if xhtml_file in cover_referrers:
+            cover_file = xhtml_file
     if cover_file is not None:
         for xhtml_file_path in _xhtml_file_paths:
             if xhtml_file_path.find(os.path.basename(cover_file)) != -1:
@@ -916,8 +935,8 @@ def set_cover_guide_ref(_xhtml_files, _itemcoverhref, _xhtml_file_paths,
             '{http://www.idpf.org/2007/opf}reference', title='Cover',
             type="cover", href=cover_file
         )
-        _refcovers = etree.XPath('//opf:reference[@type="cover"]',
-                                 namespaces=OPFNS)(_soup)
+        _refcovers = _soup.xpath('//opf:reference[@type="cover"]',
+                                 namespaces=OPFNS)
         try:
             if len(_refcovers) == 1:
                 _refcovers[0].set('href', cover_file)
@@ -949,8 +968,7 @@ def set_cover_meta_elem(_soup, _content):
 
 def force_cover_find(_soup):
     print('* Trying to find cover image:', end=' ')
-    images = etree.XPath('//opf:item[@media-type="image/jpeg"]',
-                         namespaces=OPFNS)(_soup)
+    images = _soup.items('image/jpeg')
     if len(images) != 0:
         for imag in images:
             img = os.path.basename(imag.get('href')).lower()
@@ -961,19 +979,18 @@ def force_cover_find(_soup):
     return None, None
 
 
-def remove_fonts(opftree, rootepubdir):
+def remove_fonts(opftree, ws):
     print('* Removing all fonts...')
-    for i in opftree.xpath('//opf:item[@href]', namespaces=OPFNS):
+    for i in opftree.items():
         if (i.get('href').lower().endswith('.otf') or
                 i.get('href').lower().endswith('.ttf')):
-            remove_node(i)
-            os.remove(os.path.join(rootepubdir, i.get('href')))
+            opftree.remove(i)
+            ws.remove(ws.href_name(i.get('href')))
     return opftree
 
 
 def correct_mime_types(_soup):
-    _items = etree.XPath('//opf:item[@href]', namespaces=OPFNS)(_soup)
-    for _item in _items:
+    for _item in _soup.items():
         if (
                 (_item.get('href').lower().endswith('.otf') or
                     _item.get('href').lower().endswith('.ttf')) and
@@ -981,14 +998,13 @@ def correct_mime_types(_soup):
         ):
             print('* Setting correct mime type "application/vnd.ms-opentype" '
                   'for font "%s"' % _item.get('href'))
-            _item.set('media-type', 'application/vnd.ms-opentype')
+            _soup.set(_item, 'media-type', 'application/vnd.ms-opentype')
         elif _item.get('media-type').lower() == 'text/html':
-            _item.set('media-type', 'application/xhtml+xml')
+            _soup.set(_item, 'media-type', 'application/xhtml+xml')
     return _soup
 
 
-def fix_various_opf_problems(soup, tempdir, xhtml_files,
-                             xhtml_file_paths):
+def fix_various_opf_problems(soup, ws, xhtml_files, xhtml_file_paths):
 
     soup = correct_mime_types(soup)
 
@@ -1017,41 +1033,32 @@ def fix_various_opf_problems(soup, tempdir, xhtml_files,
             metadata.insert(0, newlang)
 
     # add missing meta cover and cover reference guide element
-    metacovers = etree.XPath('//opf:meta[@name="cover"]',
-                             namespaces=OPFNS)(soup)
-    refcovers = etree.XPath('//opf:reference[@type="cover"]',
-                            namespaces=OPFNS)(soup)
+    metacovers = soup.xpath('//opf:meta[@name="cover"]', namespaces=OPFNS)
+    refcovers = soup.xpath('//opf:reference[@type="cover"]',
+                           namespaces=OPFNS)
     if len(metacovers) == 1 and len(refcovers) == 0:
         # set missing cover reference guide element
-        itemcovers = etree.XPath(
-            '//opf:item[@id="' + metacovers[0].get('content') + '"]',
-            namespaces=OPFNS
-        )(soup)
+        itemcover = soup.item_by_id(metacovers[0].get('content'))
         print('* Defining cover guide element...')
-        try:
-            itemcoverhref = os.path.basename(itemcovers[0].get('href'))
+        if itemcover is not None:
+            itemcoverhref = os.path.basename(itemcover.get('href'))
             soup = set_cover_guide_ref(
-                xhtml_files, itemcoverhref, xhtml_file_paths, soup
+                ws, xhtml_files, itemcoverhref, xhtml_file_paths, soup
             )
-        except IndexError:
+        else:
             print('* No cover images found...')
     elif len(metacovers) == 0 and len(refcovers) == 1:
         # set missing cover meta element
         cover_image = None
         try:
-            coversoup = etree.parse(
-                os.path.join(tempdir, refcovers[0].get('href')),
-                parser=etree.XMLParser(recover=True)
-            )
+            coversoup = ws.document(ws.href_name(refcovers[0].get('href')))
         except:
             coversoup = None
         if etree.tostring(coversoup) is not None:
-            imgs = etree.XPath('//xhtml:img',
-                               namespaces=XHTMLNS)(coversoup)
+            imgs = pat.XHTML_IMGS(coversoup)
             if len(imgs) == 1:
                 cover_image = imgs[0].get('src')
-            images = etree.XPath('//svg:image',
-                                 namespaces=SVGNS)(coversoup)
+            images = pat.SVG_IMAGES(coversoup)
             if len(imgs) == 0 and len(images) == 1:
                 cover_image = images[0].get(
                     '{http://www.w3.org/1999/xlink}href'
@@ -1060,7 +1067,7 @@ def fix_various_opf_problems(soup, tempdir, xhtml_files,
             imag_href, imag_id = force_cover_find(soup)
             if imag_href is not None and imag_id is not None:
                 soup = set_cover_guide_ref(
-                    xhtml_files, imag_href, xhtml_file_paths, soup
+                    ws, xhtml_files, imag_href, xhtml_file_paths, soup
                 )
                 soup = set_cover_meta_elem(soup, imag_id)
             else:
@@ -1068,7 +1075,7 @@ def fix_various_opf_problems(soup, tempdir, xhtml_files,
         if cover_image is not None:
             cib = os.path.basename(cover_image)
             cov_img_id = None
-            for item in soup.xpath('//opf:item', namespaces=OPFNS):
+            for item in soup.items():
                 if cib in item.get('href'):
                     cov_img_id = item.get('href')
                     break
@@ -1079,7 +1086,7 @@ def fix_various_opf_problems(soup, tempdir, xhtml_files,
         imag_href, imag_id = force_cover_find(soup)
         if imag_href is not None and imag_id is not None:
             soup = set_cover_guide_ref(
-                xhtml_files, imag_href, xhtml_file_paths, soup
+                ws, xhtml_files, imag_href, xhtml_file_paths, soup
             )
             soup = set_cover_meta_elem(soup, imag_id)
         else:
@@ -1168,33 +1175,18 @@ def fix_meta_cover_order(soup):
     return soup
 
 
-def fix_ncx_dtd_uid(opftree, tempdir):
-    try:
-        ncxfile = etree.XPath(
-            '//opf:item[@media-type="application/x-dtbncx+xml"]',
-            namespaces=OPFNS
-        )(opftree)[0].get('href')
-    except IndexError:
-        return opftree
-    try:
-        ncxtree = etree.parse(os.path.join(tempdir, ncxfile))
-    except:
-        return opftree
+def fix_ncx_dtd_uid(opftree, ncxtree):
     # remove empty dc:identifiers
     for i in opftree.xpath('//dc:identifier', namespaces=DCNS):
         if i.text is None:
             i.getparent().remove(i)
     uniqid = opftree.xpath('//opf:package',
                            namespaces=OPFNS)[0].get('unique-identifier')
-    try:
-        dc_identifier = opftree.xpath(
-            '//dc:identifier[@id="' + str(uniqid) + '"]/text()',
-            namespaces=DCNS
-        )[0]
-    except IndexError:
+    if (uniqid is not None and
+            not pat.DC_IDENTIFIER_TEXT(opftree.getroot(), id=uniqid)):
         uniqid = None
-        id_found = False
     if uniqid is None:
+        id_found = False
         dcidentifiers = opftree.xpath('//dc:identifier', namespaces=DCNS)
         for dcid in dcidentifiers:
             if dcid.get('id') is not None:
@@ -1222,11 +1214,11 @@ def fix_ncx_dtd_uid(opftree, tempdir):
                 )
                 uniqid = 'BookId'
                 break
+    if uniqid is None:
+        return opftree
     try:
-        dc_identifier = opftree.xpath(
-            '//dc:identifier[@id="' + str(uniqid) + '"]/text()',
-            namespaces=DCNS
-        )[0]
+        dc_identifier = pat.DC_IDENTIFIER_TEXT(opftree.getroot(),
+                                               id=uniqid)[0]
     except IndexError:
         return opftree
     try:
@@ -1242,34 +1234,27 @@ def fix_ncx_dtd_uid(opftree, tempdir):
                               namespaces=NCXNS)(ncxtree)[0]
     if metadtd.get('content') != dc_identifier:
         metadtd.set('content', dc_identifier)
-    with open(os.path.join(tempdir, ncxfile), 'w') as f:
-        f.write(etree.tostring(ncxtree.getroot(), pretty_print=True,
-                xml_declaration=True, encoding='utf-8', standalone=False))
     return opftree
 
 
-def append_reset_css(source_file, xhtml_file, opf_path, opftree):
+def append_reset_css(source_file, xhtml_file, ws, opftree):
     try:
-        heads = etree.XPath(
-            '//xhtml:head',
-            namespaces=XHTMLNS
-        )(source_file)
+        heads = pat.XHTML_HEAD(source_file)
     except:
         print('* No head found...')
-    for ci in opftree.xpath('//opf:item[@media-type="text/css"]',
-                            namespaces=OPFNS):
+    for ci in opftree.items('text/css'):
         if 'epubQTools-reset.css' in ci.get('href'):
             rqcss = ci.get('href')
             break
     heads[0].append(etree.fromstring(
         '<link href="%s" rel="stylesheet" type="text/css" />'
-        % os.path.join(os.path.relpath(opf_path, os.path.dirname(xhtml_file)),
+        % os.path.join(ws.relpath(ws.opf_dir, os.path.dirname(xhtml_file)),
                        rqcss).replace('\\', '/')
     ))
     return source_file
 
 
-def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
+def append_reset_css_file(opftree, ws, sheets, is_rm_family, del_fonts,
                           html_margin, skip_hyph):
 
     def splitkeepsep(s, sep):
@@ -1282,8 +1267,7 @@ def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
 
     is_reset_css = is_body_family = is_calibre_class = False
     ff = ''
-    cssitems = opftree.xpath('//opf:item[@media-type="text/css"]',
-                             namespaces=OPFNS)
+    cssitems = opftree.items('text/css')
     for c in cssitems:
         if 'epubQTools-reset.css' in c.get('href'):
             is_reset_css = True
@@ -1291,38 +1275,34 @@ def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
     try:
         for c in cssitems:
             if not is_body_family:
-                with open(os.path.join(tempdir, c.get('href')), 'r') as f:
-                    fs = f.read()
-                    lis = splitkeepsep(fs, '}')
-                    for e in lis:
-                        if re.search(r'(^|,|\s+)\.calibre(\s+|,|{)', e):
-                            is_calibre_class = True
-                        if re.search(r'(^|,|\s+)body(\s+|,|{)', e):
-                            try:
-                                ff = re.search(
-                                    r'font-family\s*:\s*(.*?)(;|})', e
-                                ).group(1)
-                                is_body_family = True
-                            except:
-                                pass
-                        # if ff != '':
-                        #     break
+                fs = sheets.text(ws.href_name(c.get('href')))
+                lis = splitkeepsep(fs, '}')
+                for e in lis:
+                    if pat.CALIBRE_SELECTOR.search(e):
+                        is_calibre_class = True
+                    if pat.BODY_SELECTOR.search(e):
+                        try:
+                            ff = pat.FONT_FAMILY_VALUE.search(e).group(1)
+                            is_body_family = True
+                        except:
+                            pass
+                    # if ff != '':
+                    #     break
         if not is_body_family:
             print('! Font-family for body or .calibre does not found. Trying '
                   'to find the best font...')
             fflist = []
             for c in cssitems:
-                with open(os.path.join(tempdir, c.get('href')), 'r') as f:
-                    fs = f.read()
-                    lis = splitkeepsep(fs, '}')
-                    for e in lis:
-                        if 'font-family' in e:
-                            try:
-                                fflist.append(re.search(
-                                    r'font-family\s*:\s*(.+?)(;|})', e
-                                ).group(1))
-                            except:
-                                continue
+                fs = sheets.text(ws.href_name(c.get('href')))
+                lis = splitkeepsep(fs, '}')
+                for e in lis:
+                    if 'font-family' in e:
+                        try:
+                            fflist.append(
+                                pat.FONT_FAMILY_NONEMPTY.search(e).group(1)
+                            )
+                        except:
+                            continue
             try:
                 ff = most_common(fflist)
             except:
@@ -1332,40 +1312,35 @@ def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
         return opftree, is_reset_css
     if ff != '':
         for c in cssitems:
-            with open(os.path.join(tempdir, c.get('href')), 'r+') as f:
-                fs = f.read()
-                if del_fonts:
-                    print('* Removing all @font-face rules...')
-                    fs = re.sub(re.compile(
-                        r'@font-face.*?\{.*?\}', re.DOTALL
-                    ), '', fs)
-                if is_rm_family:
-                    print('* Removing problematic font-family...')
-                    ffr = ff.split(',')[0]
-                    ffr = ffr.replace('"', '').replace("'", '')
-                    lis = splitkeepsep(fs, '}')
-                    for e in lis:
-                        if '@font-face' in e:
-                            continue
+            fs = sheets.text(ws.href_name(c.get('href')))
+            if del_fonts:
+                print('* Removing all @font-face rules...')
+                fs = pat.CSS_FONT_FACE.sub('', fs)
+            if is_rm_family:
+                print('* Removing problematic font-family...')
+                ffr = ff.split(',')[0]
+                ffr = ffr.replace('"', '').replace("'", '')
+                lis = splitkeepsep(fs, '}')
+                for e in lis:
+                    if '@font-face' in e:
+                        continue
+                    lis[lis.index(e)] = re.sub(
+                        r'font-family\s*:\s*(\"|\')?' + re.escape(ffr) +
+                        r'(\"|\')?.*?;', '', e
+                    )
+                    try:
                         lis[lis.index(e)] = re.sub(
-                            r'font-family\s*:\s*(\"|\')?' + re.escape(ffr) +
-                            r'(\"|\')?.*?;', '', e
+                            r'font-family\s*:\s*(\"|\')?' +
+                            re.escape(ffr) + r'(\"|\')?.*?}', '}', e
                         )
-                        try:
-                            lis[lis.index(e)] = re.sub(
-                                r'font-family\s*:\s*(\"|\')?' +
-                                re.escape(ffr) + r'(\"|\')?.*?}', '}', e
-                            )
-                        except:
-                            continue
-                    fs = ''.join(lis)
-                if is_calibre_class:
-                    fs = 'body, .calibre {font-family: ' + ff + ' }\r\n' + fs
-                else:
-                    fs = 'body {font-family: ' + ff + ' }\r\n' + fs
-                f.seek(0)
-                f.truncate()
-                f.write(fs)
+                    except:
+                        continue
+                fs = ''.join(lis)
+            if is_calibre_class:
+                fs = 'body, .calibre {font-family: ' + ff + ' }\r\n' + fs
+            else:
+                fs = 'body {font-family: ' + ff + ' }\r\n' + fs
+            sheets.set_text(ws.href_name(c.get('href')), fs)
 
     if len(cssitems) > 0 and all(
         os.path.dirname(x.get('href')) == os.path.dirname(
@@ -1399,58 +1374,47 @@ def append_reset_css_file(opftree, tempdir, is_rm_family, del_fonts,
         bs = bs + 'html {margin-left: ' + html_margin + \
             'px !important; margin-right: ' + html_margin + \
             'px !important;} \r\n'
-    with open(os.path.join(tempdir, cssdir, 'epubQTools-reset.css'), 'w') as f:
-        f.write(bs +
-                '@page { margin: 5pt; } \r\n'
-                'body, body.calibre  { margin: 5pt; padding: 0; }\r\n'
-                'p { margin-left: 0; margin-right: 0; }\r\n' +
-                hyphen_properties)
-    newcssmanifest = etree.Element(
-        '{http://www.idpf.org/2007/opf}item',
-        attrib={'media-type': 'text/css',
-                'href': os.path.join(
-                    cssdir,
-                    'epubQTools-reset.css'
-                ).replace('\\', '/'),
-                'id': 'epubQTools-reset'}
+    sheets.set_text(
+        ws.href_name(os.path.join(cssdir, 'epubQTools-reset.css')),
+        bs +
+        '@page { margin: 5pt; } \r\n'
+        'body, body.calibre  { margin: 5pt; padding: 0; }\r\n'
+        'p { margin-left: 0; margin-right: 0; }\r\n' +
+        hyphen_properties
+    )
+    opftree.add_item(
+        os.path.join(cssdir, 'epubQTools-reset.css').replace('\\', '/'),
+        'epubQTools-reset', 'text/css'
     )
-    opftree.xpath('//opf:manifest',
-                  namespaces=OPFNS)[0].append(newcssmanifest)
     return opftree, is_reset_css
 
 
-def modify_problematic_styles(source_file):
-    img_styles = etree.XPath('//xhtml:img[@style]',
-                             namespaces=XHTMLNS)(source_file)
-    for s in img_styles:
-        s_words = re.split(r'[:; ]+', s.get('style'))
-        maxw = w = False
-        for sw in s_words:
-            if sw == 'max-width':
-                maxw = True
-            if sw == 'width':
-                w = True
-        if (maxw and w):
-            print('* Fixing problematic combo max-width and width: "' +
-                  s.get('style') + '"')
-            stylestr = s.get('style')
-            stylestr = re.sub(r'[^-]width:(\s*)100%;*', '',
-                              stylestr)
-            s.set('style', stylestr)
-    return source_file
+def modify_problematic_styles(img):
+    s_words = pat.STYLE_WORDS.split(img.get('style'))
+    maxw = w = False
+    for sw in s_words:
+        if sw == 'max-width':
+            maxw = True
+        if sw == 'width':
+            w = True
+    if (maxw and w):
+        print('* Fixing problematic combo max-width and width: "' +
+              img.get('style') + '"')
+        stylestr = img.get('style')
+        stylestr = pat.WIDTH_100.sub('', stylestr)
+        img.set('style', stylestr)
 
 
-def remove_text_from_html_cover(opftree, rootepubdir):
+def remove_text_from_html_cover(opftree, ws):
     try:
-        html_cover_path = os.path.join(rootepubdir, opftree.xpath(
+        html_cover_path = ws.href_name(opftree.xpath(
             '//opf:reference[@type="cover"]',
             namespaces=OPFNS
         )[0].get('href'))
     except:
         return 0
     try:
-        html_cover_tree = etree.parse(html_cover_path,
-                                      parser=etree.XMLParser(recover=True))
+        html_cover_tree = ws.document(html_cover_path)
     except:
         print('* Unable to parse HTML cover file. Giving up...')
         return 0
@@ -1469,27 +1433,18 @@ def remove_text_from_html_cover(opftree, rootepubdir):
             parent.text = ''
         elif t.is_tail:
             parent.tail = ''
-    with open(html_cover_path, 'w') as f:
-        f.write(etree.tostring(
-            html_cover_tree,
-            pretty_print=True,
-            xml_declaration=True,
-            standalone=False,
-            encoding='utf-8',
-            doctype=set_dtd(opftree))
-        )
+    ws.touch(html_cover_path)
 
 
-def convert_dl_to_ul(opftree, rootepubdir):
+def convert_dl_to_ul(opftree, ws):
     try:
-        html_toc_path = os.path.join(rootepubdir, opftree.xpath(
+        html_toc_path = ws.href_name(opftree.xpath(
             '//opf:reference[@type="toc"]',
             namespaces=OPFNS
         )[0].get('href').split('#')[0])
     except IndexError:
         return None
-    with open(html_toc_path, 'r') as f:
-        raw = f.read()
+    raw = ws.read(html_toc_path)
     if '<dl>' in raw:
         print('* Coverting HTML TOC from definition list to unsorted list...')
         raw = re.sub(r'<dd>(\s*)<dl>', '<li><ul>', raw)
@@ -1498,24 +1453,22 @@ def convert_dl_to_ul(opftree, rootepubdir):
         raw = raw.replace('</dl>', '</ul>')
         raw = raw.replace('<dt>', '<li>')
         raw = raw.replace('</dt>', '</li>')
-        with open(html_toc_path, 'w') as f:
-            f.write(raw)
+        ws.write(html_toc_path, raw)
 
 
-def remove_wm_info(opftree, rootepubdir):
+def remove_wm_info(opftree, ws):
     wmfiles = ['watermark.', 'default-info.', 'generated.', 'platon_wm.',
                'cover-special.', 'default-info-epub3.']
-    items = opftree.xpath('//opf:item', namespaces=OPFNS)
+    items = opftree.items()
     for wmf in wmfiles:
         for i in items:
             if wmf in i.get('href'):
                 try:
-                    wmtree = etree.parse(os.path.join(rootepubdir,
-                                                      i.get('href')))
+                    wmtree = ws.document(ws.href_name(i.get('href')),
+                                         strict=True)
                 except:
                     continue
-                alltexts = wmtree.xpath('//xhtml:body//text()',
-                                        namespaces=XHTMLNS)
+                alltexts = pat.XHTML_BODY_TEXTS(wmtree)
                 alltext = ' '.join(alltexts)
                 alltext = alltext.replace(u'\u00AD', '').strip()
                 if (
@@ -1523,199 +1476,190 @@ def remove_wm_info(opftree, rootepubdir):
                     'Ten ebook jest chroniony znakiem wodnym' in alltext or
                     alltext == ''
                 ):
-                    remove_file_from_epub(i.get('href'), opftree, rootepubdir)
+                    remove_file_from_epub(i.get('href'), opftree, ws)
                     print('* Watermark info page removed: ' + i.get('href'))
     return opftree
 
 
-def remove_jacket(opftree, rootepubdir):
-    items = opftree.xpath('//opf:item', namespaces=OPFNS)
-    for i in items:
+def remove_jacket(opftree, ws):
+    for i in opftree.items():
         if 'jacket.xhtml' in i.get('href'):
             print('* Removing calibre file: "%s"' % i.get('href'))
-            remove_file_from_epub(i.get('href'), opftree, rootepubdir)
+            remove_file_from_epub(i.get('href'), opftree, ws)
     return opftree
 
 
-def remove_file_from_epub(file_rel_to_opf, opftree, rootepubdir):
-    item = opftree.xpath('//opf:item[@href="' + file_rel_to_opf + '"]',
-                         namespaces=OPFNS)[0]
-    item_ncx = opftree.xpath('//opf:itemref[@idref="' + item.get('id') + '"]',
-                             namespaces=OPFNS)[0]
-    item_ncx.getparent().remove(item_ncx)
-    item.getparent().remove(item)
-    os.remove(os.path.join(rootepubdir, file_rel_to_opf))
+def remove_file_from_epub(file_rel_to_opf, opftree, ws):
+    item = opftree.item_by_href(file_rel_to_opf)
+    item_ncx = opftree.itemref_by_idref(item.get('id'))
+    opftree.remove(item_ncx)
+    opftree.remove(item)
+    ws.remove(ws.href_name(file_rel_to_opf))
+
+
+def remove_wm_remaining(body):
+    """Remove <div><span/></div> left by WM at the end of body."""
+    try:
+        if (
+            len(body) > 0 and
+            body[-1].text is None and
+            body[-1].tail is None and
+            body[-1].tag == "{http://www.w3.org/1999/xhtml}div" and
+            body[-1][0].tag == "{http://www.w3.org/1999/xhtml}span" and
+            len(body[-1]) == 1 and
+            body[-1][0].get('style').replace(' ', '').replace(
+                ';', ''
+            ) == 'color:whitefont-size:1px' and
+            len(body[-1][0]) == 0 and
+            body[-1][0].text is None and
+            body[-1][0].tail is None
+        ):
+            print('* Removing WM remaining <div><span/></div>...')
+            remove_node(body[-1])
+    except:
+        pass
+
+
+def is_wm_reset_span(span):
+    classes = span.get('class', '')
+    return 'reset' in classes and any(c in classes for c in WM_CLASSES)
+
+
+def remove_wm_mark(span):
+    parent = span.getparent()
+    remove_node(span)
+    if ''.join(parent.itertext()) == '' and len(parent) == 0:
+        remove_node(parent)
+
+
+WM_CLASSES = ('black', 'black-fore', 'black2', 'dark-gray', 'dark-gray2')
+WM2_STYLE = ('padding:0;border:0;text-indent:0;line-height:normal;'
+             'margin:0 1cm 0.5cm 1cm;font-size:0pt;color:#FFFFFF;'
+             'text-decoration:none;text-align:left;background:none;'
+             'display:none;')
+XHTML = '{http://www.w3.org/1999/xhtml}'
+COVER_IMAGE_TAGS = (XHTML + 'img', '{http://www.w3.org/2000/svg}image')
+# cleanup rules of XHTML files for apply_rules(), WM_RULES are applied
+# before hyphenation
+WM_RULES = (
+    # remove WM remainings
+    (XHTML + 'body', None, remove_wm_remaining),
+    # remove WM reset spans
+    (XHTML + 'span', is_wm_reset_span, unwrap),
+)
+CLEANUP_RULES = (
+    (XHTML + 'link', lambda link: link.get('type') is None, fix_styles),
+    (XHTML + 'img', lambda img: img.get('style') is not None,
+     modify_problematic_styles),
+    (XHTML + 'div', lambda div: div.get('style') == WM2_STYLE, remove_node),
+    (XHTML + 'span', lambda span: (span.text or '').startswith('==='),
+     remove_wm_mark),
+    # remove meta charsets
+    (XHTML + 'meta', lambda meta: meta.get('charset') == 'utf-8',
+     lambda meta: meta.getparent().remove(meta)),
+    # remove useless <?fragment ?> processing-instructions
+    ('?fragment', None, remove_node),
+)
+
+
+def parse_xhtml(c):
+    """
+    Return (tree, error) for an XHTML file, see EpubWorkspace.document().
+
+    Named HTML entities are replaced before parsing and files with the XML
+    declaration after some garbage or with unclosed body are fixed.
+    """
+    c = replace_entities(c)
+    try:
+        return etree.parse(StringIO.StringIO(c),
+                           etree.XMLParser(recover=False)), None
+    except etree.XMLSyntaxError, e:
+        error = e
+    try:
+        if ('XML declaration allowed only at the start of the '
+                'document' in str(error).decode(SFENC)):
+            return etree.parse(StringIO.StringIO(c[c.find('<?xml'):]),
+                               etree.XMLParser(recover=False)), None
+        elif pat.UNCLOSED_BODY.search(str(error).decode(SFENC)):
+            return etree.parse(StringIO.StringIO(
+                c.replace('</html>', '</body></html>')
+            ), etree.XMLParser(recover=False)), None
+    except etree.XMLSyntaxError:
+        pass
+    return etree.parse(StringIO.StringIO(c),
+                       etree.XMLParser(recover=True)), error
 
 
-def process_xhtml_file(xhfile, opftree, _resetmargins, skip_hyph, opf_path,
-                       is_reset_css, opf_dir_abs, is_xml_ext_fixed, book_lang,
-                       dont_hyph_headers):
+def process_xhtml_file(ws, xhfile, opftree, _resetmargins, skip_hyph,
+                       is_reset_css, is_xml_ext_fixed, book_lang,
+                       dont_hyph_headers, skip_hyphenator=False):
     global qfixerr
     try:
-        with open(xhfile, 'r') as content_file:
-            c = content_file.read()
+        xhtree = ws.document(xhfile, strict=True).getroot()
     except IOError, e:
         print('* File skipped: %s. Problem with processing: '
               '%s' % (os.path.basename(xhfile), e))
         qfixerr = True
         return 1
-    # placeholder
-    for key in entities.iterkeys():
-        c = c.replace(key, entities[key])
-    try:
-        xhtree = etree.fromstring(c, parser=etree.XMLParser(recover=False))
     except etree.XMLSyntaxError, e:
-        if ('XML declaration allowed only at the start of the '
-                'document' in str(e).decode(SFENC)):
-            xhtree = etree.fromstring(c[c.find('<?xml'):],
-                                      parser=etree.XMLParser(recover=False))
-        elif re.search('Opening and ending tag mismatch: body line \d+ and '
-                       'html', str(e).decode(SFENC)):
-            try:
-                xhtree = etree.fromstring(
-                    c.replace('</html>', '</body></html>'),
-                    parser=etree.XMLParser(recover=False)
-                )
-            except:
-                print('* File skipped: ' + os.path.basename(xhfile) +
-                      '. NOT well formed: "' + str(e).decode(SFENC) + '"')
-                qfixerr = True
-                return 1
-        else:
-            print('* File skipped: ' + os.path.basename(xhfile) +
-                  '. NOT well formed: "' + str(e).decode(SFENC) + '"')
-            qfixerr = True
-            return 1
-
-    # remove WM remainings
-    for i in etree.XPath("//xhtml:body", namespaces=XHTMLNS)(xhtree):
-        try:
-            if (
-                len(i) > 0 and
-                i[-1].text is None and
-                i[-1].tail is None and
-                i[-1].tag == "{http://www.w3.org/1999/xhtml}div" and
-                i[-1][0].tag == "{http://www.w3.org/1999/xhtml}span" and
-                len(i[-1]) == 1 and
-                i[-1][0].get('style').replace(' ', '').replace(
-                    ';', ''
-                ) == 'color:whitefont-size:1px' and
-                len(i[-1][0]) == 0 and
-                i[-1][0].text is None and
-                i[-1][0].tail is None
-            ):
-                print('* Removing WM remaining <div><span/></div>...')
-                remove_node(i[-1])
-        except:
-            continue
+        print('* File skipped: ' + os.path.basename(xhfile) +
+              '. NOT well formed: "' + str(e).decode(SFENC) + '"')
+        qfixerr = True
+        return 1
 
-    # remove WM reset spans
-    wm_classes = ('black', 'black-fore', 'black2', 'dark-gray', 'dark-gray2')
-    deltag = "epubqtoolsdelme"  # bogus temporary tag
-    for i in wm_classes:
-        wm_spans = etree.XPath("//xhtml:span[contains(@class, 'reset') "
-                               "and contains(@class, '" + i + "')]",
-                               namespaces=XHTMLNS)(xhtree)
-        for w in wm_spans:
-            w.tag = deltag
-    etree.strip_tags(xhtree, deltag)  # strip bogus tags with attributes
-    # workaround strange strip tag bug during hyphenation:
-    xhtree = etree.fromstring(etree.tostring(xhtree))
+    xhtree = apply_rules(xhtree, WM_RULES)
     if not skip_hyph and book_lang == 'pl':
-        xhtree = hyphenate_and_fix_conjunctions(xhtree, HYPHEN_MARK, hyph,
-                                                dont_hyph_headers)
-    xhtree = fix_styles(xhtree)
+        xhtree = hyphenate_and_fix_conjunctions(
+            xhtree, HYPHEN_MARK, None if skip_hyphenator else get_hyphenator(),
+            dont_hyph_headers
+        )
+    xhtree = apply_rules(xhtree, CLEANUP_RULES)
     if is_xml_ext_fixed:
-        xhtree = xml2html_fix_references(xhtree, os.path.dirname(xhfile),
+        xhtree = xml2html_fix_references(xhtree, ws, os.path.dirname(xhfile),
                                          False)
     if _resetmargins and not is_reset_css:
-        xhtree = append_reset_css(xhtree, xhfile, opf_path, opftree)
-    xhtree = modify_problematic_styles(xhtree)
-    _wmarks = xhtree.xpath('//xhtml:span[starts-with(text(), "===")]',
-                           namespaces=XHTMLNS)
-    wm2s = xhtree.xpath(
-        '//xhtml:div[@style="padding:0;border:0;text-indent:0;'
-        'line-height:normal;margin:0 1cm 0.5cm 1cm;font-size:0pt;'
-        'color:#FFFFFF;text-decoration:none;text-align:left;'
-        'background:none;display:none;"]',
-        namespaces=XHTMLNS
-    )
-    for wm in wm2s:
-        remove_node(wm)
-    for wm in _wmarks:
-        parent = wm.getparent()
-        remove_node(wm)
-        if ''.join(parent.itertext()) == '' and len(parent) == 0:
-            remove_node(parent)
-
-    # remove meta charsets
-    _metacharsets = xhtree.xpath('//xhtml:meta[@charset="utf-8"]',
-                                 namespaces=XHTMLNS)
-    for mch in _metacharsets:
-        mch.getparent().remove(mch)
+        xhtree = append_reset_css(xhtree, xhfile, ws, opftree)
+    ws.touch(xhfile)
 
-    # remove useless <?fragment ?> processing-instructions
-    p_is = etree.XPath('//processing-instruction("fragment")')(xhtree)
-    for p in p_is:
-        remove_node(p)
 
-    with open(xhfile, "w") as f:
-        f.write(etree.tostring(xhtree, pretty_print=True, xml_declaration=True,
-                standalone=False, encoding="utf-8", doctype=set_dtd(opftree)))
-
-
-def process_epub(_tempdir, _replacefonts, _resetmargins,
+def process_epub(ws, _replacefonts, _resetmargins,
                  skip_hyph, arg_justify, arg_left, irmf, fontdir, del_colors,
-                 del_fonts, html_margin, dont_hyph_headers):
-    global qfixerr
+                 del_fonts, html_margin, dont_hyph_headers, pair_family):
+    global qfixerr, book_skipped_files
     qfixerr = False
-    opf_dir, opf_file_path, is_fixed = find_roots(_tempdir)
-    opf_dir_abs = os.path.join(_tempdir, opf_dir)
-    opf_file_path_abs = os.path.join(_tempdir, opf_file_path)
+    book_skipped_files = 0
+    opf_dir, opf_file_path, is_fixed = find_roots(ws)
+    if opf_file_path is None:
+        return True
 
     # remove obsolete files
-    for roott, dirst, filest in os.walk(_tempdir):
-        for f in filest:
-            if '.DS_Store' in f:
-                os.remove(os.path.join(roott, f))
-    try:
-        os.remove(os.path.join(_tempdir, 'META-INF', 'calibre_bookmarks.txt'))
-    except OSError:
-        pass
-    try:
-        os.remove(os.path.join(_tempdir, 'iTunesMetadata.plist'))
-    except OSError:
-        pass
-    try:
-        os.remove(os.path.join(_tempdir, 'msg.txt'))
-    except OSError:
-        pass
+    for f in ws.namelist():
+        if '.DS_Store' in os.path.basename(f):
+            ws.remove(f)
+    for f in ('META-INF/calibre_bookmarks.txt', 'iTunesMetadata.plist',
+              'msg.txt'):
+        if ws.exists(f):
+            ws.remove(f)
 
     # append com.apple.ibooks.display-options.xml file
-    ibooks_file = os.path.join(_tempdir, 'META-INF',
-                               'com.apple.ibooks.display-options.xml')
-    if not os.path.exists(ibooks_file) and not del_fonts:
+    ibooks_file = 'META-INF/com.apple.ibooks.display-options.xml'
+    if not ws.exists(ibooks_file) and not del_fonts:
         print('* Adding com.apple.ibooks.display-options.xml '
               'file...')
-        with open(ibooks_file, 'wb') as f:
-            data = get_data('lib',
-                            'resources/com.apple.ibooks.display-options.xml')
-            f.write(data)
-    elif os.path.exists(ibooks_file) and del_fonts:
+        ws.write(ibooks_file, get_data(
+            'lib', 'resources/com.apple.ibooks.display-options.xml'
+        ))
+    elif ws.exists(ibooks_file) and del_fonts:
         print('* Removing needless com.apple.ibooks.display-options.xml '
               'file...')
-        try:
-            os.remove(os.path.join(_tempdir, 'META-INF',
-                                   'com.apple.ibooks.display-options.xml'))
-        except OSError:
-            pass
+        ws.remove(ibooks_file)
 
     parser = etree.XMLParser(remove_blank_text=True)
     try:
-        opftree = etree.parse(opf_file_path_abs, parser)
+        opftree = OpfPackage(ws.parse(opf_file_path, parser))
     except (etree.XMLSyntaxError, IOError) as e:
         print('! CRITICAL! XML file "%s" is not well '
-              'formed: "%s"' % (os.path.basename(opf_file_path_abs),
+              'formed: "%s"' % (os.path.basename(opf_file_path),
                                 str(e).decode(SFENC)))
         print('! Unable to proceed...')
         return True
@@ -1725,77 +1669,114 @@ def process_epub(_tempdir, _replacefonts, _resetmargins,
               'defined in OPF file. Unable to proceed...')
         return True
     try:
-        etree.XPath('//opf:item[@media-type="application/x-dtbncx+xml"]',
-                    namespaces=OPFNS)(opftree)[0].get('href')
+        ncx_item = opftree.items('application/x-dtbncx+xml')[0]
     except IndexError:
         print('! CRITICAL! NCX file element is NOT defined in OPF file. '
               'Unable to proceed...')
         return True
     opftree = unquote_urls(opftree)
+    ncx_file_path = ws.href_name(ncx_item.get('href'))
+    try:
+        ncxtree = ws.parse(ncx_file_path, parser=etree.XMLParser(
+            recover=True, remove_blank_text=True
+        ))
+    except (etree.XMLSyntaxError, IOError) as e:
+        print('! CRITICAL! NCX file "%s" could not be loaded: "%s"' % (
+              os.path.basename(ncx_file_path), str(e).decode(SFENC)))
+        print('! Unable to proceed...')
+        return True
 
-    opftree, is_xml_ext_fixed = xml2html_extension(opftree, opf_dir_abs)
+    def serialize_xhtml(tree):
+        return etree.tostring(
+            tree.getroot(), pretty_print=True, xml_declaration=True,
+            standalone=False, encoding="utf-8", doctype=set_dtd(opftree)
+        )
+    # XHTML files are parsed once and shared by all fixers
+    ws.parse_document = parse_xhtml
+    ws.serialize_document = serialize_xhtml
+    # CSS files are read once and shared by all fixers as well
+    sheets = StylesheetStore(ws)
+
+    opftree, is_xml_ext_fixed = xml2html_extension(opftree, ws)
 
-    fix_ncx(opftree, opf_dir_abs)
+    ncxtree = fix_ncx(ncxtree, ws)
 
-    _xhtml_files, _xhtml_file_paths = find_xhtml_files(opf_dir_abs, opftree)
+    _xhtml_files, _xhtml_file_paths = find_xhtml_files(ws, opftree)
 
-    opftree = fix_various_opf_problems(opftree, opf_dir_abs, _xhtml_files,
+    opftree = fix_various_opf_problems(opftree, ws, _xhtml_files,
                                        _xhtml_file_paths)
-    opftree = fix_ncx_dtd_uid(opftree, opf_dir_abs)
+    opftree = fix_ncx_dtd_uid(opftree, ncxtree)
     opftree = fix_meta_cover_order(opftree)
 
-    opftree = fix_mismatched_covers(opftree, opf_dir_abs)
+    opftree = fix_mismatched_covers(opftree, ws)
 
     # parse encryption.xml file
-    enc_file = os.path.join(_tempdir, 'META-INF', 'encryption.xml')
-    if os.path.exists(enc_file):
-        process_encryption(enc_file, opftree, fontdir)
-        os.remove(enc_file)
+    enc_file = 'META-INF/encryption.xml'
+    if ws.exists(enc_file):
+        process_encryption(ws, enc_file, opftree, fontdir)
+        ws.remove(enc_file)
 
     if _replacefonts:
-        find_and_replace_fonts(opftree, opf_dir_abs, fontdir)
+        find_and_replace_fonts(opftree, ws, fontdir)
+    # books fixed by epubQTools before have the reset CSS file
+    was_fixed = any('epubQTools-reset.css' in i.get('href')
+                    for i in opftree.items())
     if _resetmargins:
         print('* Setting custom CSS styles...')
         opftree, is_reset_css = append_reset_css_file(
-            opftree, opf_dir_abs, irmf, del_fonts, html_margin, skip_hyph
+            opftree, ws, sheets, irmf, del_fonts, html_margin, skip_hyph
         )
     else:
         is_reset_css = False
-    opftree = remove_jacket(opftree, opf_dir_abs)
-    _xhtml_files, _xhtml_file_paths = find_xhtml_files(opf_dir_abs, opftree)
-    opftree = fix_html_toc(opftree, opf_dir_abs, _xhtml_files,
+    opftree = remove_jacket(opftree, ws)
+    _xhtml_files, _xhtml_file_paths = find_xhtml_files(ws, opftree)
+    opftree = fix_html_toc(opftree, ncxtree, ws, _xhtml_files,
                            _xhtml_file_paths)
-    convert_dl_to_ul(opftree, opf_dir_abs)
+    convert_dl_to_ul(opftree, ws)
     try:
         book_lang = opftree.xpath("//dc:language", namespaces=DCNS)[0].text
     except IndexError:
         book_lang = ''
-    if not skip_hyph and book_lang == 'pl':
+    is_hyph = not skip_hyph and book_lang == 'pl'
+    if is_hyph:
         print('* Hyphenating texts...')
         if dont_hyph_headers:
             print('* ... except headers...')
     for s in _xhtml_files:
-        process_xhtml_file(s, opftree, _resetmargins, skip_hyph, opf_dir_abs,
-                           is_reset_css, opf_dir_abs, is_xml_ext_fixed,
-                           book_lang, dont_hyph_headers)
-    opftree = remove_wm_info(opftree, opf_dir_abs)
+        hyphenated = is_hyph and is_hyphenated(ws, s, was_fixed)
+        if hyphenated:
+            book_skipped_files += 1
+        process_xhtml_file(ws, s, opftree, _resetmargins, skip_hyph,
+                           is_reset_css, is_xml_ext_fixed, book_lang,
+                           dont_hyph_headers, hyphenated)
+    opftree = remove_wm_info(opftree, ws)
     opftree = html_cover_first(opftree)
-    opftree = fix_nav_in_cover_file(opftree, opf_dir_abs)
-    remove_text_from_html_cover(opftree, opf_dir_abs)
+    opftree = fix_nav_in_cover_file(opftree, ws)
+    remove_text_from_html_cover(opftree, ws)
     if del_fonts:
-        opftree = remove_fonts(opftree, opf_dir_abs)
+        opftree = remove_fonts(opftree, ws)
     if arg_justify:
         print('* Replacing "text-align: left" with "text-align: justify" in '
               'all CSS files...')
-        modify_css_align(opftree, opf_dir_abs, 'justify', del_colors)
+        modify_css_align(opftree, ws, sheets, 'justify', del_colors)
     elif arg_left:
         print('* Replacing "text-align: justify" with "text-align: left" in '
               'all CSS files...')
-        modify_css_align(opftree, opf_dir_abs, 'left', del_colors)
-    # write all OPF changes back to file
-    with open(opf_file_path_abs, 'w') as f:
-        f.write(etree.tostring(opftree.getroot(), pretty_print=True,
-                standalone=False, xml_declaration=True, encoding='utf-8'))
+        modify_css_align(opftree, ws, sheets, 'left', del_colors)
+    # cssutils is imported only when a book is beautified
+    from lib.beautify_book import beautify_book
+    beautify_book(opftree, ncxtree, ws, sheets, fontdir, pair_family)
+    # write all CSS, XHTML, OPF and NCX changes back to the workspace
+    sheets.flush()
+    ws.flush()
+    ws.write(opf_file_path, etree.tostring(
+        opftree.getroot(), pretty_print=True, standalone=False,
+        xml_declaration=True, encoding='utf-8'
+    ))
+    ws.write(ncx_file_path, etree.tostring(
+        ncxtree.getroot(), pretty_print=True, standalone=False,
+        xml_declaration=True, encoding='utf-8'
+    ))
     return False
 
 
@@ -1833,29 +1814,23 @@ def process_corrupted_zip(e, root, f, zipbinf):
         return 1
 
 
-def modify_css_align(opftree, opfdir, mode, del_colors):
+def modify_css_align(opftree, ws, sheets, mode, del_colors):
     global qfixerr
     if mode == 'justify':
         searchmode = 'left'
     elif mode == 'left':
         searchmode = 'justify'
-    cssitems = opftree.xpath('//opf:item[@media-type="text/css"]',
-                             namespaces=OPFNS)
-    for c in cssitems:
+    for c in opftree.items('text/css'):
         try:
-            with open(os.path.join(opfdir, c.get('href')), 'r+') as cf:
-                cc = cf.read()
-                cc = re.sub(r'text-align\s*:\s*' + searchmode,
-                            'text-align: ' + mode, cc)
-                if del_colors:
-                    print('* Removing all color definitions from all '
-                          'CSS files...')
-                    cc = re.sub(r'color\s*:\s*(.*?)(;|\r|\n)', '', cc)
-                cf.seek(0)
-                cf.truncate()
-                cf.write(cc)
+            cc = sheets.text(ws.href_name(c.get('href')))
         except IOError:
-            pass
+            continue
+        cc = pat.TEXT_ALIGN[searchmode].sub('text-align: ' + mode, cc)
+        if del_colors:
+            print('* Removing all color definitions from all '
+                  'CSS files...')
+            cc = pat.COLOR.sub('', cc)
+        sheets.set_text(ws.href_name(c.get('href')), cc)
 
 
 def html_cover_first(opftree):
@@ -1865,69 +1840,159 @@ def html_cover_first(opftree):
     try:
         if not refcvs[0].get('href').endswith('html'):
             return opftree
-        id = opftree.xpath('//opf:item[@href="' + refcvs[0].get('href') + '"]',
-                           namespaces=OPFNS)[0].get('id')
-        coverir = opftree.xpath('//opf:itemref[@idref="' + id + '"]',
-                                namespaces=OPFNS)[0]
+        id = opftree.item_by_href(refcvs[0].get('href')).get('id')
+        coverir = opftree.itemref_by_idref(id)
         if coverir.attrib['linear']:
             del coverir.attrib['linear']
-        spine = coverir.getparent()
-        spine.remove(coverir)
     except:
         return opftree
-    spine.insert(0, coverir)
+    opftree.move_first(coverir)
     return opftree
 
 
+def open_epub(root, f, zbf, error=None):
+    """
+    Return a workspace for the EPUB file or None if it is corrupted and
+    could not be fixed. A fixed copy is kept in memory only.
+    """
+    if error is None:
+        try:
+            return EpubWorkspace(os.path.join(root, f))
+        except zipfile.BadZipfile, e:
+            error = e
+    fixed_pth = process_corrupted_zip(error, root, f, zbf)
+    if str(fixed_pth) == '1':
+        return None
+    with open(fixed_pth, 'rb') as fixed:
+        data = fixed.read()
+    os.unlink(fixed_pth)
+    return open_workspace(data)
+
+
 def qfix(root, f, _forced, _replacefonts, _resetmargins, zbf,
          skip_hyph, arg_justify, arg_left, irmf, del_colors, del_fonts,
          fontdir, fix_container_only, html_margin, dont_hyph_headers,
-         pair_family):
+         pair_family, pack_threads=1):
     global qfixerr
+
+    def fix_and_pack(ws):
+        global skipped_files
+        is_failed = process_epub(
+            ws, _replacefonts, _resetmargins, skip_hyph,
+            arg_justify, arg_left, irmf, fontdir, del_colors,
+            del_fonts, html_margin, dont_hyph_headers, pair_family)
+        if not is_failed:
+            ws.pack(os.path.join(root, newfile), threads=pack_threads)
+            # counted after packing, a book which is repaired, because
+            # packing failed, is processed again
+            skipped_files += book_skipped_files
+        return is_failed
+
     qfixerr = False
+    is_failed = False
     newfile = os.path.splitext(f)[0] + '_moh.epub'
     if not _forced:
         if os.path.isfile(os.path.join(root, newfile)):
             print('* Skipping previously generated _moh file: ' +
                   newfile)
-            return 0
+            return qfixerr
+    ws = open_epub(root, f, zbf)
+    if ws is None:
+        return True
     try:
-        _tempdir = unpack_epub(os.path.join(root, f))
-    except zipfile.BadZipfile, e:
-        fixed_pth = process_corrupted_zip(e, root, f, zbf)
-        if str(fixed_pth) == '1':
-            return 0
-        else:
-            _tempdir = unpack_epub(fixed_pth)
-            os.unlink(fixed_pth)
-    if fix_container_only:
-        print('')
-        print('* Checking for missing META-INF/container.xml in '
-              'original file: ' + f)
-        opf_dir, opf_file_path, is_fixed = find_roots(_tempdir)
-        if is_fixed:
-            print('* Repairing missing META-INF/container.xml done! '
-                  'Writing changes back to original file...')
-            pack_epub(os.path.join(root, f), _tempdir)
-        else:
-            print('* Repairing not needed...')
-    else:
-        print('')
-        print('START qfix for: ' + f)
-        if skip_hyph:
-            print('* Hyphenating is turned OFF...')
-        is_failed = process_epub(
-            _tempdir, _replacefonts, _resetmargins, skip_hyph,
-            arg_justify, arg_left, irmf, fontdir, del_colors,
-            del_fonts, html_margin, dont_hyph_headers)
-        if not is_failed:
-            pack_epub(os.path.join(root, newfile), _tempdir)
-        else:
-            qfixerr = True
-        if qfixerr:
-            print('FINISH (with PROBLEMS) qfix for: ' + f)
+        if fix_container_only:
+            print('')
+            print('* Checking for missing META-INF/container.xml in '
+                  'original file: ' + f)
+            opf_dir, opf_file_path, is_fixed = find_roots(ws)
+            if is_fixed:
+                print('* Repairing missing META-INF/container.xml done! '
+                      'Writing changes back to original file...')
+                ws.pack(os.path.join(root, f))
+            else:
+                print('* Repairing not needed...')
         else:
-            print('FINISH qfix for: ' + f)
-    clean_temp(_tempdir)
-    if not fix_container_only and not is_failed:
-        beautify_book(root, f, fontdir, pair_family)
+            print('')
+            print('START qfix for: ' + f)
+            if skip_hyph:
+                print('* Hyphenating is turned OFF...')
+            try:
+                is_failed = fix_and_pack(ws)
+            except zipfile.BadZipfile, e:
+                # entries are decompressed only when they are used, so
+                # a corrupted entry is found while the book is processed
+                ws.close()
+                ws = open_epub(root, f, zbf, e)
+                if ws is None:
+                    return True
+                is_failed = fix_and_pack(ws)
+            if is_failed:
+                qfixerr = True
+            if qfixerr:
+                print('FINISH (with PROBLEMS) qfix for: ' + f)
+            else:
+                print('FINISH qfix for: ' + f)
+    finally:
+        if ws is not None:
+            ws.close()
+    return qfixerr
+
+
+class LogBuffer(object):
+    """File-like object collecting everything printed for one book."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, message):
+        self.chunks.append(message)
+
+    def flush(self):
+        pass
+
+
+def qfix_buffered(task):
+    """
+    Run qfix() for a single book and return its buffered log.
+
+    The task is a (root, f, options) tuple, where options are the remaining
+    positional arguments of qfix(). Returns a (chunks, is_problem,
+    new_words, skipped) tuple, so the whole START/FINISH block of a book can
+    be written out at once. new_words are words hyphenated for the first
+    time in the book, they are stored by the parent process. skipped is
+    the number of already hyphenated XHTML files of the book.
+    """
+    root, f, options = task
+    stdout = sys.stdout
+    sys.stdout = log = LogBuffer()
+    try:
+        is_problem = qfix(root, f, *options)
+    except Exception:
+        print('! CRITICAL! Unexpected error while processing file '
+              '"%s":' % f)
+        print(traceback.format_exc().decode(SFENC))
+        print('FINISH (with PROBLEMS) qfix for: ' + f)
+        is_problem = True
+    finally:
+        sys.stdout = stdout
+    return log.chunks, is_problem, take_new_words(), take_skipped_files()
+
+
+def qfix_library(tasks, jobs, hyph_options=(CACHE_SIZE, None)):
+    """
+    Fix many books in a pool of worker processes.
+
+    Every worker has its own hyphenator, set up with setup_hyphenation()
+    called with hyph_options, and its own EPUB workspace. Results are
+    yielded in the order of tasks, as produced by qfix_buffered().
+    """
+    pool = multiprocessing.Pool(jobs, setup_hyphenation, hyph_options)
+    try:
+        for result in pool.imap(qfix_buffered, tasks):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
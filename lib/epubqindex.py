@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import bisect
+import os
+import stat
+
+from collections import OrderedDict
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class LibraryFile(object):
+    """Single file found in a library directory."""
+
+    __slots__ = ('root', 'name', 'size', 'mtime')
+
+    def __init__(self, root, name, size, mtime):
+        self.root = root
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def path(self):
+        return os.path.join(self.root, self.name)
+
+    def __repr__(self):
+        return 'LibraryFile(%r)' % self.path
+
+
+def list_dir(path):
+    """
+    Return sorted lists of (name, size, mtime) tuples of files and names of
+    subdirectories for a single directory.
+    """
+    files = []
+    dirs = []
+    if scandir is not None:
+        for e in scandir(path):
+            try:
+                if e.is_dir():
+                    dirs.append(e.name)
+                elif e.is_file():
+                    st = e.stat()
+                    files.append((e.name, st.st_size, st.st_mtime))
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(name)
+            elif stat.S_ISREG(st.st_mode):
+                files.append((name, st.st_size, st.st_mtime))
+    files.sort()
+    dirs.sort()
+    return files, dirs
+
+
+class LibraryIndex(object):
+    """
+    Index of all files in a library directory built with a single pass.
+
+    Files are kept in a stable order: sorted by name inside every directory,
+    directories visited top-down like os.walk(). Numbers used by individual
+    mode are positions in the list returned by originals().
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.scan()
+
+    def scan(self):
+        # directory path -> list of files sorted by name
+        self.dirs = OrderedDict()
+        # (directory path, file name) -> file
+        self.paths = {}
+        pending = [self.directory]
+        while pending:
+            root = pending.pop()
+            try:
+                files, dirs = list_dir(root)
+            except OSError:
+                continue
+            self.dirs[root] = []
+            for name, size, mtime in files:
+                lf = LibraryFile(root, name, size, mtime)
+                self.dirs[root].append(lf)
+                self.paths[root, name] = lf
+            pending.extend(os.path.join(root, d) for d in reversed(dirs))
+
+    @property
+    def files(self):
+        return [lf for files in self.dirs.itervalues() for lf in files]
+
+    def select(self, suffix, excludes=()):
+        return [f for f in self.files if f.name.lower().endswith(suffix) and
+                not f.name.lower().endswith(excludes)]
+
+    def originals(self):
+        """Original EPUB files (including _org.epub backups)."""
+        return self.select('.epub', ('_moh.epub',))
+
+    def fixable(self):
+        """Original EPUB files which can be fixed to _moh.epub files."""
+        return self.select('.epub', ('_moh.epub', '_org.epub'))
+
+    def moh_epubs(self):
+        return self.select('_moh.epub')
+
+    def moh_mobis(self):
+        return self.select('_moh.mobi')
+
+    def individual(self, nr):
+        """Return the original EPUB file with the given number or None."""
+        originals = self.originals()
+        if 0 <= nr < len(originals):
+            return originals[nr]
+        return None
+
+    def get(self, root, name):
+        return self.paths.get((root, name))
+
+    def refresh(self, root, name):
+        """Update the index after a file was written or removed."""
+        lf = self.paths.get((root, name))
+        try:
+            st = os.stat(os.path.join(root, name))
+        except OSError:
+            if lf is not None:
+                self.dirs[root].remove(lf)
+                del self.paths[root, name]
+            return None
+        if lf is not None:
+            lf.size = st.st_size
+            lf.mtime = st.st_mtime
+            return lf
+        lf = LibraryFile(root, name, st.st_size, st.st_mtime)
+        files = self.dirs.setdefault(root, [])
+        # keep the files of a directory sorted by name
+        pos = bisect.bisect([f.name for f in files], name)
+        files.insert(pos, lf)
+        self.paths[root, name] = lf
+        return lf
+
+    def rename(self, root, old_name, new_name):
+        """Update the index after a file was renamed."""
+        self.refresh(root, old_name)
+        return self.refresh(root, new_name)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+from lxml import etree
+
+OPF = '{http://www.idpf.org/2007/opf}'
+ITEM = OPF + 'item'
+ITEMREF = OPF + 'itemref'
+
+
+class OpfPackage(object):
+    """
+    Parsed OPF file with indexes of manifest items and spine itemrefs.
+
+    It is used by fixers in place of the parsed OPF tree, xpath() and
+    getroot() are passed to the tree. Items are looked up by href, id and
+    media-type and itemrefs by idref without XPath queries. When hrefs
+    contain quotes, no XPath is built by string concatenation either.
+
+    The href, id, media-type and idref attributes are changed, and items
+    and itemrefs are added, removed or moved, only with methods of the
+    package. These methods mark the indexes as stale, and the next lookup
+    rebuilds them in a single pass over the tree. When the same key is
+    used by many items, the first one in document order is returned, the
+    same as with XPath before.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.stale = True
+
+    def getroot(self):
+        return self.tree.getroot()
+
+    def xpath(self, *args, **kwargs):
+        return self.tree.xpath(*args, **kwargs)
+
+    def reindex(self):
+        self._items = []
+        self._hrefs = {}
+        self._ids = {}
+        self._media_types = {}
+        self._idrefs = {}
+        for el in self.tree.getroot().iter(ITEM, ITEMREF):
+            if el.tag == ITEM:
+                self._items.append(el)
+                if el.get('href') is not None:
+                    self._hrefs.setdefault(el.get('href'), el)
+                if el.get('id') is not None:
+                    self._ids.setdefault(el.get('id'), el)
+                self._media_types.setdefault(el.get('media-type'),
+                                             []).append(el)
+            elif el.get('idref') is not None:
+                self._idrefs.setdefault(el.get('idref'), el)
+        self.stale = False
+
+    def items(self, *media_types):
+        """Return items of all or given media types in document order."""
+        if self.stale:
+            self.reindex()
+        if not media_types:
+            return list(self._items)
+        if len(media_types) == 1:
+            return list(self._media_types.get(media_types[0], ()))
+        return [i for i in self._items if i.get('media-type') in media_types]
+
+    def item_by_href(self, href):
+        if self.stale:
+            self.reindex()
+        return self._hrefs.get(href)
+
+    def item_by_id(self, id):
+        if self.stale:
+            self.reindex()
+        return self._ids.get(id)
+
+    def itemref_by_idref(self, idref):
+        if self.stale:
+            self.reindex()
+        return self._idrefs.get(idref)
+
+    def set(self, el, name, value):
+        """Set attribute name of an item or itemref."""
+        el.set(name, value)
+        self.stale = True
+
+    def add_item(self, href, id, media_type):
+        """Append a new item to the manifest and return it."""
+        item = etree.SubElement(
+            next(self.tree.getroot().iter(OPF + 'manifest')), ITEM,
+            attrib={'media-type': media_type, 'href': href, 'id': id}
+        )
+        self.stale = True
+        return item
+
+    def add_itemref(self, idref):
+        """Append a new itemref to the spine and return it."""
+        itemref = etree.SubElement(
+            next(self.tree.getroot().iter(OPF + 'spine')), ITEMREF,
+            idref=idref
+        )
+        self.stale = True
+        return itemref
+
+    def remove(self, el):
+        """Remove an item or itemref."""
+        el.getparent().remove(el)
+        self.stale = True
+
+    def move_first(self, el):
+        """Move an item or itemref to the beginning of its parent."""
+        parent = el.getparent()
+        parent.remove(el)
+        parent.insert(0, el)
+        self.stale = True
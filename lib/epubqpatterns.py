@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+# XPath expressions and regular expressions compiled once at import time
+# and shared by qcheck, qfix and beautify. They are called for every file
+# of every book, and books split into thousands of small XHTML files spend
+# a lot of time compiling the same expressions again otherwise.
+#
+# Compiled XPath objects are called with a tree or an element, values of
+# parameterised lookups are passed as XPath variables, e.g.
+#     DC_IDENTIFIER_TEXT(opftree, id=uniqid)
+# so they are never built by string concatenation.
+#
+
+import re
+
+from lxml import etree
+
+NAMESPACES = {
+    'cr': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'svg': 'http://www.w3.org/2000/svg',
+    'xhtml': 'http://www.w3.org/1999/xhtml',
+    'xlink': 'http://www.w3.org/1999/xlink'
+}
+
+
+def xpath(path):
+    return etree.XPath(path, namespaces=NAMESPACES)
+
+
+# OPF
+OPF_PACKAGE = xpath('//opf:package')
+OPF_REFERENCE_BY_TYPE = xpath('//opf:reference[@type=$type]')
+OPF_ITEM_BY_ID = xpath('//opf:item[@id=$id]')
+DC_IDENTIFIER_TEXT = xpath('//dc:identifier[@id=$id]/text()')
+
+# NCX
+NCX_CONTENTS = xpath('//ncx:content')
+NCX_CONTENTS_WITH_SRC = xpath('//ncx:content[@src]')
+NCX_NAVPOINTS = xpath('//ncx:navPoint')
+
+# XHTML
+XHTML_HTML = xpath('//xhtml:html')
+XHTML_HEAD = xpath('//xhtml:head')
+XHTML_BODY = xpath('//xhtml:body')
+XHTML_BODY_WITH_ID = xpath('//xhtml:body[@id]')
+XHTML_BODY_TEXTS = xpath('//xhtml:body//text()')
+TEXTS = xpath('//text()')
+XHTML_LINKS = xpath('//xhtml:link')
+XHTML_META_CHARSET = xpath('//xhtml:meta[@charset="utf-8"]')
+XHTML_WITH_URL = xpath('//xhtml:*[@href or @src]')
+XHTML_IMGS = xpath('//xhtml:img')
+SVG_IMAGES = xpath('//svg:image')
+WITH_URL = xpath('//*[@href or @src]')
+WITH_ANY_URL = xpath('//*[@href or @src or @xlink:href]')
+WITH_STYLE = xpath('//*[@style]')
+WM_MARKS = xpath('//*[starts-with(text(),"===")]')
+FRAGMENT_PIS = xpath('//processing-instruction("fragment")')
+
+# CSS
+CSS_COMMENT = re.compile(r'\/\*[^*]*\*+([^/*][^*]*\*+)*\/')
+CSS_URLS = re.compile(r'url\(\s*([\"\']?)(.+?)\1\s*\)')
+CSS_FONT_FACE = re.compile(r'@font-face.*?\{.*?\}', re.DOTALL)
+CALIBRE_SELECTOR = re.compile(r'(^|,|\s+)\.calibre(\s+|,|{)')
+BODY_SELECTOR = re.compile(r'(^|,|\s+)body(\s+|,|{)')
+FONT_FAMILY_VALUE = re.compile(r'font-family\s*:\s*(.*?)(;|})')
+FONT_FAMILY_NONEMPTY = re.compile(r'font-family\s*:\s*(.+?)(;|})')
+FONT_FAMILY_LINE = re.compile(r'font-family\s*:\s*(.*?)(;|$)')
+TEXT_ALIGN = {
+    'left': re.compile(r'text-align\s*:\s*left'),
+    'justify': re.compile(r'text-align\s*:\s*justify')
+}
+COLOR = re.compile(r'color\s*:\s*(.*?)(;|\r|\n)')
+
+# inline styles
+STYLE_WORDS = re.compile(r'[:; ]+')
+WIDTH_100 = re.compile(r'[^-]width:(\s*)100%;*')
+DISPLAY_NONE = re.compile(r'display\s*:\s*none')
+
+# others
+NCX_INVALID_ID = re.compile('[^0-9a-zA-Z_.-]+')
+FONT_SUBSET_PREFIX = re.compile(r'\w+?\s-\ssubset\sof\s')
+UNCLOSED_BODY = re.compile(r'Opening and ending tag mismatch: body line \d+ '
+                           r'and html')
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import posixpath
+
+from collections import namedtuple, OrderedDict
+from urllib import unquote
+
+from lib import epubqpatterns as pat
+from lib.epubqworkspace import normalize
+
+EXCLUDED_URLS = ('http://', 'https://', 'mailto:', 'tel:', 'data:', '#')
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+# attributes with URL, only the first one found is used for an element
+URL_ATTRIBUTES = ('src', 'href', XLINK_HREF)
+
+# A reference from the file source to the file target. path is the URL
+# without the anchor as written in source, but unquoted. element and
+# attribute hold the URL in XML documents, both are None in stylesheets.
+Reference = namedtuple('Reference', 'source target path anchor element '
+                                    'attribute')
+
+
+def unquote_url(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    url = unquote(url)
+    try:
+        return url.decode('utf-8')
+    except UnicodeDecodeError:
+        return url.decode('latin-1')
+
+
+def resolve(source, path):
+    """Return the archive name for path relative to the file source."""
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source),
+                                             path))
+
+
+def relative_url(target, source, anchor):
+    url = posixpath.relpath(target, posixpath.dirname(source) or '.')
+    if anchor:
+        url += '#' + anchor
+    return url
+
+
+class ReferenceGraph(object):
+    """
+    References between files of a book.
+
+    Files of the archive are nodes and every reference found in an XML
+    document (href, src and xlink:href attributes of XHTML, OPF and NCX
+    files) or a stylesheet (url() values) is an edge. Edges are indexed by
+    the source and by the target file, so both the references of a file
+    and the references to a file are found without scanning the book.
+
+    The graph is built once per book. Fixers which change references use
+    update() or rename(), so the graph is kept in sync with documents.
+    """
+
+    def __init__(self, names=()):
+        # archive names of all files of the book
+        self.resources = OrderedDict((normalize(n), None) for n in names
+                                     if not n.endswith('/'))
+        # source -> references in document order
+        self.outgoing = OrderedDict()
+        # target -> references to the target
+        self.incoming = {}
+        # name -> id attribute of body element of XHTML files
+        self.body_ids = {}
+
+    def _index(self, ref):
+        self.outgoing.setdefault(ref.source, []).append(ref)
+        self.incoming.setdefault(ref.target, []).append(ref)
+        return ref
+
+    def _unindex(self, ref):
+        self.incoming[ref.target].remove(ref)
+        if not self.incoming[ref.target]:
+            del self.incoming[ref.target]
+
+    def _reference(self, source, url, element=None, attribute=None):
+        if url is None or url.lower().startswith(EXCLUDED_URLS):
+            return None
+        path, sep, anchor = unquote_url(url).partition('#')
+        if not path:
+            return None
+        return Reference(source, resolve(source, path), path, anchor,
+                         element, attribute)
+
+    def remove_file(self, source):
+        """Remove references of source, e.g. before it is scanned again."""
+        for ref in self.outgoing.pop(source, ()):
+            self._unindex(ref)
+        self.body_ids.pop(source, None)
+
+    def add_document(self, source, tree):
+        """Add references of the parsed XML document source."""
+        source = normalize(source)
+        self.remove_file(source)
+        self.outgoing[source] = []
+        for el in pat.WITH_ANY_URL(tree):
+            for attribute in URL_ATTRIBUTES:
+                if el.get(attribute):
+                    ref = self._reference(source, el.get(attribute), el,
+                                          attribute)
+                    if ref is not None:
+                        self._index(ref)
+                    break
+        for body in pat.XHTML_BODY_WITH_ID(tree):
+            self.body_ids[source] = body.get('id')
+            break
+
+    def add_stylesheet(self, source, text):
+        """Add url() references of the stylesheet source."""
+        source = normalize(source)
+        self.remove_file(source)
+        self.outgoing[source] = []
+        for m in pat.CSS_URLS.finditer(pat.CSS_COMMENT.sub('', text)):
+            ref = self._reference(source, m.group(2))
+            if ref is not None:
+                self._index(ref)
+
+    def references(self, source):
+        """Return references of the file source in document order."""
+        return list(self.outgoing.get(normalize(source), ()))
+
+    def referrers(self, target):
+        """Return references to the file target."""
+        return list(self.incoming.get(normalize(target), ()))
+
+    def targets(self):
+        """Return names of all referenced files."""
+        return list(self.incoming)
+
+    def broken(self, source):
+        """Return references of source to files missing in the book."""
+        return [r for r in self.references(source)
+                if r.target not in self.resources]
+
+    def orphans(self, source):
+        """Return names of files not referenced by the file source."""
+        targets = set(r.target
+                      for r in self.outgoing.get(normalize(source), ()))
+        return [n for n in self.resources if n not in targets]
+
+    def _replace(self, old, new):
+        refs = self.outgoing[new.source]
+        refs[refs.index(old)] = new
+        self._unindex(old)
+        self.incoming.setdefault(new.target, []).append(new)
+        return new
+
+    def update(self, ref, url):
+        """Set the URL of the reference ref in its document."""
+        ref.element.set(ref.attribute, url)
+        new = self._reference(ref.source, url, ref.element, ref.attribute)
+        if new is None:
+            self.outgoing[ref.source].remove(ref)
+            self._unindex(ref)
+            return None
+        return self._replace(ref, new)
+
+    def _rewrite(self, ref, target):
+        """Point the reference ref to target and set its URL."""
+        url = relative_url(target, ref.source, ref.anchor)
+        if ref.element is not None:
+            ref.element.set(ref.attribute, url)
+        return self._replace(ref, ref._replace(
+            target=target, path=url.partition('#')[0]
+        ))
+
+    def rename(self, old_name, new_name):
+        """
+        Move the file old_name to new_name in the graph.
+
+        URLs to the file in XML documents are rewritten and so are relative
+        URLs of the moved document, when its directory is changed. Return
+        the changed references, URLs in stylesheets still have to be
+        rewritten by the caller.
+        """
+        old_name = normalize(old_name)
+        new_name = normalize(new_name)
+        self.resources.pop(old_name, None)
+        self.resources[new_name] = None
+        changed = []
+        moved = self.outgoing.pop(old_name, None)
+        if moved is not None:
+            if old_name in self.body_ids:
+                self.body_ids[new_name] = self.body_ids.pop(old_name)
+            self.outgoing[new_name] = []
+            is_moved = (posixpath.dirname(old_name) !=
+                        posixpath.dirname(new_name))
+            for ref in moved:
+                self._unindex(ref)
+                ref = self._index(ref._replace(source=new_name))
+                if is_moved:
+                    changed.append(self._rewrite(ref, ref.target))
+        for ref in self.referrers(old_name):
+            changed.append(self._rewrite(ref, new_name))
+        return changed
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+
+from multiprocessing.pool import ThreadPool
+from lib.epubqcache import CACHE_DIR
+
+SFENC = sys.getfilesystemencoding()
+
+# short living JVM: skip the optimizing compiler and use the simplest GC
+JVM_OPTIONS = ['-XX:+IgnoreUnrecognizedVMOptions', '-Xshare:auto',
+               '-XX:TieredStopAtLevel=1', '-XX:+UseSerialGC',
+               '-Djava.awt.headless=true']
+
+
+def fs_path(path):
+    """Return path encoded for subprocess arguments."""
+    if isinstance(path, unicode):
+        return path.encode(SFENC)
+    return path
+
+
+def extract_epubcheck(zip_path, epubcheckstr, cache_dir=CACHE_DIR):
+    """
+    Return path to epubcheck.jar extracted from the EpubCheck ZIP file.
+
+    The ZIP file is extracted only once into a cache directory versioned
+    with its name, size and mtime, so a new EpubCheck ZIP file is extracted
+    again automatically.
+    """
+    st = os.stat(zip_path)
+    version_dir = os.path.join(cache_dir, '%s-%d-%d' % (
+        epubcheckstr, st.st_size, int(st.st_mtime)
+    ))
+    jar = os.path.join(version_dir, epubcheckstr, 'epubcheck.jar')
+    if os.path.isfile(jar):
+        return jar
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    temp_dir = tempfile.mkdtemp(suffix='', prefix='quiris-tmp-',
+                                dir=cache_dir)
+    try:
+        with zipfile.ZipFile(zip_path) as echpzipfile:
+            echpzipfile.extractall(temp_dir)
+        try:
+            os.rename(temp_dir, version_dir)
+        except OSError:
+            # extracted by another epubQTools process in the meantime
+            if not os.path.isfile(jar):
+                raise
+    finally:
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+    return jar
+
+
+def epubcheck(jar, path):
+    """Validate a single EPUB file and return error output of EpubCheck."""
+    jp = subprocess.Popen(
+        ['java'] + JVM_OPTIONS + [
+            '-jar', fs_path(jar), fs_path(path)
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    jpout, jperr = jp.communicate()
+    return jperr
+
+
+def epubcheck_library(jar, paths, jobs):
+    """
+    Validate many EPUB files with at most jobs JVMs running at once.
+
+    EpubCheck 4.x validates a single EPUB file per JVM, so books are
+    spread over a pool of JVM processes instead. (path, error output)
+    tuples are yielded in the order of paths as soon as they are ready.
+    """
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield path, epubcheck(jar, path)
+        return
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap(lambda path: (path, epubcheck(jar, path)),
+                                paths):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class KindlegenReport(object):
+    """Result of converting a single book with kindlegen."""
+
+    def __init__(self, path):
+        self.path = path
+        self.skipped = False
+        self.lines = []
+        self.error_found = False
+        self.cover_html_found = False
+        self.timed_out = False
+
+
+def kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        # already finished
+        pass
+
+
+def kindlegen(kgapp, path, compression, timeout=None):
+    """
+    Convert a single EPUB file with kindlegen and return its report.
+
+    Output of kindlegen is parsed while it is produced and the conversion
+    is aborted at the first Error line. With timeout kindlegen is killed
+    after that number of seconds.
+    """
+    report = KindlegenReport(path)
+    proc = subprocess.Popen([
+        fs_path(kgapp), '-dont_append_source', compression, fs_path(path)
+    ], stdout=subprocess.PIPE)
+    timer = None
+    if timeout:
+        def on_timeout():
+            report.timed_out = True
+            kill(proc)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+    try:
+        for ln in iter(proc.stdout.readline, ''):
+            ln = ln.rstrip('\r\n')
+            if 'Warning' in ln and 'W14029' not in ln:
+                report.lines.append(ln)
+            if 'Error' in ln:
+                report.lines.append(ln)
+                report.error_found = True
+                kill(proc)
+                break
+            if 'I1052' in ln:
+                report.cover_html_found = True
+        proc.stdout.close()
+        proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return report
+
+
+def kindlegen_library(kgapp, books, compression, jobs, timeout=None):
+    """
+    Convert many EPUB files with at most jobs kindlegen processes at once.
+
+    books is a list of (path, skip) tuples, skipped books are not converted
+    but still reported. Reports are yielded in the order of books.
+    """
+    def convert(book):
+        path, skip = book
+        if skip:
+            report = KindlegenReport(path)
+            report.skipped = True
+            return report
+        return kindlegen(kgapp, path, compression, timeout)
+
+    if jobs <= 1 or len(books) <= 1:
+        for book in books:
+            yield convert(book)
+        return
+    pool = ThreadPool(jobs)
+    try:
+        for report in pool.imap(convert, books):
+            yield report
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
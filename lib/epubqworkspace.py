@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import errno
+import mimetypes
+import os
+import posixpath
+import struct
+import StringIO
+import sys
+import time
+import zipfile
+import zlib
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from lxml import etree
+
+# already compressed formats, deflating them again gives nothing
+STORED_MEDIA_TYPES = frozenset([
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    'audio/mpeg', 'audio/mp4', 'video/mp4', 'application/zip',
+    'application/font-woff', 'font/woff', 'font/woff2'
+])
+
+
+def normalize(name):
+    """Return a normalized archive name, e.g. 'OEBPS/Text/../a.css'."""
+    if not isinstance(name, unicode):
+        try:
+            name = name.decode('utf-8')
+        except UnicodeDecodeError:
+            name = name.decode('cp437')
+    name = posixpath.normpath(name.replace('\\', '/'))
+    while name.startswith('../'):
+        name = name[3:]
+    if name in ('.', '..'):
+        return ''
+    return name.lstrip('/')
+
+
+def compress_type(name, stored_types=STORED_MEDIA_TYPES):
+    """Return the compression method for a new or modified entry."""
+    media_type = mimetypes.guess_type(name, strict=False)[0]
+    if media_type in stored_types:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def read_raw(zf, info):
+    """Return compressed data of an entry without decompressing it."""
+    zf.fp.seek(info.header_offset)
+    fheader = zf.fp.read(zipfile.sizeFileHeader)
+    if len(fheader) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile('Truncated file header')
+    fheader = struct.unpack(zipfile.structFileHeader, fheader)
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('Bad magic number for file header')
+    zf.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] +
+               fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    data = zf.fp.read(info.compress_size)
+    if len(data) != info.compress_size:
+        raise zipfile.BadZipfile('Truncated data of file %r' % info.filename)
+    return data
+
+
+def check_entry(zf, info):
+    """
+    Decompress an entry and check its CRC, without keeping the data.
+    Raise BadZipfile when the entry is corrupted.
+    """
+    try:
+        with zf.open(info) as f:
+            while f.read(1 << 20):
+                pass
+    except zlib.error as e:
+        raise zipfile.BadZipfile('Corrupted data of file %r: %s' %
+                                 (info.filename, e))
+
+
+def compress(data, compress_type):
+    """
+    Return CRC and compressed data of an entry the same way as
+    ZipFile.writestr() does. zlib releases the GIL while deflating, so it
+    can be called from many threads at once.
+    """
+    crc = zlib.crc32(data) & 0xffffffff
+    if compress_type == zipfile.ZIP_DEFLATED:
+        co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = co.compress(data) + co.flush()
+    return crc, data
+
+
+def raw_info(name, info):
+    """Return ZipInfo for a copy of the source entry info."""
+    zinfo = zipfile.ZipInfo(name, info.date_time)
+    zinfo.compress_type = info.compress_type
+    # sizes and CRC are known, so the data descriptor is not needed
+    zinfo.flag_bits = info.flag_bits & ~(0x08 | 0x800)
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    return zinfo
+
+
+def parse_document(data):
+    """
+    Return (tree, error) for XML data. When data is not well formed the
+    tree is parsed with a recovering parser and error is the XMLSyntaxError
+    of the strict parser.
+    """
+    try:
+        return etree.parse(StringIO.StringIO(data)), None
+    except etree.XMLSyntaxError as e:
+        return etree.parse(StringIO.StringIO(data),
+                           etree.XMLParser(recover=True)), e
+
+
+def serialize_document(tree):
+    return etree.tostring(tree, xml_declaration=True, standalone=False,
+                          encoding='utf-8')
+
+
+def write_raw(z, zinfo, data):
+    """Append already compressed data of an entry to the ZipFile z."""
+    zinfo.header_offset = z.fp.tell()
+    z.fp.write(zinfo.FileHeader())
+    z.fp.write(data)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+    z._didModify = True
+
+
+class EpubWorkspace(object):
+    """
+    Copy-on-write view of an EPUB archive used instead of a temp directory.
+
+    Entries are read lazily from the source ZipFile and only when needed.
+    Written entries are kept in memory as overlay buffers and removed or
+    renamed entries are tracked in the overlay as well, so the source
+    archive stays untouched until pack() is called.
+
+    All names are archive paths relative to the root of the EPUB file.
+    After find_roots() the opf_dir attribute holds the directory of the OPF
+    file, which is the base for hrefs used in the OPF file.
+
+    Parsed documents returned by document() are shared by all callers,
+    each entry is parsed at most once. Documents marked as modified with
+    touch() are serialized once by flush() or when the entry is read.
+    parse_document and serialize_document may be replaced to parse and
+    serialize documents of the book in a specific way.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.zf = zipfile.ZipFile(source)
+        # name -> ZipInfo of the source entry or None for a new entry
+        self.infos = OrderedDict()
+        # name -> data of modified or new entries
+        self.overlay = {}
+        # name -> data of unmodified entries read so far
+        self.loaded = {}
+        # name -> (tree, error) of parsed documents, see document()
+        self.documents = {}
+        # names of documents modified since they were parsed or flushed
+        self.dirty = set()
+        self.parse_document = parse_document
+        self.serialize_document = serialize_document
+        self.opf_dir = ''
+        for info in self.zf.infolist():
+            if info.filename.endswith('/'):
+                continue
+            name = normalize(info.filename)
+            if name == 'mimetype':
+                continue
+            self.infos[name] = info
+
+    def namelist(self):
+        return list(self.infos)
+
+    def exists(self, name):
+        return normalize(name) in self.infos
+
+    def join(self, *parts):
+        return normalize(posixpath.join(*parts))
+
+    def href_name(self, href):
+        """Return the archive name for a href relative to the OPF file."""
+        return self.join(self.opf_dir, href)
+
+    def relpath(self, name, start):
+        """Return a relative url of name as seen from directory start."""
+        return posixpath.relpath(name or '.', start or '.')
+
+    def read(self, name):
+        name = normalize(name)
+        if name in self.dirty:
+            self.flush_document(name)
+        if name in self.overlay:
+            return self.overlay[name]
+        if name in self.loaded:
+            return self.loaded[name]
+        info = self.infos.get(name)
+        if info is None:
+            raise IOError(errno.ENOENT, 'No such file in EPUB', name)
+        data = self.loaded[name] = self.zf.read(info)
+        return data
+
+    def parse(self, name, parser=None):
+        return etree.parse(StringIO.StringIO(self.read(name)), parser)
+
+    def document(self, name, strict=False):
+        """
+        Return the parsed document name, the same tree for every call.
+
+        With strict the XMLSyntaxError is raised for documents which are
+        not well formed, unless the recovered tree was modified since.
+        """
+        name = normalize(name)
+        if name not in self.documents:
+            self.documents[name] = self.parse_document(self.read(name))
+        tree, error = self.documents[name]
+        if strict and error is not None and name not in self.dirty:
+            raise error
+        return tree
+
+    def touch(self, name):
+        """Mark the document name as modified."""
+        name = normalize(name)
+        if name in self.documents:
+            self.dirty.add(name)
+
+    def flush_document(self, name):
+        self.dirty.discard(name)
+        tree, error = self.documents[name]
+        self.loaded.pop(name, None)
+        self.overlay[name] = self.serialize_document(tree)
+        self.documents[name] = tree, None
+
+    def flush(self):
+        """Serialize all modified documents."""
+        for name in list(self.dirty):
+            self.flush_document(name)
+
+    def write(self, name, data):
+        name = normalize(name)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.documents.pop(name, None)
+        self.dirty.discard(name)
+        self.loaded.pop(name, None)
+        self.overlay[name] = data
+        self.infos.setdefault(name, None)
+
+    def remove(self, name):
+        name = normalize(name)
+        if name not in self.infos:
+            raise IOError(errno.ENOENT, 'No such file in EPUB', name)
+        del self.infos[name]
+        self.overlay.pop(name, None)
+        self.loaded.pop(name, None)
+        self.documents.pop(name, None)
+        self.dirty.discard(name)
+
+    def rename(self, old_name, new_name):
+        old_name = normalize(old_name)
+        new_name = normalize(new_name)
+        if old_name not in self.infos:
+            raise IOError(errno.ENOENT, 'No such file in EPUB', old_name)
+        if new_name in self.infos:
+            self.remove(new_name)
+        self.infos[new_name] = self.infos.pop(old_name)
+        for d in (self.overlay, self.loaded, self.documents):
+            if old_name in d:
+                d[new_name] = d.pop(old_name)
+        if old_name in self.dirty:
+            self.dirty.remove(old_name)
+            self.dirty.add(new_name)
+
+    def is_modified(self, name):
+        name = normalize(name)
+        return (name in self.overlay or name in self.dirty or
+                self.infos.get(name) is None)
+
+    def pack(self, output_filename, stored_types=STORED_MEDIA_TYPES,
+             threads=1):
+        """
+        Write the workspace to a new EPUB file.
+
+        Compressed data of unmodified entries is copied from the source
+        archive without compressing it again. Entries which were not read
+        are decompressed once to check them first, so a corrupted source
+        raises BadZipfile before anything is written, the same as when it
+        was extracted. New and modified entries are deflated, except media
+        types listed in stored_types. With threads greater than 1 they are
+        compressed in a pool of threads, entries are still written in the
+        same order.
+        """
+        if output_filename == self.source:
+            # the source archive is still read while packing
+            target = output_filename + '.epubQTools-tmp'
+        else:
+            target = output_filename
+        self.flush()
+        pool = ThreadPool(threads) if threads > 1 else None
+        try:
+            jobs = {}
+            for name, info in self.infos.iteritems():
+                if info is None or name in self.overlay:
+                    zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+                    zinfo.external_attr = 0644 << 16L
+                    zinfo.compress_type = compress_type(name, stored_types)
+                    job = (self.read(name), zinfo.compress_type)
+                    if pool is not None:
+                        job = pool.apply_async(compress, job)
+                    jobs[name] = zinfo, job
+                elif name not in self.loaded:
+                    # read() already checked entries which were loaded
+                    check_entry(self.zf, info)
+            with zipfile.ZipFile(target, 'w') as z:
+                z.writestr('mimetype', 'application/epub+zip')
+                for name, info in self.infos.iteritems():
+                    if name in jobs:
+                        zinfo, job = jobs.pop(name)
+                        zinfo.file_size = len(self.read(name))
+                        if pool is not None:
+                            zinfo.CRC, data = job.get()
+                        else:
+                            zinfo.CRC, data = compress(*job)
+                        zinfo.compress_size = len(data)
+                    else:
+                        zinfo = raw_info(name, info)
+                        data = read_raw(self.zf, info)
+                    write_raw(z, zinfo, data)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if target != output_filename:
+            self.close()
+            if sys.platform == 'win32' and os.path.exists(output_filename):
+                os.remove(output_filename)
+            os.rename(target, output_filename)
+
+    def close(self):
+        self.zf.close()
+        self.loaded.clear()
+        self.documents.clear()
+        self.dirty.clear()
+
+
+def open_workspace(data):
+    """Return a workspace for EPUB file kept in memory."""
+    return EpubWorkspace(StringIO.StringIO(data))
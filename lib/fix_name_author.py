@@ -10,10 +10,8 @@ import zipfile
 import os
 import sys
 from lxml import etree
-from lib.epubqfix import pack_epub
-from lib.epubqfix import unpack_epub
-from lib.epubqfix import clean_temp
 from lib.epubqfix import find_roots
+from lib.epubqworkspace import EpubWorkspace
 
 SFENC = sys.getfilesystemencoding()
 OPFNS = {'opf': 'http://www.idpf.org/2007/opf'}
@@ -88,21 +86,23 @@ def set_title(tree, title):
 def fix_name_author(root, f, author, title):
     print('START work for: ' + f.decode(SFENC))
     try:
-        tempdir = unpack_epub(os.path.join(root, f))
+        ws = EpubWorkspace(os.path.join(root, f))
     except zipfile.BadZipfile:
         print('Unable to process corrupted file...')
         return 0
-    opfd, opff, is_fixed = find_roots(tempdir)
-    opff_abs = os.path.join(tempdir, opff)
-    parser = etree.XMLParser(remove_blank_text=True)
-    opftree = etree.parse(opff_abs, parser)
-    if author != 'no_author' and author is not None:
-        set_author(opftree, author)
-    if title != 'no_title' and title is not None:
-        set_title(opftree, title)
-    with open(opff_abs, 'w') as file:
-        file.write(etree.tostring(opftree.getroot(), pretty_print=True,
-                   standalone=False, xml_declaration=True, encoding='utf-8'))
-    pack_epub(os.path.join(root, f), tempdir)
-    clean_temp(tempdir)
+    try:
+        opfd, opff, is_fixed = find_roots(ws)
+        parser = etree.XMLParser(remove_blank_text=True)
+        opftree = ws.parse(opff, parser)
+        if author != 'no_author' and author is not None:
+            set_author(opftree, author)
+        if title != 'no_title' and title is not None:
+            set_title(opftree, title)
+        ws.write(opff, etree.tostring(
+            opftree.getroot(), pretty_print=True, standalone=False,
+            xml_declaration=True, encoding='utf-8'
+        ))
+        ws.pack(os.path.join(root, f))
+    finally:
+        ws.close()
     print('FINISH work for: ' + f.decode(SFENC))
@@ -5,6 +5,8 @@
 # Copyright © Robert Błaut. See NOTICE for more information.
 #
 
+import re
+
 entities = {
     "&AElig;": '&#198;',
     "&Aacute;": '&#193;',
@@ -259,3 +261,19 @@ entities = {
     "&zwj;": '&#8205;',
     "&zwnj;": '&#8204;',
 }
+
+# keys of entities are '&name;', so they never overlap and a single pass
+# gives the same result as replacing them one by one
+ENTITY = re.compile(r'&[A-Za-z][A-Za-z0-9]*;')
+
+
+def replace_entity(match):
+    name = match.group()
+    return entities.get(name, name)
+
+
+def replace_entities(c):
+    """Replace HTML named entities in c with numeric character references."""
+    if '&' not in c:
+        return c
+    return ENTITY.sub(replace_entity, c)
@@ -17,12 +17,31 @@ License: LGPL.
 
 import sys
 import re
+import os
+import mmap
+import struct
+import hashlib
+import json
+import tempfile
+
+from collections import OrderedDict
+from StringIO import StringIO
 
 __all__ = ("Hyphenator")
 
 # cache of per-file Hyph_dict objects
 hdcache = {}
 
+# default capacity of the word cache of a Hyph_dict
+CACHE_SIZE = 100000
+
+# compiled dictionary: header, '\0' separated pattern keys, index of
+# (values offset, start, length) per key, values, nonstandard alternatives
+COMPILED_MAGIC = 'HYPHDICT'
+COMPILED_VERSION = 1
+compiled_header = struct.Struct('<8sI20sIIIII')
+compiled_index = struct.Struct('<IBB')
+
 # precompile some stuff
 parse_hex = re.compile(r'\^{2}([0-9a-f]{2})').sub
 parse = re.compile(r'(\d?)(\D?)').findall
@@ -77,47 +96,265 @@ class dint(int):
         return obj
 
 
+def parse_dict(f):
+    """
+    Parse a hyph_*.dic file object.
+
+    Returns a (patterns, maxlen) tuple, patterns is a dict mapping pattern
+    to a (start offset, values) tuple.
+    """
+    patterns = {}
+    charset = f.readline().strip()
+    if charset.startswith('charset '):
+        charset = charset[8:].strip()
+
+    for pat in f:
+        pat = pat.decode(charset).strip()
+        if not pat or pat[0] == '%':
+            continue
+        # replace ^^hh with the real character
+        pat = parse_hex(hexrepl, pat)
+        # read nonstandard hyphen alternatives
+        if '/' in pat:
+            pat, alt = pat.split('/', 1)
+            factory = parse_alt(pat, alt)
+        else:
+            factory = int
+        tag, value = zip(*[(s, factory(i or "0")) for i, s in parse(pat)])
+        # if only zeros, skip this pattern
+        if max(value) == 0:
+            continue
+        # chop zeros from beginning and end, and store start offset.
+        start, end = 0, len(value)
+        while not value[start]:
+            start += 1
+        while not value[end - 1]:
+            end -= 1
+        patterns[''.join(tag)] = start, value[start:end]
+    return patterns, max(map(len, patterns.keys()))
+
+
+def compile_dict(f, output, digest):
+    """
+    Compile a hyph_*.dic file object into the binary form read by
+    Compiled_dict.
+
+    digest is the SHA-1 digest of the source dictionary, it is stored as
+    the version stamp of the compiled file. The file is written to a
+    temporary file first, so a reader never sees a partial file.
+    """
+    patterns, maxlen = parse_dict(f)
+    keys = sorted(patterns)
+    keys_blob = u'\0'.join(keys).encode('utf-8')
+    offset = (compiled_header.size + len(keys_blob) +
+              compiled_index.size * len(keys))
+    index = []
+    values = []
+    alts = []
+    for i, key in enumerate(keys):
+        start, value = patterns[key]
+        index.append(compiled_index.pack(offset, start, len(value)))
+        values.append(''.join(chr(v) for v in value))
+        offset += len(value)
+        for pos, v in enumerate(value):
+            if type(v) == dint and v.data:
+                change, alt_index, cut = v.data
+                alts.append(u'%d\t%d\t%s\t%d\t%d' % (
+                    i, pos, change, alt_index, cut
+                ))
+    values = ''.join(values)
+    alts = u'\n'.join(alts).encode('utf-8')
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(output) + '.',
+                                dir=os.path.dirname(output) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(compiled_header.pack(
+                COMPILED_MAGIC, COMPILED_VERSION, digest, maxlen,
+                len(index), len(keys_blob), len(values), len(alts)
+            ))
+            out.write(keys_blob)
+            out.write(''.join(index))
+            out.write(values)
+            out.write(alts)
+        os.chmod(temp, 0644)
+        if sys.platform == 'win32' and os.path.exists(output):
+            os.remove(output)
+        os.rename(temp, output)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def compiled_digest(filename):
+    """
+    Return the version stamp of a compiled dictionary or None, if the file
+    is missing or was compiled by a different version of this module.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(compiled_header.size)
+    except (IOError, OSError):
+        return None
+    if len(header) != compiled_header.size:
+        return None
+    magic, version, digest = compiled_header.unpack(header)[:3]
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+        return None
+    return digest
+
+
+class Pattern_table(object):
+    """
+    Read-only mapping of patterns stored in a compiled dictionary.
+
+    Values of a pattern are unpacked from the memory mapped file when the
+    pattern is used for the first time.
+    """
+
+    def __init__(self, mm, keys, index_offset, alts):
+        self.mm = mm
+        self.ids = dict((k, i) for i, k in enumerate(keys))
+        self.index_offset = index_offset
+        self.alts = alts
+        self.loaded = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __getitem__(self, key):
+        p = self.get(key)
+        if p is None:
+            raise KeyError(key)
+        return p
+
+    def get(self, key, default=None):
+        p = self.loaded.get(key)
+        if p is not None:
+            return p
+        i = self.ids.get(key)
+        if i is None:
+            return default
+        offset, start, length = compiled_index.unpack_from(
+            self.mm, self.index_offset + i * compiled_index.size
+        )
+        value = tuple(bytearray(self.mm[offset:offset + length]))
+        if i in self.alts:
+            data = self.alts[i]
+            value = tuple(dint(v, data[pos]) if pos in data else v
+                          for pos, v in enumerate(value))
+        p = self.loaded[key] = start, value
+        return p
+
+    def keys(self):
+        return list(self.ids)
+
+
+class LRU_cache(object):
+    """
+    Word cache keeping at most capacity most recently used words.
+
+    hits and misses count the results of get().
+    """
+
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+
+
+def encode_points(points):
+    """Return hyphenation points as a string, see decode_points()."""
+    if any(type(p) is dint for p in points):
+        return json.dumps([[p] + list(p.data) if type(p) is dint else p
+                           for p in points])
+    return ','.join(str(p) for p in points)
+
+
+def decode_points(value):
+    """Return hyphenation points stored with encode_points()."""
+    if value.startswith('['):
+        return [dint(p[0], tuple(p[1:])) if isinstance(p, list) else p
+                for p in json.loads(value)]
+    if not value:
+        return []
+    return map(int, value.split(','))
+
+
 class Hyph_dict(object):
     """
     Reads a hyph_*.dic file and stores the hyphenation patterns.
 
+    The digest attribute holds the SHA-1 digest of the file.
+
+    Words hyphenated in previous runs may be given in the words attribute,
+    an object with a get() method returning points of a lowercased word
+    encoded with encode_points(), or None. It is used for words missing in
+    the word cache and the points found are put in the cache. If the
+    new_words attribute is a dict, words which were hyphenated with the
+    patterns are collected in it the same way.
+
     Parameters:
     -filename : filename of hyph_*.dic to read
+    -cache_size: capacity of the word cache
     """
 
-    def __init__(self, filename):
-        self.patterns = {}
-        f = open(filename)
-        charset = f.readline().strip()
-        if charset.startswith('charset '):
-            charset = charset[8:].strip()
-
-        for pat in f:
-            pat = pat.decode(charset).strip()
-            if not pat or pat[0] == '%':
-                continue
-            # replace ^^hh with the real character
-            pat = parse_hex(hexrepl, pat)
-            # read nonstandard hyphen alternatives
-            if '/' in pat:
-                pat, alt = pat.split('/', 1)
-                factory = parse_alt(pat, alt)
-            else:
-                factory = int
-            tag, value = zip(*[(s, factory(i or "0")) for i, s in parse(pat)])
-            # if only zeros, skip this pattern
-            if max(value) == 0:
-                continue
-            # chop zeros from beginning and end, and store start offset.
-            start, end = 0, len(value)
-            while not value[start]:
-                start += 1
-            while not value[end - 1]:
-                end -= 1
-            self.patterns[''.join(tag)] = start, value[start:end]
-        f.close()
-        self.cache = {}
-        self.maxlen = max(map(len, self.patterns.keys()))
+    def __init__(self, filename, cache_size=CACHE_SIZE):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        self.digest = hashlib.sha1(data).digest()
+        self.patterns, self.maxlen = parse_dict(StringIO(data))
+        self.cache = LRU_cache(cache_size)
+        self.words = None
+        self.new_words = None
+        self._trie = None
+
+    @property
+    def trie(self):
+        """
+        Trie of the patterns built on first use.
+
+        Every node is a dict mapping a character to the next node. A pattern
+        ending in the node is stored under the None key as its key, and it
+        is replaced with the (start offset, values) tuple of the pattern when
+        the pattern matches for the first time. So the trie is built from
+        keys only and values of a compiled dictionary are still unpacked
+        only for patterns which are used.
+        """
+        if self._trie is None:
+            trie = {}
+            for pat in self.patterns:
+                node = trie
+                for c in pat:
+                    node = node.setdefault(c, {})
+                node[None] = pat
+            self._trie = trie
+        return self._trie
 
     def positions(self, word):
         """
@@ -126,9 +363,9 @@ class Hyph_dict(object):
         E.g. for the dutch word 'lettergrepen' this method returns
         the list [3, 6, 9].
 
-        Each position is a 'data int' (dint) with a data attribute.
-        If the data attribute is not None, it contains a tuple with
-        information about nonstandard hyphenation at that point:
+        Positions with nonstandard hyphenation are 'data ints' (dint)
+        with a data attribute, which contains a tuple with information
+        about nonstandard hyphenation at that point:
         (change, index, cut)
 
         change: is a string like 'ff=f', that describes how hyphenation
@@ -140,22 +377,110 @@ class Hyph_dict(object):
         """
         word = word.lower()
         points = self.cache.get(word)
+        if points is None and self.words is not None:
+            value = self.words.get(word)
+            if value is not None:
+                points = decode_points(value)
+                self.cache[word] = points
         if points is None:
             prepWord = '.%s.' % word
             res = [0] * (len(prepWord) + 1)
-            for i in range(len(prepWord) - 1):
-                for j in range(i + 1, min(i + self.maxlen, len(prepWord)) + 1):
-                    p = self.patterns.get(prepWord[i:j])
-                    if p:
-                        offset, value = p
-                        s = slice(i + offset, i + offset + len(value))
-                        res[s] = map(max, value, res[s])
-
-            points = [dint(i - 1, ref=r) for i, r in enumerate(res) if r % 2]
+            trie = self.trie
+            patterns = self.patterns
+            maxlen = self.maxlen
+            # walk the trie once from every start position, every node on
+            # the way is a pattern matching at that position
+            for i in xrange(len(prepWord) - 1):
+                node = trie
+                for c in prepWord[i:i + maxlen]:
+                    node = node.get(c)
+                    if node is None:
+                        break
+                    p = node.get(None)
+                    if p is not None:
+                        if type(p) is not tuple:
+                            p = node[None] = patterns[p]
+                        k, value = p
+                        k += i
+                        for v in value:
+                            # ties go to the pattern, like max() does
+                            if v >= res[k]:
+                                res[k] = v
+                            k += 1
+
+            points = [dint(i - 1, r.data) if type(r) is dint else i - 1
+                      for i, r in enumerate(res) if r % 2]
             self.cache[word] = points
+            if self.new_words is not None:
+                self.new_words[word] = encode_points(points)
         return points
 
 
+class Compiled_dict(Hyph_dict):
+    """
+    Reads a dictionary compiled with compile_dict().
+
+    The file is memory mapped, so processes using the same dictionary
+    share its pages and nothing has to be parsed on startup.
+
+    Parameters:
+    -filename : filename of the compiled dictionary to read
+    -cache_size: capacity of the word cache
+    """
+
+    def __init__(self, filename, cache_size=CACHE_SIZE):
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.digest, self.maxlen, count, keys_len,
+         values_len, alts_len) = compiled_header.unpack_from(self.mm)
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            raise ValueError('Unsupported compiled dictionary: ' + filename)
+        offset = compiled_header.size
+        keys = self.mm[offset:offset + keys_len].decode('utf-8').split(u'\0')
+        index_offset = offset + keys_len
+        offset = index_offset + count * compiled_index.size + values_len
+        alts = {}
+        if alts_len:
+            for ln in self.mm[offset:offset + alts_len].decode(
+                    'utf-8').split(u'\n'):
+                i, pos, change, alt_index, cut = ln.split(u'\t')
+                alts.setdefault(int(i), {})[int(pos)] = (
+                    change, int(alt_index), int(cut)
+                )
+        self.patterns = Pattern_table(self.mm, keys, index_offset, alts)
+        self.cache = LRU_cache(cache_size)
+        self.words = None
+        self.new_words = None
+        self._trie = None
+
+
+def load_compiled(filename, source, cache_dirs):
+    """
+    Return a path to the compiled form of the source dictionary.
+
+    source is the content of a hyph_*.dic file. An up to date compiled file
+    is looked for in cache_dirs and if there is none, the dictionary is
+    compiled into the first writable directory. Returns None, if it could
+    not be written anywhere.
+    """
+    digest = hashlib.sha1(source).digest()
+    name = os.path.basename(filename) + 'c'
+    for cache_dir in cache_dirs:
+        compiled = os.path.join(cache_dir, name)
+        if compiled_digest(compiled) == digest:
+            return compiled
+    for cache_dir in cache_dirs:
+        compiled = os.path.join(cache_dir, name)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            compile_dict(StringIO(source), compiled, digest)
+        except (IOError, OSError):
+            continue
+        return compiled
+    return None
+
+
 class Hyphenator(object):
     """
     Reads a hyph_*.dic file and stores the hyphenation patterns.
@@ -168,16 +493,25 @@ class Hyphenator(object):
     -right: make the last syllabe not shorter than this
     -cache: if true (default), use a cached copy of the dic file, if possible
 
+    A file compiled with compile_dict() may be given instead of a hyph_*.dic
+    file, it is recognized by its header.
+
     left and right may also later be changed:
       h = Hyphenator(file)
       h.left = 1
+
+    Words hyphenated in previous runs are used through the words and
+    new_words attributes of the Hyph_dict in the hd attribute.
     """
 
     def __init__(self, filename, left=2, right=2, cache=True):
         self.left = left
         self.right = right
         if not cache or filename not in hdcache:
-            hdcache[filename] = Hyph_dict(filename)
+            if compiled_digest(filename) is not None:
+                hdcache[filename] = Compiled_dict(filename)
+            else:
+                hdcache[filename] = Hyph_dict(filename)
         self.hd = hdcache[filename]
 
     def positions(self, word):
@@ -190,12 +524,22 @@ class Hyphenator(object):
         right = len(word) - self.right
         return [i for i in self.hd.positions(word) if self.left <= i <= right]
 
+    def take_new_words(self):
+        """
+        Return words collected in new_words of the dictionary and start
+        a new collection.
+        """
+        if self.hd.new_words is None:
+            return {}
+        new_words, self.hd.new_words = self.hd.new_words, {}
+        return new_words
+
     def iterate(self, word):
         """Iterate over all hyphenation possibilities, the longest first."""
         if isinstance(word, str):
             word = word.decode('latin1')
         for p in reversed(self.positions(word)):
-            if p.data:
+            if type(p) is dint and p.data:
                 # get the nonstandard hyphenation data
                 change, index, cut = p.data
                 if word.isupper():
@@ -230,7 +574,7 @@ class Hyphenator(object):
             word = word.decode('latin1')
         l = list(word)
         for p in reversed(self.positions(word)):
-            if p.data:
+            if type(p) is dint and p.data:
                 # get the nonstandard hyphenation data
                 change, index, cut = p.data
                 if word.isupper():
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.epubqcache import HyphenationCache
+
+DIGEST = '\x01' * 20
+
+
+def open_cache(args):
+    """Open the cache in a worker process when start is set."""
+    path, start, word = args
+    start.wait()
+    cache = HyphenationCache(path, DIGEST)
+    try:
+        cache.store({word: '2,4'})
+        return cache.get(word)
+    finally:
+        cache.close()
+
+
+class HyphenationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-test-')
+        self.path = os.path.join(self.tempdir, 'home', '.epubQTools',
+                                 'cache', 'hyphenation.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_processes_create_missing_directory(self):
+        manager = multiprocessing.Manager()
+        start = manager.Event()
+        pool = multiprocessing.Pool(2)
+        try:
+            result = pool.map_async(open_cache, [
+                (self.path, start, u'słowo%d' % i) for i in range(2)
+            ], chunksize=1)
+            start.set()
+            self.assertEqual(result.get(60), ['2,4', '2,4'])
+        finally:
+            pool.close()
+            pool.join()
+            manager.shutdown()
+        cache = HyphenationCache(self.path, DIGEST)
+        self.assertEqual(cache.get(u'słowo0'), '2,4')
+        self.assertEqual(cache.get(u'słowo1'), '2,4')
+        cache.close()
+
+    def test_directory_created_meanwhile(self):
+        os.makedirs(os.path.dirname(self.path))
+        isdir = os.path.isdir
+        # the directory was created by another process after the check
+        os.path.isdir = lambda path: False
+        try:
+            cache = HyphenationCache(self.path, DIGEST)
+            self.assertEqual(cache.get(u'słowo'), None)
+        finally:
+            os.path.isdir = isdir
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.epubqbench import make_corpus
+from lib.hyphenator import Compiled_dict, Hyph_dict, compile_dict, dint
+
+DICT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'lib', 'resources', 'dictionaries', 'hyph_pl_PL.dic')
+
+
+def substring_positions(hd, word):
+    """
+    Hyph_dict.positions() as it was before the trie: every substring of
+    the word is looked up in the patterns and values are merged with max().
+    """
+    prepWord = '.%s.' % word.lower()
+    res = [0] * (len(prepWord) + 1)
+    for i in range(len(prepWord) - 1):
+        for j in range(i + 1, min(i + hd.maxlen, len(prepWord)) + 1):
+            p = hd.patterns.get(prepWord[i:j])
+            if p:
+                offset, value = p
+                s = slice(i + offset, i + offset + len(value))
+                res[s] = map(max, value, res[s])
+    return [dint(i - 1, ref=r) for i, r in enumerate(res) if r % 2]
+
+
+def dump(points):
+    return [(int(p), getattr(p, 'data', None)) for p in points]
+
+
+class TriePositionsTest(unittest.TestCase):
+    """
+    positions() walking the trie returns the same points as the substring
+    lookups for every pattern of the Polish dictionary and a word corpus.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp(prefix='epubQTools-test-')
+        with open(DICT, 'rb') as f:
+            digest = hashlib.sha1(f.read()).digest()
+        cls.compiled = os.path.join(cls.tempdir, 'hyph_pl_PL.dicc')
+        with open(DICT, 'rb') as f:
+            compile_dict(f, cls.compiled, digest)
+        # every pattern as a word of its own and generated words
+        words = set(p.strip('.') for p in Hyph_dict(DICT).patterns)
+        words.update(make_corpus(20000))
+        words.discard(u'')
+        cls.words = sorted(words)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def check(self, hd):
+        mismatches = []
+        for word in self.words:
+            expected = dump(substring_positions(hd, word))
+            if dump(hd.positions(word)) != expected:
+                mismatches.append(word)
+        self.assertEqual(mismatches[:20], [])
+
+    def test_hyph_dict(self):
+        self.check(Hyph_dict(DICT))
+
+    def test_compiled_dict(self):
+        self.check(Compiled_dict(self.compiled))
+
+    def test_trie_is_lazy(self):
+        hd = Compiled_dict(self.compiled)
+        hd.trie
+        self.assertEqual(len(hd.patterns.loaded), 0)
+        hd.positions(u'nieprawdopodobieństwo')
+        self.assertTrue(0 < len(hd.patterns.loaded) < len(hd.patterns))
+
+
+if __name__ == '__main__':
+    unittest.main()
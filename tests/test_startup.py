@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of epubQTools, licensed under GNU Affero GPLv3 or later.
+# Copyright © Robert Błaut. See NOTICE for more information.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.epubqbench import HEAVY_MODULES, LAZY_RESOURCES, \
+    make_fixed_layout_epub, startup_modules
+
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StartupTest(unittest.TestCase):
+    """
+    Short commands must not import modules and load resources which are
+    needed only by checking and fixing books.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(suffix='', prefix='epubQTools-test-')
+        make_fixed_layout_epub(os.path.join(self.tempdir, 'book.epub'), 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def assertNotLoaded(self, args, names):
+        modules = startup_modules(PACKAGE, args)
+        self.assertIn('lib.epubqindex', modules)
+        self.assertEqual([m for m in names if m in modules], [])
+        return modules
+
+    def test_version(self):
+        self.assertNotLoaded(['-V'], HEAVY_MODULES + LAZY_RESOURCES)
+
+    def test_listing(self):
+        self.assertNotLoaded([self.tempdir, '-i'],
+                             HEAVY_MODULES + LAZY_RESOURCES)
+
+    def test_rename(self):
+        # renaming reads metadata with lxml, but fixes nothing
+        modules = self.assertNotLoaded(
+            [self.tempdir, '-n'],
+            ('cssutils', 'lib.beautify_book') + LAZY_RESOURCES
+        )
+        self.assertIn('lib.epubqfix', modules)
+
+
+if __name__ == '__main__':
+    unittest.main()